@@ -1,7 +1,7 @@
-from ontquery.query import OntQuery, OntQueryCli
+from ontquery.query import OntQuery, OntQueryCli, AsyncOntQuery
 from ontquery.terms import OntCuries, OntId, OntTerm
 from ontquery import plugin
 
-__all__ = ['OntCuries', 'OntId', 'OntTerm', 'OntQuery', 'OntQueryCli']
+__all__ = ['OntCuries', 'OntId', 'OntTerm', 'OntQuery', 'OntQueryCli', 'AsyncOntQuery']
 
 __version__ = '0.2.11'
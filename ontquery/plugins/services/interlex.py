@@ -1,10 +1,17 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Union, List, Dict
 
 import rdflib
 
 import ontquery as oq
 import ontquery.exceptions as exc
-from ontquery.utils import cullNone, log, QueryResult
+from ontquery.utils import cullNone, log, QueryResult, deadline_session
 from ontquery.services import OntService
 from .interlex_client import InterLexClient
 from .rdflib import rdflibLocal
@@ -14,13 +21,43 @@ from . import deco
 class _InterLexSharedCache:
     _graph_cache = {}
     # FIXME maxsize ??
+    _graph_cache_lock = threading.Lock()
+    _graph_fetch_locks = {}  # url -> lock so that only one thread fetches each url
+
+    def _cached_graph(self, url, fetch):
+        """ the cached graph for url, calling fetch(url) at most once per url,
+            fetch returns (graph, cache) where cache says whether to keep it """
+        with self._graph_cache_lock:
+            if url in self._graph_cache:
+                return self._graph_cache[url]
+
+            lock = self._graph_fetch_locks.setdefault(url, threading.Lock())
+
+        with lock:
+            with self._graph_cache_lock:
+                if url in self._graph_cache:  # another thread finished fetching
+                    return self._graph_cache[url]
+
+            graph, cache = fetch(url)
+            with self._graph_cache_lock:
+                if cache:
+                    self._graph_cache[url] = graph
+
+                self._graph_fetch_locks.pop(url, None)
+
+            return graph
 
 
 @deco.ilx_host
 @deco.ilx_port
 class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
+    _accepts_plan = True
+    hedgeable = True
     known_inverses = ('', ''),
     defaultEndpoint = 'https://scicrunch.org/api/1/'
+    _executor = None
+    _executor_lock = threading.Lock()
+    _max_workers = 8
 
     def __init__(self, *args, apiEndpoint=defaultEndpoint,
                  user_curies: dict = None,  # FIXME hardcoded
@@ -33,6 +70,8 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
         self.OntId = OntId
         self.apiEndpoint = apiEndpoint
         self.api_first = api_first
+        # prefix -> name of the lookup that last resolved an entity for it
+        self._resolution_paths = {}
 
         # TODO : TROY : should move this to a global change since this is fluid 
         self.user_curies = user_curies or {'ILX': 'http://uri.interlex.org/base/ilx_',
@@ -177,6 +216,122 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
                 # TODO stick the responding predicates etc in if success
         return tresp
 
+    def _ilx_fragment(self, ontid):
+        """ fragment the way the server reports it, ie ilx_0101431 """
+        if ontid.startswith('http://'):
+            return self.ilx_cli.get_ilx_fragment(ontid)
+        elif ontid.prefix == 'ILXTEMP':
+            return 'tmp_' + ontid.suffix
+        elif ontid.prefix == 'ILX.CDE':
+            return 'cde_' + ontid.suffix
+        elif ontid.prefix == 'ILX.SET':
+            return 'set_' + ontid.suffix
+        elif ontid.prefix == 'ILX.PDE':
+            return 'pde_' + ontid.suffix
+        else:
+            return 'ilx_' + ontid.suffix
+
+    def _current_predicates(self, fragment):
+        """ live annotations and relationships of one entity as
+            (kind, predicate fragment, value or object fragment) """
+        entity = self.ilx_cli.get_entity(fragment)
+        current = set()
+        for anno in entity.get('annotations') or []:
+            if str(anno['withdrawn']) == '0':
+                current.add(('annotation',
+                             self.ilx_cli.get_ilx_fragment(anno['annotation_term_ilx']),
+                             anno['value']))
+
+        for rel in entity.get('relationships') or []:
+            if (str(rel['withdrawn']) == '0' and
+                self.ilx_cli.get_ilx_fragment(rel['term1_ilx']) == fragment):
+                current.add(('relationship',
+                             self.ilx_cli.get_ilx_fragment(rel['relationship_term_ilx']),
+                             self.ilx_cli.get_ilx_fragment(rel['term2_ilx'])))
+
+        return current
+
+    def sync_predicates(self, predicates: dict, max_workers: int = 8,
+                        rate: float = None, dry_run: bool = False) -> tuple:
+        """ Make the annotations and relationships of many subjects match predicates.
+
+            Only the predicates listed for a subject are synced, everything
+            else on it is left alone. Each subject is fetched once, the diff
+            is computed locally and the writes run concurrently.
+
+        :param predicates: {subject: {predicate: object or [objects]}} like add_predicates
+        :param max_workers: number of concurrent writers
+        :param rate: maximum writes per second across all writers, None for no limit
+        :param dry_run: compute the diff without writing anything
+        :return: (added, withdrawn) lists of (subject, predicate, object) fragments or values
+        """
+        desired, synced = {}, {}
+        for subject, preds in predicates.items():
+            if not subject.startswith('http://uri.interlex.org/base/'):  # FIXME: need formality
+                subject = 'http://uri.interlex.org/base/' + subject
+
+            s = self._ilx_fragment(self.OntId(subject))
+            triples = desired.setdefault(s, set())
+            for predicate, objs in preds.items():
+                p = self._ilx_fragment(self.OntId(predicate))
+                synced.setdefault(s, set()).add(p)  # an empty list clears p
+                if not isinstance(objs, list):
+                    objs = [objs]
+
+                for object in objs:
+                    o = self._get_type(object)
+                    if type(o) == str:
+                        triples.add(('annotation', p, o))
+                    elif type(o) == self.OntId:
+                        triples.add(('relationship', p, self._ilx_fragment(o)))
+                    else:
+                        raise TypeError(f'what are you giving me?! {object!r}')
+
+        executor = self._get_executor()
+        current = dict(zip(desired, executor.map(self._current_predicates, desired)))
+
+        add, withdraw = [], []
+        for s, triples in desired.items():
+            add.extend((s, t) for t in sorted(triples - current[s]))
+            withdraw.extend((s, t) for t in sorted(current[s] - triples)
+                            if t[1] in synced.get(s, ()))
+
+        added = [(s, p, o) for s, (_, p, o) in add]
+        withdrawn = [(s, p, o) for s, (_, p, o) in withdraw]
+        if dry_run:
+            return added, withdrawn
+
+        funcs = {('add', 'annotation'): self.ilx_cli.add_annotation,
+                 ('add', 'relationship'): self.ilx_cli.add_relationship,
+                 ('withdraw', 'annotation'): self.ilx_cli.withdraw_annotation,
+                 ('withdraw', 'relationship'): self.ilx_cli.withdraw_relationship,}
+        lock = threading.Lock()
+        interval = 1 / rate if rate else 0
+        next_slot = [time.monotonic()]
+
+        def write(action, s, t):
+            if interval:
+                with lock:
+                    now = time.monotonic()
+                    wait = next_slot[0] - now
+                    next_slot[0] = max(now, next_slot[0]) + interval
+
+                if wait > 0:
+                    time.sleep(wait)
+
+            kind, p, o = t
+            return funcs[action, kind](s, p, o)
+
+        jobs = ([('withdraw', s, t) for s, t in withdraw] +
+                [('add', s, t) for s, t in add])
+        with ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix='InterLexSync') as writers:
+            # result() raises the first failed write after the rest finish
+            for future in [writers.submit(write, *job) for job in jobs]:
+                future.result()
+
+        return added, withdrawn
+
     def get_entity(self, ilx_id: str, **kwargs) -> dict:
         try:
             resp = self.ilx_cli.get_entity(ilx_id)
@@ -438,15 +593,6 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
         """ Triple of curied or full iris to add to graph.
             Subject should be an interlex """
 
-        def filter_ontid(ontid):
-            if ontid.startswith('http://'):
-                pass
-            elif ontid.prefix == 'ILXTEMP':
-                ontid = 'tmp_' + ontid.suffix
-            else:
-                ontid = 'ilx_' + ontid.suffix
-            return ontid
-
         # this split between annotations and relationships is severely annoying
         # because you have to know before hand which one it is (sigh)
         s = self.OntId(subject)
@@ -456,12 +602,12 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
             func = self.ilx_cli.add_annotation
         elif type(o) == self.OntId:
             func = self.ilx_cli.add_relationship
-            o = filter_ontid(o)
+            o = self._ilx_fragment(o)
         else:
             raise TypeError(f'what are you giving me?! {object!r}')
 
-        s = filter_ontid(s)
-        p = filter_ontid(p)
+        s = self._ilx_fragment(s)
+        p = self._ilx_fragment(p)
 
         resp = func(s, p, o)
         return resp
@@ -470,22 +616,6 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
         """ Triple of curied or full iris to add to graph.
             Subject should be an interlex """
 
-        # TODO : TROY : should move this to a global change since this is fluid 
-        def filter_ontid(ontid):
-            if ontid.startswith('http://'):
-                pass
-            elif ontid.prefix == 'ILXTEMP':
-                ontid = 'tmp_' + ontid.suffix
-            elif ontid.prefix == 'ILX.CDE':
-                ontid = 'cde_' + ontid.suffix
-            elif ontid.prefix == 'ILX.SET':
-                ontid = 'set_' + ontid.suffix
-            elif ontid.prefix == 'ILX.PDE':
-                ontid = 'pde_' + ontid.suffix
-            else:
-                ontid = 'ilx_' + ontid.suffix
-            return ontid
-
         # this split between annotations and relationships is severely annoying
         # because you have to know before hand which one it is (sigh)
         s = self.OntId(subject)
@@ -495,12 +625,12 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
             func = self.ilx_cli.withdraw_annotation
         elif type(o) == self.OntId:
             func = self.ilx_cli.withdraw_relationship
-            o = filter_ontid(o)
+            o = self._ilx_fragment(o)
         else:
             raise TypeError(f'what are you giving me?! {object!r}')
 
-        s = filter_ontid(s)
-        p = filter_ontid(p)
+        s = self._ilx_fragment(s)
+        p = self._ilx_fragment(p)
 
         # TODO: check if add_relationship works
         resp = func(s, p, o)
@@ -516,20 +646,17 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
     def _is_dev_endpoint(self):
         return bool(self.port)
 
+    @property
+    def query_keywords(self):
+        if hasattr(self, 'ilx_cli') and not self._is_dev_endpoint:
+            return frozenset(('iri', 'curie', 'label', 'term'))  # term via elasticsearch
+        else:
+            return frozenset(('iri', 'curie', 'label'))
+
     def query(self, iri=None, curie=None, label=None, term=None, predicates=tuple(),
-              prefix=tuple(), exclude_prefix=tuple(), limit=10, depth=1, **_):
+              prefix=tuple(), exclude_prefix=tuple(), limit=10, depth=1, _plan=None, **_):
         kwargs = cullNone(iri=iri, curie=curie, label=label, term=term, predicates=predicates)
-        if iri:
-            oiri = self.OntId(iri=iri)
-            icurie = oiri.curie
-            if curie and icurie and icurie != curie:
-                raise ValueError(f'curie and curied iri do not match {curie} {icurie}')
-            else:
-                curie = icurie
-
-        elif curie:
-            iri = self.OntId(curie).iri
-
+        iri, curie = self._iri_curie(iri, curie, _plan)
         if self._is_dev_endpoint:
             res = self._dev_query(kwargs, iri, curie, label, predicates, prefix, exclude_prefix, depth)
             if res is not None:
@@ -558,31 +685,213 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
             if res is not None:
                 yield res
 
-    def _scicrunch_api_query(self, kwargs, iri, curie, label, term, predicates, limit):
-        resp = None
+    def _iri_curie(self, iri, curie, plan=None):
+        identifier = None if plan is None else plan.identifier
         if iri:
-            try:
-                resp: dict = self.ilx_cli.get_entity(iri)
-            except:
-                pass
+            oiri = self.OntId(iri=iri) if identifier is None else identifier
+            icurie = oiri.curie
+            if curie and icurie and icurie != curie:
+                raise ValueError(f'curie and curied iri do not match {curie} {icurie}')
+            else:
+                curie = icurie
+
+        elif curie:
+            iri = (self.OntId(curie) if identifier is None else identifier).iri
+
+        return iri, curie
+
+    async def aquery(self, iri=None, curie=None, label=None, term=None, predicates=tuple(),
+                     prefix=tuple(), exclude_prefix=tuple(), limit=10, depth=1,
+                     _plan=None, **_):
+        # only entity lookups through the scicrunch api are natively async
+        # FIXME the dev resolver and elastic search still go through a thread
+        native = (importlib.util.find_spec('aiohttp') is not None and
+                  not self._is_dev_endpoint and
+                  hasattr(self, 'ilx_cli') and
+                  self.api_first and
+                  (iri or curie))
+
+        if not native:
+            async for result in super().aquery(
+                    iri=iri, curie=curie, label=label, term=term, predicates=predicates,
+                    prefix=prefix, exclude_prefix=exclude_prefix, limit=limit, depth=depth,
+                    _plan=_plan, **_):
+                yield result
+
+            return
 
-        if resp is None and curie:
+        kwargs = cullNone(iri=iri, curie=curie, label=label, term=term, predicates=predicates)
+        iri, curie = self._iri_curie(iri, curie, _plan)
+        resp = await self._aresolve_entity(iri, curie)
+        if resp is None:
+            return
+
+        for result in self._api_query_results(kwargs, iri, curie, resp):
+            yield result
+
+    async def aclose(self):
+        if hasattr(self, 'ilx_cli'):
+            await self.ilx_cli.aclose()
+
+    @staticmethod
+    def _reset_after_fork():
+        """ worker threads and the locks they held do not survive a fork """
+        InterLexRemote._executor = None
+        InterLexRemote._executor_lock = threading.Lock()
+        _InterLexSharedCache._graph_cache_lock = threading.Lock()
+        _InterLexSharedCache._graph_fetch_locks = {}
+
+    @classmethod
+    def _get_executor(cls):
+        with InterLexRemote._executor_lock:
+            if InterLexRemote._executor is None:
+                InterLexRemote._executor = ThreadPoolExecutor(
+                    max_workers=cls._max_workers,
+                    thread_name_prefix='InterLexRemote')
+
+        return InterLexRemote._executor
+
+    @property
+    def resolution_paths(self):
+        """ prefix -> lookup (iri, curie, iri_curie) that resolved it last """
+        return dict(self._resolution_paths)
+
+    _entity_lookups = {'iri': 'get_entity',
+                       'curie': 'get_entity_from_curie',
+                       'iri_curie': 'get_entity_from_curie',}
+
+    @staticmethod
+    def _check_entity(resp):
+        if resp is None or resp.get('id', None) is None:  # FIXME should error before we have to check this
+            return
+
+        return resp
+
+    def _try_entity(self, name, arg):
+        try:
+            resp = getattr(self.ilx_cli, self._entity_lookups[name])(arg)
+        except Exception as e:  # the iri path historically used a bare except
+            log.debug(e)
+            return
+
+        return self._check_entity(resp)
+
+    async def _atry_entity(self, name, arg):
+        try:
+            resp = await getattr(self.ilx_cli, 'a' + self._entity_lookups[name])(arg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.debug(e)
+            return
+
+        return self._check_entity(resp)
+
+    def _entity_candidates(self, iri, curie):
+        candidates = []
+        if iri:
             try:
-                resp: dict = self.ilx_cli.get_entity_from_curie(curie)
-            except (self._requests.exceptions.HTTPError, self.ilx_cli.Error) as e:
-                log.debug(e)
-                resp = None
+                self.ilx_cli.get_ilx_fragment(iri)
+                candidates.append(('iri', iri))
+            except ValueError:
+                pass  # not an interlex id, get_entity can never succeed
 
-            if resp is None or resp['id'] is None:  # FIXME should error before we have to check this
-                # sometimes a remote curie does not match ours
-                try:
-                    resp: dict = self.ilx_cli.get_entity_from_curie(self.OntId(iri).curie)
-                except (self._requests.exceptions.HTTPError, self.ilx_cli.Error) as e:
-                    log.debug(e)
-                    return
+        if curie:
+            candidates.append(('curie', curie))
 
-                if resp['id'] is None:
-                    return
+        if iri:
+            # sometimes a remote curie does not match ours
+            icurie = self.OntId(iri).curie
+            if icurie and icurie != curie:
+                candidates.append(('iri_curie', icurie))
+
+        return candidates
+
+    def _entity_prefix(self, iri, curie):
+        try:
+            return self.OntId(iri).prefix if iri else self.OntId(curie).prefix
+        except self.OntId.Error:
+            return None
+
+    def _resolve_entity(self, iri, curie):
+        """ Fire all candidate lookups for an identifier at the same time
+            and return the first valid entity. The lookup that wins is
+            remembered per prefix and tried alone on later queries. """
+        candidates = self._entity_candidates(iri, curie)
+        if not candidates:
+            return
+
+        prefix = self._entity_prefix(iri, curie)
+        path = self._resolution_paths.get(prefix, None)
+        for name, arg in candidates:
+            if name == path:
+                resp = self._try_entity(name, arg)
+                if resp is not None:
+                    return resp
+
+                candidates = [c for c in candidates if c[0] != path]
+                break
+
+        if len(candidates) == 1:
+            (name, arg), = candidates
+            resp = self._try_entity(name, arg)
+            if resp is not None:
+                self._resolution_paths[prefix] = name
+
+            return resp
+
+        executor = self._get_executor()
+        # each lookup gets a copy of the context so the deadline and
+        # transport_errors of the query follow it into the thread
+        futures = {executor.submit(contextvars.copy_context().run,
+                                   self._try_entity, name, arg):name
+                   for name, arg in candidates}
+        for future in as_completed(futures):
+            resp = future.result()
+            if resp is not None:
+                # the losers finish in the background, nothing waits on them
+                self._resolution_paths[prefix] = futures[future]
+                return resp
+
+    async def _aresolve_entity(self, iri, curie):
+        """ Async version of _resolve_entity, losing lookups are cancelled. """
+        candidates = self._entity_candidates(iri, curie)
+        if not candidates:
+            return
+
+        prefix = self._entity_prefix(iri, curie)
+        path = self._resolution_paths.get(prefix, None)
+        for name, arg in candidates:
+            if name == path:
+                resp = await self._atry_entity(name, arg)
+                if resp is not None:
+                    return resp
+
+                candidates = [c for c in candidates if c[0] != path]
+                break
+
+        tasks = {asyncio.ensure_future(self._atry_entity(name, arg)):name
+                 for name, arg in candidates}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    resp = task.result()
+                    if resp is not None:
+                        self._resolution_paths[prefix] = tasks[task]
+                        return resp
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _scicrunch_api_query(self, kwargs, iri, curie, label, term, predicates, limit):
+        resp = None
+        if iri or curie:
+            resp = self._resolve_entity(iri, curie)
+            if resp is None:
+                return
 
         elif label:
             try:
@@ -602,6 +911,9 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
         if not resp:
             return
 
+        yield from self._api_query_results(kwargs, iri, curie, resp)
+
+    def _api_query_results(self, kwargs, iri, curie, resp):
         resps = [resp] if isinstance(resp, dict) else resp
 
         # FIXME this is really a temp hack until we can get the
@@ -694,7 +1006,7 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
 
     def _dev_query(self, kwargs, iri, curie, label, predicates, prefix, exclude_prefix, depth):
         def get(url, headers={'Accept':'application/n-triples'}):  # FIXME extremely slow?
-            with self._requests.Session() as s:
+            with deadline_session(self._requests.Session()) as s:
                 s.headers.update(headers)
                 resp = s.get(url, allow_redirects=False)
                 while resp.is_redirect and resp.status_code < 400:  # FIXME redirect loop issue
@@ -734,24 +1046,21 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
         else:
             return None
 
-        if url in self._graph_cache:
-            graph = self._graph_cache[url]
-            if not graph:
-                return None
-        else:
+        def fetch(url):
             resp = get(url)
             if not resp.ok:
-                if resp.status_code < 500:  # > 500 server broken don't cache None
-                    self._graph_cache[url] = None
-
-                return None
+                # > 500 server broken don't cache None
+                return None, resp.status_code < 500
 
             ttl = resp.content
             if ttl.startswith(b'<!DOCTYPE HTML PUBLIC'):
-                return None  # FIXME disambiguation multi results page
+                return None, False  # FIXME disambiguation multi results page
+
+            return self.Graph().parse(data=ttl, format='turtle'), True
 
-            graph = self.Graph().parse(data=ttl, format='turtle')
-            self._graph_cache[url] = graph
+        graph = self._cached_graph(url, fetch)
+        if not graph:
+            return None
 
         try:
             ia_iri = isAbout(graph)
@@ -833,3 +1142,7 @@ class InterLexRemote(_InterLexSharedCache, OntService):  # note to self
                     return
 
             yield from out
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=InterLexRemote._reset_after_fork)
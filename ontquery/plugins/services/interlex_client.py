@@ -92,6 +92,7 @@ class InterLexClient(InterlexSession):
         """
         key = key or self.api_key  # Set in config under scigraph-api-key or interlex-api-key
         InterlexSession.__init__(self, key=key, host=base_url)
+        self._entity_meta = {}  # ilx fragment -> {'id': ..., 'version': ...}
 
     @staticmethod
     def get_ilx_fragment(ilx_id: str, fragment: bool = False) -> str:
@@ -472,8 +473,50 @@ class InterLexClient(InterlexSession):
         ilx_id = self.get_ilx_fragment(ilx_id)
         resp = self._get(f"term/ilx/{ilx_id}")
         entity = resp.json()['data']
+        self._remember_entity(ilx_id, entity)
         return entity
 
+    async def aget_entity(self, ilx_id: str) -> dict:
+        """ Async version of get_entity.
+
+        :param str ilx_id: ILX ID of current Entity.
+        """
+        ilx_id = self.get_ilx_fragment(ilx_id)
+        resp = await self._aget(f"term/ilx/{ilx_id}")
+        entity = resp.json()['data']
+        self._remember_entity(ilx_id, entity)
+        return entity
+
+    def _remember_entity(self, fragment: str, entity: dict) -> None:
+        if entity.get('id'):
+            self._entity_meta[fragment] = {'id': entity['id'], 'version': entity.get('version')}
+
+    def _forget_entity(self, ilx_id: str) -> None:
+        self._entity_meta.pop(self.get_ilx_fragment(ilx_id), None)
+
+    def get_entity_meta(self, ilx_id: str) -> dict:
+        """ Term id and version for an ILX ID without refetching the whole entity.
+
+            Cached per ilx fragment until this client edits the entity.
+            Adding or withdrawing annotations and relationships creates
+            separate records and does not bump the version of the entities
+            they connect so those writes do not invalidate.
+
+        :param str ilx_id: ILX ID of current Entity.
+        :return: {'id': ..., 'version': ...}, id is None if the entity does not exist
+        """
+        fragment = self.get_ilx_fragment(ilx_id)
+        meta = self._entity_meta.get(fragment)
+        if meta is None:
+            entity = self.get_entity(fragment)
+            meta = {'id': entity['id'], 'version': entity.get('version')}
+
+        return meta
+
+    def clear_entity_meta(self) -> None:
+        """ Drop cached ids and versions, needed if someone else edits the entities. """
+        self._entity_meta.clear()
+
     # todo even in test env it needs ILX prefix instead of TMP b/c its anchored to existing_ids
     def get_entity_from_curie(self, curie: str) -> dict:
         """ Pull InterLex entity if curie exists in existing_ids
@@ -484,6 +527,14 @@ class InterLexClient(InterlexSession):
         """
         return self._get(f'term/curie/{curie}').json()['data']
 
+    async def aget_entity_from_curie(self, curie: str) -> dict:
+        """ Async version of get_entity_from_curie.
+
+        :param curie: Compressed version of IRI from entity
+        """
+        resp = await self._aget(f'term/curie/{curie}')
+        return resp.json()['data']
+
     def add_entity(self,
                    label: str,
                    type: str,
@@ -652,7 +703,12 @@ class InterLexClient(InterlexSession):
         # ReplaceBy relationship connection
         self.replace_entity(from_ilx_id, to_ilx_id)
         # POST
-        resp = self._post(f"term/edit/{entity['ilx']}", data=entity)
+        try:
+            resp = self._post(f"term/edit/{entity['ilx']}", data=entity)
+        finally:
+            # after the write, a read racing it would cache the old version
+            # and a failed write may still have been partially applied
+            self._forget_entity(entity['ilx'])
         # BUG: server response is bad and needs to actually search again to get proper format
         entity = resp.json()['data']
         entity['superclass'] = entity.pop('superclasses')
@@ -823,7 +879,10 @@ class InterLexClient(InterlexSession):
         if existing_entity['existing_ids']:
             existing_entity['existing_ids'] = self._process_existing_ids(existing_entity['existing_ids'])
         # existing_entity['batch-elastic'] = 'true'
-        resp = self._post(f"term/edit/{existing_entity['ilx']}", data=existing_entity)
+        try:
+            resp = self._post(f"term/edit/{existing_entity['ilx']}", data=existing_entity)
+        finally:
+            self._forget_entity(existing_entity['ilx'])  # see merge_and_replace_entity
         # BUG: server response is bad and needs to actually search again to get proper format
         entity = resp.json()['data']
         entity['superclass'] = entity.pop('superclasses')
@@ -891,12 +950,12 @@ class InterLexClient(InterlexSession):
             :param annotation_value: Annotation value
             :return: Empty Annotation Record
         """
-        term_data = self.get_entity(term_ilx_id)
+        term_data = self.get_entity_meta(term_ilx_id)
         if not term_data['id']:
             raise self.EntityDoesNotExistError(
                 'term_ilx_id: ' + term_ilx_id + ' does not exist'
             )
-        anno_data = self.get_entity(annotation_type_ilx_id)
+        anno_data = self.get_entity_meta(annotation_type_ilx_id)
         if not anno_data['id']:
             raise self.EntityDoesNotExistError(
                 'annotation_type_ilx_id: ' + annotation_type_ilx_id
@@ -976,13 +1035,13 @@ class InterLexClient(InterlexSession):
                 -> Has its' own meta data, so no value needed
             3. entity with type term, cde, fde, or pde
         """
-        entity1_data = self.get_entity(entity1_ilx)
+        entity1_data = self.get_entity_meta(entity1_ilx)
         if not entity1_data['id']:
             raise self.EntityDoesNotExistError(f'entity1_ilx: {entity1_data} does not exist')
-        relationship_data = self.get_entity(relationship_ilx)
+        relationship_data = self.get_entity_meta(relationship_ilx)
         if not relationship_data['id']:
             raise self.EntityDoesNotExistError(f'relationship_ilx: {relationship_ilx} does not exist')
-        entity2_data = self.get_entity(entity2_ilx)
+        entity2_data = self.get_entity_meta(entity2_ilx)
         if not entity2_data['id']:
             raise self.EntityDoesNotExistError(f'entity2_ilx: {entity2_data} does not exist')
         data = {
@@ -6,11 +6,24 @@ from typing import Callable, List, Tuple
 from pyontutils.utils import Async, deferred
 
 from ontquery import exceptions as exc
+from ontquery.utils import deadline_session, time_left, transport_error
 
 
 __maintainer_email__ = 'tsincomb@ucsd.edu'
 
 
+class _AsyncResponse:
+    """ Just enough of requests.Response for __check_response. """
+
+    def __init__(self, status_code: int, url: str, text: str):
+        self.status_code = status_code
+        self.url = url
+        self.text = self.txt = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
 class InterlexSession:
     """ Boiler plate for SciCrunch server responses. """
 
@@ -52,10 +65,11 @@ class InterlexSession:
             api = os.path.join(api, 'api/1')
 
         self.api = api
+        self._asessions = {}
 
         # Setup Retries #
         import requests
-        self.session = requests.Session()
+        self.session = deadline_session(requests.Session())
         self.session.auth = auth  # legacy; InterLex no longer needs this.
         self.session.headers.update({
             'Content-Type': 'application/json', # retained in the event that the server is dumb
@@ -136,6 +150,51 @@ class InterlexSession:
         self.__check_response(resp)
         return resp
 
+    def _asession(self):
+        """ One aiohttp session per event loop. """
+        import asyncio
+        import aiohttp
+        loop = asyncio.get_event_loop()
+        if loop not in self._asessions:
+            self._asessions[loop] = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(*self.session.auth) if any(self.session.auth) else None,
+                headers=dict(self.session.headers))
+
+        return self._asessions[loop]
+
+    async def _aget(self, endpoint: str, params: dict = None):
+        """ Async version of _get, requires aiohttp.
+
+        :param str endpoint: tail of endpoint (ie term/add).
+        :param dict params: params/data for API request.
+        :returns: response with status_code, url, text and json()
+        """
+        url = os.path.join(self.api, endpoint)
+        params = self.__prepare_data(params)  # adds api key to params here
+        import asyncio
+        import aiohttp
+        left = time_left()
+        timeout = None if left is None else aiohttp.ClientTimeout(total=left)
+        try:
+            async with self._asession().get(url, data=params, timeout=timeout) as aresp:
+                resp = _AsyncResponse(aresp.status, str(aresp.url), await aresp.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            transport_error(e)
+            raise
+
+        if resp.status_code >= 500:
+            transport_error(f'{resp.status_code} {resp.url}')
+
+        self.__check_response(resp)
+        return resp
+
+    async def aclose(self):
+        """ Close the aiohttp session for the running event loop. """
+        import asyncio
+        session = self._asessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session.close()
+
     def _post(self, endpoint: str, data: dict = None):
         """ Quick POST for InterLex.
 
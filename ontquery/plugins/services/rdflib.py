@@ -1,11 +1,13 @@
 import rdflib
 import ontquery as oq
 import ontquery.exceptions as exc
-from ontquery.utils import log, red
+from ontquery.utils import cullNone, log, red, QueryPlan
 from ontquery.services import OntService
 
 
 class rdflibLocal(OntService):  # reccomended for local default implementation
+    _accepts_plan = True
+    query_keywords = frozenset(('iri', 'curie', 'label', 'term'))  # no search= or abbrev=
     #graph = rdflib.Graph()  # TODO pull this out into ../plugins? package as ontquery-plugins?
     # if loading if the default set of ontologies is too slow, it is possible to
     # dump loaded graphs to a pickle gzip and distribute that with a release...
@@ -79,7 +81,8 @@ class rdflibLocal(OntService):  # reccomended for local default implementation
     def predicates(self):
         yield from sorted(set(self.graph.predicates()))
 
-    def by_ident(self, iri, curie, kwargs, predicates=tuple(), depth=1, _pseen=tuple()):
+    def by_ident(self, iri, curie, kwargs, predicates=tuple(), depth=1, _pseen=tuple(),
+                 identifier=None, uriref=None):
         def append_preds(out, c, o):
             if c not in out['predicates']:
                 out['predicates'][c] = o  # curie to be consistent with OntTerm behavior
@@ -115,8 +118,13 @@ class rdflibLocal(OntService):  # reccomended for local default implementation
                            if isinstance(p, self.OntId) else
                            p for p in predicates)
         out = {'predicates':{}}
-        identifier = self.OntId(curie=curie, iri=iri)
-        gen = self.graph.predicate_objects(rdflib.URIRef(identifier.iri))
+        if identifier is None:
+            identifier = self.OntId(curie=curie, iri=iri)
+
+        if uriref is None:
+            uriref = rdflib.URIRef(identifier.iri)
+
+        gen = self.graph.predicate_objects(uriref)
         out['curie'] = identifier.curie
         out['iri'] = identifier.iri
         o = None
@@ -214,7 +222,12 @@ class rdflibLocal(OntService):  # reccomended for local default implementation
 
     def query(self, iri=None, curie=None, label=None, term=None, predicates=tuple(),
               search=None, prefix=tuple(), exclude_prefix=tuple(), all_classes=False,
-              depth=1, **kwargs):
+              depth=1, _plan=None, **kwargs):
+        if _plan is None:
+            _plan = QueryPlan(cullNone(iri=iri, curie=curie, predicates=predicates,
+                                       prefix=prefix, exclude_prefix=exclude_prefix),
+                              self.OntId)
+
         _empty_tuple = tuple()  # FIXME name lookup cost vs empty tuple alloc cost
         if (prefix is not None and
             prefix is not _empty_tuple and
@@ -249,12 +262,14 @@ class rdflibLocal(OntService):  # reccomended for local default implementation
             for iri, type in self.graph[:rdflib.RDF.type:]:
                 if isinstance(iri, rdflib.URIRef):  # no BNodes
                     yield from self.by_ident(iri, None, kwargs,  # actually query is done here
-                                             predicates=predicates,
+                                             predicates=_plan.predicate_urirefs,
                                              depth=depth - 1)
         elif iri is not None or curie is not None:
             yield from self.by_ident(iri, curie, kwargs,
-                                     predicates=predicates,
-                                     depth=depth - 1)
+                                     predicates=_plan.predicate_urirefs,
+                                     depth=depth - 1,
+                                     identifier=_plan.identifier,
+                                     uriref=_plan.uriref)
         elif search is not None:  # prevent search + prefix from behaving like prefix alone
             return
         else:
@@ -269,12 +284,12 @@ class rdflibLocal(OntService):  # reccomended for local default implementation
                     for predicate in predicates:
                         gen = self.graph.subjects(predicate, rdflib.Literal(object))
                         for subject in gen:
-                            if prefix or exclude_prefix:
+                            if _plan.prefixes or _plan.exclude_prefixes:
                                 oid = self.OntId(subject)
-                                if prefix and oid.prefix not in prefix:
+                                if _plan.prefixes and oid.prefix not in _plan.prefixes:
                                     continue
 
-                                if exclude_prefix and oid.prefix in exclude_prefix:
+                                if oid.prefix in _plan.exclude_prefixes:
                                     continue
 
                             yield from self.query(iri=subject)
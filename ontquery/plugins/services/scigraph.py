@@ -1,5 +1,8 @@
+import asyncio
+from urllib.parse import quote
 import ontquery as oq
-from ontquery.utils import cullNone, one_or_many, log, bunch, red
+from ontquery.utils import cullNone, one_or_many, log, bunch, red, QueryPlan
+from ontquery.utils import deadline_session, time_left, transport_errors, transport_error
 from ontquery.services import OntService
 from . import deco, auth
 
@@ -8,9 +11,13 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
     cache = True
     verbose = False
     known_inverses = ('', ''),
+    _accepts_plan = True
+    hedgeable = True
+    _aiohttp = None
     def __init__(self, apiEndpoint=None, OntId=oq.OntId):  # apiEndpoint=None -> default from pyontutils.devconfig
         self.apiEndpoint = apiEndpoint
         self.OntId = OntId
+        self._asessions = {}
         super().__init__()
 
     @property
@@ -44,6 +51,11 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
             deco.scigraph_api_key(scigraph.restService)
 
         self.__class__._scigraph = scigraph
+        try:
+            import aiohttp
+            self.__class__._aiohttp = aiohttp
+        except ModuleNotFoundError:
+            pass  # aquery falls back to running query in a thread
 
     def setup(self, **kwargs):
         self._import_stuff()
@@ -55,6 +67,13 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
                                    basePath=self.apiEndpoint)
         self.sgd = self._scigraph.Dynamic(cache=self.cache, verbose=self.verbose,
                                     basePath=self.apiEndpoint)
+        for client in (self.sgv, self.sgg, self.sgc, self.sgd):
+            if hasattr(client, '_session'):
+                deadline_session(client._session)
+
+            if hasattr(client, '_cache'):
+                self._uncache_failures(client)
+
         self.curies = type('LocalCuries', (oq.OntCuries,), {})
         self._remote_curies = type('RemoteCuries', (oq.OntCuries.new(),), {})
         curies = self.sgc.getCuries()
@@ -62,6 +81,7 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
         self._remote_curies(curies)
         self.prefixes = sorted(self.curies)
         self.search_prefixes = [p for p in sorted(self._remote_curies) if p != 'SCR']
+        self._served_namespaces = tuple(self._remote_curies[p] for p in self._remote_curies)
         self.categories = self.sgv.getCategories()
         self._predicates = sorted(set(self.sgg.getRelationships()))
         #self._onts = sorted(o['n']['iri'] for o in self.sgc.execute('MATCH (n:Ontology) RETURN n', 1000, 'application/json'))  # only on newer versions, update when we switch production over
@@ -71,6 +91,17 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
                                              'text/plain'))
         super().setup(**kwargs)
 
+    @property
+    def served_prefixes(self):
+        if self.started:
+            # curies can be added after setup, _qualify checks them at call time too
+            return frozenset(self.curies)
+
+    @property
+    def served_namespaces(self):
+        if self.started:
+            return self._served_namespaces
+
     def _graphQuery(self, subject, predicate, depth=1, direction='OUTGOING',
                     entail=True, inverse=False, include_supers=False, done=None):
         # TODO need predicate mapping... also subClassOf inverse?? hasSubClass??
@@ -79,29 +110,9 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
             raise NotImplementedError('Currently cannot handle inverse and entail at the same time.')
 
         if include_supers:
-            if done is None:
-                done = set()
-
-            done.add(subject)
-            for _, sup in self._graphQuery(subject, 'subClassOf', depth=40):
-                if sup not in done:
-                    done.add(sup)
-                    for p, o in self._graphQuery(sup, predicate, depth=depth,
-                                                 direction=direction, entail=entail,
-                                                 inverse=inverse, done=done):
-                        if o not in done:
-                            done.add(o)
-                            yield p, o
-
-            for p, o in self._graphQuery(subject, predicate, depth=depth,
-                                         direction=direction, entail=entail,
-                                         inverse=inverse, done=done):
-                if o not in done:
-                    yield p, o
-                    done.add(o)
-                    yield from self._graphQuery(o, predicate, depth=depth,
-                                                direction=direction, entail=entail,
-                                                inverse=inverse, include_supers=include_supers, done=done)
+            yield from self._graphQuerySupers(subject, predicate, depth=depth,
+                                              direction=direction, entail=entail,
+                                              inverse=inverse, done=done)
             return
 
         d_nodes_edges = self.sgg.getNeighbors(subject, relationshipType=predicate,
@@ -123,22 +134,11 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
         if inverse:
             s, o = o, s
 
-        def properPredicate(e):
-            if ':' in e['pred']:
-                p = self.OntId(e['pred'])
-                if inverse:  # FIXME p == predicate ? no it is worse ...
-                    p = self.inverses[p]
-
-                p = p.curie
-            else:
-                p = e['pred']
-
-            return p
-
         if depth > 1:
             #subjects = set(subject.curie)
             seen = {((predicate.curie if isinstance(predicate, self.OntId) else predicate),
                      subject.curie)}
+            keep = []
             for i, e in enumerate(self.sgg.ordered(subject.curie, edges, inverse=inverse)):
                 if [v for k, v in e.items() if k != 'meta' and v.startswith('_:')]:
                     # FIXME warn on these ? bnode getting pulled in ...
@@ -155,50 +155,147 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
                     # and would have to fetch the object directly anyway since OntTerm requires
                     # direct atestation ... which suggests that we probably need/want a bulk constructor
                     seen.add((p, object))
-                    yield (properPredicate(e),
-                           self.OntId(object)) # FIXME TODO this is _very_ inefficient for multiple lookups...
+                    keep.append(e)
+
+            yield from self._decodeEdges(keep, o, inverse=inverse)
 
         else:
             _has_part_list = ['http://purl.obolibrary.org/obo/BFO_0000051']
             _disjoint_with_list = ['disjointWith']
             scurie = self._remote_curies.qname(subject)
-            pred_objects = ((properPredicate(e),
-                             self.OntId(e[o])) for e in edges if e[s] == scurie
-                            #and not print(predicate, scurie, e['pred'], e[o])
-                            and not [v for k, v in e.items()
-                                     if k != 'meta' and v.startswith('_:')]
-                            and ('owlType' not in e['meta'] or
-                                 (e['meta']['owlType'] != _has_part_list and
-                                  e['meta']['owlType'] != _disjoint_with_list)))
-            yield from pred_objects
+            keep = [e for e in edges if e[s] == scurie
+                    #and not print(predicate, scurie, e['pred'], e[o])
+                    and not [v for k, v in e.items()
+                             if k != 'meta' and v.startswith('_:')]
+                    and ('owlType' not in e['meta'] or
+                         (e['meta']['owlType'] != _has_part_list and
+                          e['meta']['owlType'] != _disjoint_with_list))]
+            yield from self._decodeEdges(keep, o, inverse=inverse)
+
+    def _decodeEdges(self, edges, o='obj', inverse=False):
+        """ decode a whole getNeighbors edge list at once, each distinct
+            pred string and each distinct curie is only converted once """
+        preds, ids = {}, {}
+
+        def properPredicate(pred):
+            if pred not in preds:
+                if ':' in pred:
+                    p = self.OntId(pred)
+                    if inverse:  # FIXME p == predicate ? no it is worse ...
+                        p = self.inverses[p]
+
+                    preds[pred] = p.curie
+                else:
+                    preds[pred] = pred
 
-    def query(self, iri=None, curie=None,
-              label=None, term=None, search=None, abbrev=None,  # FIXME abbrev -> any?
-              prefix=tuple(), category=tuple(), exclude_prefix=tuple(),
-              include_deprecated=False, include_supers=False,
-              predicates=tuple(), depth=1,
-              direction='OUTGOING', entail=True, limit=10):
-        # BEWARE THE MADNESS THAT LURKS WITHIN
-        def herp(p):
-            if hasattr(p, 'curie'):
-                return self.OntId(p)
-            elif ':' in p:
-                return self.OntId(p)
-            elif type(p) == str:
-                return p
-            else:
-                raise TypeError(f'wat {type(p)} {p}')
+            return preds[pred]
 
-        def derp(ps):
-            for p in ps:
-                if hasattr(p, 'curie'):
-                    if p.curie:
-                        yield p.curie
-                    else:
-                        yield str(p)
+        def ontid(curie):
+            if curie not in ids:
+                ids[curie] = self.OntId(curie)
+
+            return ids[curie]
+
+        return [(properPredicate(e['pred']), ontid(e[o])) for e in edges]
+
+    def _superClosure(self, subject, adjacency, closed):
+        """ fetch the subClassOf subgraph above subject in one call and
+            merge it into adjacency, every node reached has a complete
+            closure afterward so it goes in closed """
+        d_nodes_edges = self.sgg.getNeighbors(subject, relationshipType='subClassOf',
+                                              depth=40, direction='OUTGOING', entail=True)
+        scurie = self._remote_curies.qname(subject)
+        closed.add(scurie)
+        if not d_nodes_edges:
+            return scurie
+
+        for e in d_nodes_edges['edges']:
+            if e['sub'].startswith('_:') or e['obj'].startswith('_:'):
+                continue
+
+            closed.add(e['sub'])
+            closed.add(e['obj'])
+            objs = adjacency.setdefault(e['sub'], [])
+            if e['obj'] not in objs:
+                objs.append(e['obj'])
+
+        return scurie
+
+    def _graphQuerySupers(self, subject, predicate, depth=1, direction='OUTGOING',
+                          entail=True, inverse=False, done=None):
+        """ include_supers traversal, one closure fetch covers every node
+            in the subgraph it returns, the transitive combination is done
+            locally and neighborhoods are fetched at most once per node """
+        if done is None:
+            done = set()
+
+        adjacency, closed, supers, neighbors = {}, set(), {}, {}
+
+        def super_curies(curie):
+            # iterative so deep hierarchies don't hit the recursion limit
+            if curie not in supers:
+                out, stack = [], list(reversed(adjacency.get(curie, ())))
+                seen = {curie}
+                while stack:
+                    c = stack.pop()
+                    if c in seen:
+                        continue
+
+                    seen.add(c)
+                    out.append(c)
+                    stack.extend(reversed(adjacency.get(c, ())))
+
+                supers[curie] = out
+
+            return supers[curie]
+
+        def neighborhood(node):
+            if node not in neighbors:
+                neighbors[node] = list(self._graphQuery(node, predicate, depth=depth,
+                                                        direction=direction, entail=entail,
+                                                        inverse=inverse))
+            return neighbors[node]
+
+        stack = [subject]
+        while stack:
+            node = stack.pop()
+            done.add(node)
+            scurie = self._remote_curies.qname(node)
+            if scurie not in closed:
+                scurie = self._superClosure(node, adjacency, closed)
+
+            for sup in (self.OntId(c) for c in super_curies(scurie)):
+                if sup not in done:
+                    done.add(sup)
+                    for p, o in neighborhood(sup):
+                        if o not in done:
+                            done.add(o)
+                            yield p, o
+
+            new = []
+            for p, o in neighborhood(node):
+                if o not in done:
+                    done.add(o)
+                    yield p, o
+                    new.append(o)
+
+            stack.extend(reversed(new))
+
+    # BEWARE THE MADNESS THAT LURKS WITHIN
+    @staticmethod
+    def _derp(ps):
+        for p in ps:
+            if hasattr(p, 'curie'):
+                if p.curie:
+                    yield p.curie
                 else:
-                    yield p
+                    yield str(p)
+            else:
+                yield p
 
+    def _qualify(self, label, term, search, abbrev, prefix, category, exclude_prefix, limit):
+        """ check prefixes and categories against the remote and
+            return the search expressions and qualifiers for a query """
         # use explicit keyword arguments to dispatch on type
         prefix = one_or_many(prefix)
         category = one_or_many(category)
@@ -228,12 +325,74 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
         qualifiers = cullNone(prefix=prefix,
                               category=category,
                               limit=limit)
+        return search_expressions, qualifiers
+
+    def _set_types(self, result, node):
+        types = tuple()
+        if node is not None:
+            for _type in node['nodes'][0]['meta']['types']:
+                if _type not in result['categories']:
+                    types += self.OntId('owl:' + _type),
+
+        result['type'] = types[0] if types else None
+        result['types'] = types
+
+    def _query_results(self, results, query_args, identifiers,
+                       out_predicates, include_deprecated, limit):
+        # TODO deprecated handling
+
+        # TODO transform result to expected
+        count = 0
+        for result in results:
+            if not include_deprecated and result['deprecated'] and not identifiers:
+                continue
+            ni = lambda i: next(iter(sorted(i))) if i else None  # FIXME multiple labels issue
+            predicate_results = {predicate:result[predicate]  # FIXME hack
+                                 for predicate in self._derp(out_predicates)  # TODO depth=1 means go ahead and retrieve?
+                                 if predicate in result}  # FIXME hasheqv on OntId
+
+            #print(red.format('PR:'), pprint.pformat(predicate_results), pprint.pformat(result))
+            yield self.QueryResult(
+                query_args=query_args,
+                iri=result['iri'],
+                curie=result['curie'] if 'curie' in result else None,
+                label=ni(result['labels']),
+                labels=result['labels'],
+                definition=ni(result['definitions']),
+                synonyms=result['synonyms'],
+                deprecated=result['deprecated'],
+                acronym=result['acronyms'],
+                abbrev=result['abbreviations'],
+                prefix=result['curie'].split(':')[0] if 'curie' in result else None,
+                category=ni(result['categories']),
+                predicates=predicate_results,
+                type=result['type'] if 'type' in result else None,
+                types=result['types'] if 'types' in result else tuple(),
+                source=self)
+
+            if count >= limit:  # FIXME deprecated issue
+                break
+            else:
+                count += 1
+
+    def query(self, iri=None, curie=None,
+              label=None, term=None, search=None, abbrev=None,  # FIXME abbrev -> any?
+              prefix=tuple(), category=tuple(), exclude_prefix=tuple(),
+              include_deprecated=False, include_supers=False,
+              predicates=tuple(), depth=1,
+              direction='OUTGOING', entail=True, limit=10, _plan=None):
+        if _plan is None:
+            _plan = QueryPlan(cullNone(iri=iri, curie=curie, predicates=predicates), self.OntId)
+
+        search_expressions, qualifiers = self._qualify(label, term, search, abbrev,
+                                                       prefix, category, exclude_prefix, limit)
         identifiers = cullNone(iri=iri, curie=curie)
-        predicates = tuple(herp(p) for p in predicates)
+        predicates = _plan.predicates
 
         out_predicates = []
         if identifiers:
-            identifier = self.OntId(next(iter(identifiers.values())))  # WARNING: only takes the first if there is more than one...
+            # WARNING: only takes the first if there is more than one...
+            identifier = _plan.identifier or self.OntId(next(iter(identifiers.values())))
             result = self.sgv.findById(identifier)  # this does not accept qualifiers
             # WARNING
             # if results are cached then the mutation we do below
@@ -248,7 +407,7 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
                 for predicate in predicates:
                     if (hasattr(predicate, 'prefix') and
                         predicate.prefix in ('owl', 'rdfs')):
-                        unshorten = next(derp([predicate]))
+                        unshorten = next(self._derp([predicate]))
                         predicate = predicate.suffix
                     else:
                         unshorten = None
@@ -302,16 +461,7 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
                                     result[pred] = tuple(ipvalues)
                                     out_predicates.append(pred)
 
-            res = self.sgg.getNode(identifier)
-            types = tuple()
-            _type = None
-            for _type in res['nodes'][0]['meta']['types']:
-                if _type not in result['categories']:
-                    _type = self.OntId('owl:' + _type)
-                    types += _type,
-
-            result['type'] = types[0] if _type is not None else None
-            result['types'] = types
+            self._set_types(result, self.sgg.getNode(identifier))
 
             results = result,
         elif term:
@@ -329,44 +479,152 @@ class SciGraphRemote(OntService):  # incomplete and not configureable yet
         else:
             raise ValueError('No query prarmeters provided!')
 
-        # TODO deprecated handling
+        yield from self._query_results(results,
+                                       {**search_expressions,
+                                        **qualifiers,
+                                        **identifiers,
+                                        'predicates':predicates},
+                                       identifiers, out_predicates,
+                                       include_deprecated, limit)
+
+    class _Failed(Exception):
+        """ carries the result of a failed request past the client cache """
+
+    @classmethod
+    def _uncache_failures(cls, client):
+        """ the scigraph client caches the None it returns for a failed
+            request, which would keep a transient outage for the life of
+            the client, so failed requests skip the cache """
+        normal_get, get = client._normal_get, client._get
+        def _normal_get(*args, **kwargs):
+            errors = []
+            with transport_errors(errors):
+                out = normal_get(*args, **kwargs)
+
+            for error in errors:
+                transport_error(error)  # still tell the query
+
+            if errors:
+                raise cls._Failed(out)
+
+            return out
+
+        def _get(*args, **kwargs):
+            try:
+                return get(*args, **kwargs)
+            except cls._Failed as e:
+                return e.args[0]
+
+        client._normal_get, client._get = _normal_get, _get
+
+    async def _asession(self):
+        loop = asyncio.get_event_loop()
+        if loop not in self._asessions:
+            for old in [l for l in self._asessions if l.is_closed()]:
+                # nothing can close it now, but don't keep the loop alive
+                log.warning(f'{self} aiohttp session was not closed, use aclose')
+                self._asessions.pop(old)
+
+            self._asessions[loop] = self._aiohttp.ClientSession(
+                headers={'Accept': 'application/json'})
+
+        return self._asessions[loop]
+
+    async def aclose(self):
+        """ close the aiohttp session for the running event loop, sessions
+            are per loop so call this before the loop finishes, see
+            AsyncOntQuery.aclose """
+        session = self._asessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def _aget(self, path, **params):
+        """ GET from the SciGraph rest api, None if the request fails,
+            raises ConnectionError for a bad api key like the sync client """
+        session = await self._asession()
+        _params = []
+        for k, v in params.items():
+            for v in (v if isinstance(v, (list, tuple)) else (v,)):
+                if v is not None:
+                    _params.append((k, str(v).lower() if isinstance(v, bool) else str(v)))
+
+        if self.sgv.api_key is not None:
+            _params.append(('key', self.sgv.api_key))
+
+        left = time_left()
+        timeout = None if left is None else self._aiohttp.ClientTimeout(total=left)
+        async with session.get(self.sgv._basePath + path, params=_params,
+                               timeout=timeout) as resp:
+            if resp.status in (401, 403):
+                raise ConnectionError(f'{resp.reason}. '
+                                      f'Did you set {self.sgv.__class__.__name__}.api_key'
+                                      ' = my_api_key?')
+            elif resp.status >= 500:
+                transport_error(f'{resp.status} {resp.reason} {resp.url}')
+
+            if not resp.ok:
+                return None
+
+            return await resp.json()
+
+    async def aquery(self, iri=None, curie=None,
+                     label=None, term=None, search=None, abbrev=None,
+                     prefix=tuple(), category=tuple(), exclude_prefix=tuple(),
+                     include_deprecated=False, include_supers=False,
+                     predicates=tuple(), depth=1,
+                     direction='OUTGOING', entail=True, limit=10, _plan=None):
+        if predicates or self._aiohttp is None:
+            # graph traversal is only implemented by the synchronous client
+            async for result in super().aquery(
+                    iri=iri, curie=curie, label=label, term=term, search=search,
+                    abbrev=abbrev, prefix=prefix, category=category,
+                    exclude_prefix=exclude_prefix, include_deprecated=include_deprecated,
+                    include_supers=include_supers, predicates=predicates, depth=depth,
+                    direction=direction, entail=entail, limit=limit, _plan=_plan):
+                yield result
 
-        # TODO transform result to expected
-        count = 0
-        for result in results:
-            if not include_deprecated and result['deprecated'] and not identifiers:
-                continue
-            ni = lambda i: next(iter(sorted(i))) if i else None  # FIXME multiple labels issue
-            predicate_results = {predicate:result[predicate]  # FIXME hack
-                                 for predicate in derp(out_predicates)  # TODO depth=1 means go ahead and retrieve?
-                                 if predicate in result}  # FIXME hasheqv on OntId
+            return
 
-            #print(red.format('PR:'), pprint.pformat(predicate_results), pprint.pformat(result))
-            yield self.QueryResult(
-                query_args={**search_expressions,
-                            **qualifiers,
-                            **identifiers,
-                            'predicates':predicates},
-                iri=result['iri'],
-                curie=result['curie'] if 'curie' in result else None,
-                label=ni(result['labels']),
-                labels=result['labels'],
-                definition=ni(result['definitions']),
-                synonyms=result['synonyms'],
-                deprecated=result['deprecated'],
-                acronym=result['acronyms'],
-                abbrev=result['abbreviations'],
-                prefix=result['curie'].split(':')[0] if 'curie' in result else None,
-                category=ni(result['categories']),
-                predicates=predicate_results,
-                type=result['type'] if 'type' in result else None,
-                types=result['types'] if 'types' in result else tuple(),
-                source=self)
+        search_expressions, qualifiers = self._qualify(label, term, search, abbrev,
+                                                       prefix, category, exclude_prefix, limit)
+        identifiers = cullNone(iri=iri, curie=curie)
+        if identifiers:
+            identifier = _plan.identifier if _plan is not None else None
+            identifier = quote(identifier or self.OntId(next(iter(identifiers.values()))), safe='')
+            result, node = await asyncio.gather(self._aget(f'/vocabulary/id/{identifier}'),
+                                                self._aget(f'/graph/{identifier}'))
+            if result is None:
+                return
 
-            if count >= limit:  # FIXME deprecated issue
-                break
-            else:
-                count += 1
+            self._set_types(result, node)
+            results = result,
+        elif term:
+            results = await self._aget(f'/vocabulary/term/{quote(term, safe="")}',
+                                       searchSynonyms=True, **qualifiers)
+        elif label:
+            results = await self._aget(f'/vocabulary/term/{quote(label, safe="")}',
+                                       searchSynonyms=False, **qualifiers)
+        elif search:
+            qualifiers['limit'] = 100  # FIXME deprecated issue
+            results = await self._aget(f'/vocabulary/search/{quote(search, safe="")}',
+                                       **qualifiers)
+        elif abbrev:
+            results = await self._aget(f'/vocabulary/term/{quote(abbrev, safe="")}',
+                                       searchSynonyms=True,
+                                       searchAbbreviations=True,
+                                       searchAcronyms=True,
+                                       **qualifiers)
+        else:
+            raise ValueError('No query prarmeters provided!')
+
+        for result in self._query_results(results or [],
+                                          {**search_expressions,
+                                           **qualifiers,
+                                           **identifiers,
+                                           'predicates':tuple()},
+                                          identifiers, [],
+                                          include_deprecated, limit):
+            yield result
 
 
 class SciCrunchRemote(SciGraphRemote):
@@ -3,18 +3,543 @@ Implementation of the query interface that provides a layer of separation betwee
 identifiers and lookup services for finding and validating them.
 """
 
+import os
+import time
+import queue
+import asyncio
+import multiprocessing
+import threading
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from ontquery import plugin, exceptions as exc
-from ontquery.utils import mimicArgs, cullNone, one_or_many, log
+from ontquery.utils import mimicArgs, cullNone, one_or_many, log, QueryPlan
+from ontquery.utils import deadline, deadline_iter, transport_errors, Hooks
+from ontquery.utils import QueryResult as _QueryResult
 
 
-class OntQuery:
-    def __init__(self, *services, prefix=tuple(), category=tuple(), instrumented=None):
+class NegativeCache:
+    """ Remember queries that no service could answer so that they are not
+        sent to every service again. ttl is in seconds, None never expires,
+        0 disables the cache. Off by default since nothing purges it when a
+        graph or a remote is written to behind its back. """
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, stamp, now):
+        return self.ttl is not None and now - stamp >= self.ttl
+
+    def __contains__(self, key):
+        if not self.ttl and self.ttl is not None:
+            return False
+
+        with self._lock:
+            if key not in self._cache:
+                return False
+
+            if self._expired(self._cache[key], time.monotonic()):
+                self._cache.pop(key)
+                return False
+
+            return True
+
+    def __len__(self):
+        return len(self.items())
+
+    def add(self, key):
+        if not self.ttl and self.ttl is not None:
+            return
+
+        with self._lock:
+            self._cache[key] = time.monotonic()
+
+    def items(self):
+        """ list of (query kwargs, seconds until expiry) for live entries """
+        now = time.monotonic()
+        with self._lock:
+            for key, stamp in list(self._cache.items()):
+                if self._expired(stamp, now):
+                    self._cache.pop(key)
+
+            return [(dict(key), None if self.ttl is None else self.ttl - (now - stamp))
+                    for key, stamp in self._cache.items()]
+
+    def purge(self, **kwargs):
+        """ drop all entries, or only those whose query kwargs match kwargs """
+        match = OntQuery._query_key(kwargs)
+        with self._lock:
+            if not match:
+                n = len(self._cache)
+                self._cache.clear()
+                return n
+
+            keys = [key for key in self._cache if set(match) <= set(key)]
+            for key in keys:
+                self._cache.pop(key)
+
+            return len(keys)
+
+
+class _Flight:
+    """ A query that is currently running against the services. Identical
+        queries that arrive while it is running follow it and receive the
+        same QueryResults instead of making their own service calls. """
+
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.followers = 0
+        self.results = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def publish(self, result):
+        with self.condition:
+            self.results.append(result)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def follow(self):
+        i = 0
+        while True:
+            with self.condition:
+                while i >= len(self.results) and not self.done:
+                    self.condition.wait()
+
+                if i < len(self.results):
+                    result = self.results[i]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+
+            i += 1
+            yield result
+
+
+class ServiceStats:
+    """ Hit rate and latency of each service per prefix and query type.
+        OntQuery(adaptive=True) uses these to try the services that are
+        likely to answer quickly first. A service that sorts last may
+        never be asked again, so stats not updated for stale seconds are
+        forgotten and the service gets tried as if it were new. """
+
+    alpha = 0.2  # weight of the newest latency in the moving average
+    stale = 300  # seconds, None keeps stats forever
+    samples = 200  # latencies kept per service for percentile
+    min_samples = 20  # percentile is None until there are this many
+    _keywords = 'term', 'label', 'search', 'abbrev'
+
+    def __init__(self):
+        self._stats = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def key(cls, plan):
+        """ (prefix, query type) for a QueryPlan """
+        if plan.identifier is not None:
+            return plan.identifier.prefix, 'iri'
+
+        prefix = ','.join(sorted(plan.prefixes)) or None
+        for keyword in cls._keywords:
+            if keyword in plan:
+                return prefix, keyword
+
+        return prefix, None
+
+    def record(self, service, key, hit, latency):
+        with self._lock:
+            stats = self._stats.setdefault(service, {})
+            now = time.monotonic()
+            if key not in stats or self._stale(stats[key], now):
+                stats[key] = [0, 0, latency, now]
+
+            stat = stats[key]
+            stat[0] += 1
+            stat[1] += bool(hit)
+            stat[2] += self.alpha * (latency - stat[2])
+            stat[3] = now
+            if service not in self._latencies:
+                self._latencies[service] = deque(maxlen=self.samples)
+
+            self._latencies[service].append(latency)
+
+    def percentile(self, service, q):
+        """ latency below which fraction q of recent calls to service finished """
+        with self._lock:
+            latencies = sorted(self._latencies.get(service, ()))
+
+        if len(latencies) < self.min_samples:
+            return None
+
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def _stale(self, stat, now):
+        return self.stale is not None and now - stat[3] >= self.stale
+
+    def cost(self, service, key):
+        """ expected seconds spent per hit, 0 for services not yet seen
+            or not seen in a while so that they get tried """
+        try:
+            stat = self._stats[service][key]
+        except KeyError:
+            return 0
+
+        calls, hits, latency, _ = stat
+        if self._stale(stat, time.monotonic()):
+            return 0
+
+        return latency * (calls + 2) / (hits + 1)
+
+    def order(self, services, key):
+        """ sort by explicit priority first, then by expected cost,
+            and finally by the original order """
+        return [service for i, service in sorted(
+            enumerate(services),
+            key=lambda i_s: (-i_s[1].priority, self.cost(i_s[1], key), i_s[0]))]
+
+    def as_dict(self):
+        """ {service: {(prefix, query type): {calls, hits, hit_rate, latency}}} """
+        with self._lock:
+            return {service: {key: dict(calls=calls,
+                                        hits=hits,
+                                        hit_rate=hits / calls,
+                                        latency=latency)
+                              for key, (calls, hits, latency, _) in stats.items()}
+                    for service, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._latencies.clear()
+
+
+class CircuitBreaker:
+    """ Consecutive failures of each service. With a threshold set a
+        service that fails that many times in a row is open and gets
+        skipped for cooldown seconds, after that a single query is let
+        through as a probe (half open), success closes the circuit and
+        failure opens it again. With threshold None nothing is skipped
+        but failures are still counted. """
+
+    closed, open, half_open = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold=None, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._health = {}  # service -> [consecutive failures, opened at, probing, last error]
+        self._lock = threading.Lock()
+
+    def _state(self, health, now):
+        failures, opened, probing, _ = health
+        if self.threshold is None or failures < self.threshold:
+            return self.closed
+        elif probing or now - opened >= self.cooldown:
+            return self.half_open
+        else:
+            return self.open
+
+    def state(self, service):
+        with self._lock:
+            if service not in self._health:
+                return self.closed
+
+            return self._state(self._health[service], time.monotonic())
+
+    def allow(self, service):
+        """ whether to query service now, claims the probe when half open """
+        with self._lock:
+            health = self._health.get(service)
+            if health is None:
+                return True
+
+            state = self._state(health, time.monotonic())
+            if state == self.closed:
+                return True
+            elif state == self.half_open and not health[2]:
+                health[2] = True
+                return True
+            else:
+                return False
+
+    def success(self, service):
+        with self._lock:
+            self._health.pop(service, None)
+
+    def failure(self, service, error=None):
+        with self._lock:
+            health = self._health.setdefault(service, [0, None, False, None])
+            health[0] += 1
+            health[1] = time.monotonic()
+            health[2] = False
+            health[3] = error
+
+    def as_dict(self):
+        """ {service: {state, failures, retry_in, error}} for services that have failed """
+        with self._lock:
+            now = time.monotonic()
+            out = {}
+            for service, health in self._health.items():
+                state = self._state(health, now)
+                out[service] = dict(state=state,
+                                    failures=health[0],
+                                    retry_in=(max(0, self.cooldown - (now - health[1]))
+                                              if state == self.open else 0),
+                                    error=health[3])
+
+            return out
+
+    def reset(self):
+        with self._lock:
+            self._health.clear()
+
+
+class _Histogram:
+    """ cumulative buckets the way prometheus wants them """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def as_dict(self):
+        cumulative, total = {}, 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative[le] = total
+
+        return dict(count=total, sum=self.sum, buckets=cumulative)
+
+
+class QueryMetrics:
+    """ Counters and latency histograms per query kind and per service
+        and query kind, the kind is iri, term, label, search, abbrev or
+        other. Built from OntQuery hooks, see OntQuery(metrics=True). """
+
+    buckets = .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10  # seconds
+    hook_names = 'on_service_result', 'on_service_error', 'on_query_end'
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+
+        self._queries = {}  # kind -> [queries, results, negative cache hits, histogram]
+        self._services = {}  # (service name, kind) -> [calls, results, errors, histogram]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def kind(plan):
+        return ServiceStats.key(plan)[1] or 'other'
+
+    @staticmethod
+    def service_name(service):
+        return service.__class__.__name__
+
+    def _service(self, service, plan):
+        key = self.service_name(service), self.kind(plan)
+        if key not in self._services:
+            self._services[key] = [0, 0, 0, _Histogram(self.buckets)]
+
+        return self._services[key]
+
+    def on_service_result(self, query, plan, service, count, latency):
+        with self._lock:
+            stat = self._service(service, plan)
+            stat[0] += 1
+            stat[1] += count
+            stat[3].observe(latency)
+
+    def on_service_error(self, query, plan, service, error, latency):
+        with self._lock:
+            stat = self._service(service, plan)
+            stat[0] += 1
+            stat[2] += 1
+            stat[3].observe(latency)
+
+    def on_query_end(self, query, plan, count, latency, cached):
+        with self._lock:
+            kind = self.kind(plan)
+            if kind not in self._queries:
+                self._queries[kind] = [0, 0, 0, _Histogram(self.buckets)]
+
+            stat = self._queries[kind]
+            stat[0] += 1
+            stat[1] += count
+            stat[2] += cached
+            stat[3].observe(latency)
+
+    def as_dict(self):
+        """ {'queries': {kind: {...}}, 'services': {service: {kind: {...}}}}
+            latency histograms have count, sum and cumulative buckets by upper bound """
+        with self._lock:
+            queries = {kind: dict(queries=n, results=results, negative_cache_hits=cached,
+                                  latency=hist.as_dict())
+                       for kind, (n, results, cached, hist) in self._queries.items()}
+            services = {}
+            for (name, kind), (calls, results, errors, hist) in self._services.items():
+                services.setdefault(name, {})[kind] = dict(calls=calls, results=results,
+                                                           errors=errors,
+                                                           latency=hist.as_dict())
+
+        return {'queries': queries, 'services': services}
+
+    def prometheus(self, namespace='ontquery'):
+        """ the metrics in the prometheus text exposition format """
+        def labels(**kwargs):
+            escape = lambda v: str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+            return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in kwargs.items()) + '}'
+
+        def le(bound):
+            return '+Inf' if bound == float('inf') else f'{bound:g}'
+
+        lines = []
+        def family(name, type, help, samples):
+            lines.append(f'# HELP {namespace}_{name} {help}')
+            lines.append(f'# TYPE {namespace}_{name} {type}')
+            for suffix, label, value in samples:
+                lines.append(f'{namespace}_{name}{suffix}{label} {value:g}')
+
+        def histogram(rows):
+            for label, hist in rows:
+                for bound, count in hist['buckets'].items():
+                    yield '_bucket', labels(**label, le=le(bound)), count
+
+                yield '_sum', labels(**label), hist['sum']
+                yield '_count', labels(**label), hist['count']
+
+        metrics = self.as_dict()
+        queries = sorted(metrics['queries'].items())
+        services = sorted((name, kind, stat) for name, kinds in metrics['services'].items()
+                          for kind, stat in kinds.items())
+        for key, name, help in (('queries', 'queries_total', 'Queries run.'),
+                                ('results', 'query_results_total', 'Results returned by queries.'),
+                                ('negative_cache_hits', 'negative_cache_hits_total',
+                                 'Queries answered by the negative cache.')):
+            family(name, 'counter', help,
+                   [('', labels(kind=kind), stat[key]) for kind, stat in queries])
+
+        family('query_duration_seconds', 'histogram', 'Time spent per query.',
+               histogram((dict(kind=kind), stat['latency']) for kind, stat in queries))
+        for key, name, help in (('calls', 'service_calls_total', 'Calls to each service.'),
+                                ('results', 'service_results_total', 'Results from each service.'),
+                                ('errors', 'service_errors_total', 'Calls that raised.')):
+            family(name, 'counter', help,
+                   [('', labels(service=service, kind=kind), stat[key])
+                    for service, kind, stat in services])
+
+        family('service_duration_seconds', 'histogram', 'Time spent per service call.',
+               histogram((dict(service=service, kind=kind), stat['latency'])
+                         for service, kind, stat in services))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self._services.clear()
+
+
+_worker = threading.local()  # marks the threads of OntQuery._executor
+
+
+def _mark_worker():
+    _worker.active = True
+
+
+class _InlineExecutor:
+    """ Runs work in the calling thread. OntQuery._get_executor hands this
+        out to code already running on one of the executor's workers since
+        a worker that waits on work queued behind itself deadlocks once
+        every worker is waiting. """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+    def map(self, fn, *iterables):
+        return iter([fn(*args) for args in zip(*iterables)])
+
+
+_inline_executor = _InlineExecutor()
+_map_query = None  # set in the parent right before forking, see OntQuery.map
+
+
+def _map_init():
+    """ run once in each forked worker before any chunk """
+    _map_query._after_fork()
+
+
+def _map_chunk(chunk):
+    """ run in a forked worker, the query and its graphs were inherited """
+    query, out = _map_query, []
+    sources = query.services
+    for i, kwargs in chunk:
+        results = query._rcall__(raw=True, **kwargs)
+        out.append((i, tuple(result.to_wire(sources) for result in results)))
+
+    return out
+
+
+class OntQuery(Hooks):
+    # state that is shared when one query is constructed from another
+    _shared_attrs = ('_negative_cache', '_in_flight', '_in_flight_lock', '_stats', '_breaker',
+                     '_setup_lock', '_hooks', '_metrics')
+    _executor = None  # shared by all queries for include_all_services
+    _executor_lock = threading.Lock()
+    _max_workers = 8
+    _hedge_executor = None  # separate so hedging never waits on a busy _executor
+
+    # per query settings, set through _configure so that OntQueryCli(query=q) gets them all
+    _config_attrs = 'coalesce', 'adaptive', 'hedge', 'timeout'
+    coalesce = True
+    adaptive = False
+    hedge = None  # latency percentile after which to send a duplicate request
+    timeout = None  # default seconds per call when the call does not pass timeout=
+
+    def __init__(self, *services, prefix=tuple(), category=tuple(), instrumented=None,
+                 negative_cache_ttl=0, coalesce=True, adaptive=False,
+                 breaker_threshold=None, breaker_cooldown=30, hedge=None, timeout=None,
+                 metrics=False):
         # services from OntServices
         # check to make sure that prefix valid for ontologies
         # more config
 
         self._prefix = one_or_many(prefix)
         self._category = one_or_many(category)
+        self._negative_cache = NegativeCache(ttl=negative_cache_ttl)
+        self._configure(coalesce=coalesce, adaptive=adaptive, hedge=hedge, timeout=timeout)
+        self._stats = ServiceStats()
+        self._breaker = CircuitBreaker(threshold=breaker_threshold, cooldown=breaker_cooldown)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._setup_lock = threading.RLock()  # services may query during their setup
+        self._hooks = {}  # see Hooks, empty means nothing is timed or counted
+        self._metrics = None
+        if metrics:
+            self._metrics = QueryMetrics() if metrics is True else metrics
+            for name in self._metrics.hook_names:
+                self.add_hook(name, getattr(self._metrics, name))
 
         _services = [] 
         for maybe_service in services:
@@ -25,7 +550,7 @@ class OntQuery:
 
             _services.append(service)
 
-        self._services = tuple(_services)
+        self._services = self._dedupe(_services)
         if instrumented:
             self._instrumented = instrumented
             self._OntId = self._instrumented._uninstrumented_class()
@@ -33,25 +558,46 @@ class OntQuery:
         else:
             raise TypeError('instrumented is a required keyword argument')
 
+    def _configure(self, **config):
+        for attr, value in config.items():
+            if attr not in self._config_attrs:
+                raise TypeError(f'unknown setting {attr}')
+
+            setattr(self, attr, value)
+
+    @property
+    def _config(self):
+        return {attr:getattr(self, attr) for attr in self._config_attrs}
+
+    @staticmethod
+    def _dedupe(services):
+        """ keep the first occurrence of each service """
+        out = []
+        for service in services:
+            if not any(service is s for s in out):
+                out.append(service)
+
+        return tuple(out)
+
     def add(self, *services):
         """ add low priority services """
-        # FIXME dupes
-        self._services += services
+        self.radd(*services)
 
     def ladd(self, *services):
-        """ add high priority services """
-        # FIXME dupes
-        self._services = services + self._services
+        """ add high priority services, moving them up if already present """
+        self._services = self._dedupe(services + self._services)
+        self._negative_cache.purge()
 
     def radd(self, *services):
-        """ add low priority services """
-        # FIXME dupes
-        self._services = self._services + services
+        """ add low priority services, existing services keep their place """
+        self._services = self._dedupe(self._services + services)
+        self._negative_cache.purge()
 
     def setup(self):
-        for service in self.services:
-            if not service.started:
-                service.setup(instrumented=self._instrumented)
+        with self._setup_lock:  # two threads on first use would set up services twice
+            for service in self.services:
+                if not service.started:
+                    service.setup(instrumented=self._instrumented)
 
         # NOTE if you add a service after the first use of a query
         # you will have to call setup manually, which is reaonsable
@@ -80,6 +626,49 @@ class OntQuery:
     def services(self):
         return self._services
 
+    @property
+    def stats(self):
+        """ per service hit rates and latencies, see ServiceStats.as_dict """
+        return self._stats
+
+    @property
+    def breaker(self):
+        """ per service health, see CircuitBreaker.state and .as_dict """
+        return self._breaker
+
+    @property
+    def negative_cache(self):
+        """ queries that returned nothing, see NegativeCache.items and .purge """
+        return self._negative_cache
+
+    @property
+    def metrics(self):
+        """ None unless OntQuery(metrics=True), see QueryMetrics.as_dict and .prometheus """
+        return self._metrics
+
+    _unordered_keys = 'prefix', 'exclude_prefix', 'category', 'predicates'
+
+    @classmethod
+    def _query_key(cls, kwargs):
+        """ normalize query kwargs into something hashable, identifiers
+            of all types become plain strings so that OntId, OntTerm and
+            rdflib.URIRef versions of the same query share a key """
+        def freeze(value):
+            if isinstance(value, str):
+                return str(value)
+            elif isinstance(value, (tuple, list, set)):
+                return tuple(freeze(v) for v in value)
+            else:
+                return value
+
+        def normalize(k, v):
+            if k in cls._unordered_keys:
+                return tuple(sorted(freeze(one_or_many(v))))
+            else:
+                return freeze(v)
+
+        return tuple(sorted((k, normalize(k, v)) for k, v in kwargs.items()))
+
     # see if we can get away with using ladd
     #@services.setter
     #def services(self, value):
@@ -94,6 +683,123 @@ class OntQuery:
         self.setup()
         return self.__call__(*args, **kwargs)
 
+    _stream_done = object()
+
+    def stream(self, *args, buffer=16, raw=False, **kwargs):
+        """ Iterate over the results of a query as they arrive, one per iri.
+            The services are queried in a background thread that runs at
+            most buffer results ahead of the consumer, so stopping early
+            also stops the query. With hedge set, services that are
+            hedgeable deliver their results all at once. """
+        results = queue.Queue(maxsize=buffer)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def produce():
+            seen = set()
+            gen = OntQuery.__call__(self, *args, raw=True, **kwargs)  # OntQueryCli returns lists
+            try:
+                for result in gen:
+                    iri = str(result.iri)  # rdflib.URIRef != str
+                    if iri in seen:
+                        continue
+
+                    seen.add(iri)
+                    if not put(result):
+                        return
+
+                put(self._stream_done)
+            except BaseException as e:
+                put(e)
+            finally:
+                gen.close()
+
+        thread = threading.Thread(target=produce, daemon=True,
+                                  name=f'{self.__class__.__name__}.stream')
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is self._stream_done:
+                    return
+                elif isinstance(result, BaseException):
+                    raise result
+
+                yield result if raw else result.asTerm()
+        finally:
+            stop.set()
+
+    @staticmethod
+    def _map_kwargs(query):
+        if isinstance(query, dict):
+            return query
+        elif hasattr(query, 'iri') or query.startswith('http'):
+            return {'iri': str(getattr(query, 'iri', query))}
+        else:
+            return {'curie': query}
+
+    def map(self, queries, processes=None, chunksize=256, raw=False):
+        """ Resolve many queries on a pool of forked processes. Each query is
+            an iri, a curie or a dict of keyword arguments. Returns a list
+            with a tuple of results for each query in the same order.
+
+            Meant for local services, the workers are forked after setup so
+            they share the loaded graphs copy on write instead of each one
+            loading or unpickling them. Results come back via
+            QueryResult.to_wire so graphs and services are never pickled.
+            Thread pools and locks are recreated in the workers since the
+            threads behind them do not survive the fork, see _after_fork.
+            Falls back to running in this process when fork is not
+            available or processes=0. """
+        global _map_query
+        self.setup()
+        chunk, chunks = [], []
+        for i, query in enumerate(queries):
+            chunk.append((i, self._map_kwargs(query)))
+            if len(chunk) >= chunksize:
+                chunks.append(chunk)
+                chunk = []
+
+        if chunk:
+            chunks.append(chunk)
+
+        if processes is None:
+            processes = min(os.cpu_count() or 1, len(chunks))
+
+        if processes and 'fork' in multiprocessing.get_all_start_methods():
+            _map_query = self
+            try:
+                with multiprocessing.get_context('fork').Pool(processes, _map_init) as pool:
+                    done = [pair for part in pool.imap(_map_chunk, chunks) for pair in part]
+            finally:
+                _map_query = None
+
+            sources = self.services
+            QueryResult = _QueryResult.new_from_instrumented(self._instrumented)
+            out = [None] * len(done)
+            for i, wires in done:
+                results = tuple(QueryResult.from_wire(wire, self._OntId, sources=sources)
+                                for wire in wires)
+                out[i] = results if raw else tuple(r.asTerm() for r in results)
+
+            return out
+
+        else:
+            if processes:
+                log.warning('fork is not available, OntQuery.map running in process')
+
+            return [tuple(self._rcall__(raw=raw, **kwargs))
+                    for chunk in chunks for i, kwargs in chunk]
+
     def _rcall__(self,
                  term=None,           # put this first so that the happy path query('brain') can be used, matches synonyms
                  prefix=tuple(),      # limit search within these prefixes
@@ -111,9 +817,63 @@ class OntQuery:
                  limit=10,
                  include_deprecated=False,
                  include_supers=False,
-                 include_all_services=False,
+                 include_all_services=False,  # ask every service at once and merge results per iri
+                 timeout=None,        # seconds the whole query may take, passed on to http calls
                  raw=False,
     ):
+        key, plan, stop_on_label = self._prepare(
+            **{k:v for k, v in locals().items() if k not in ('self', 'raw')})
+        if self._hooks:
+            yield from self._watched_call(key, plan, stop_on_label, raw)
+            return
+
+        if key in self._negative_cache:
+            log.debug(f'negative cache hit for {plan}')
+            return
+
+        for result in self._single_flight(key, plan, stop_on_label):
+            yield result if raw else result.asTerm()
+
+    def _watched_call(self, key, plan, stop_on_label, raw):
+        """ _rcall__ with on_query_start and on_query_end, count is the
+            number of results the caller actually took """
+        self._fire('on_query_start', query=self, plan=plan)
+        start, count, cached = time.monotonic(), 0, False
+        try:
+            if key in self._negative_cache:
+                log.debug(f'negative cache hit for {plan}')
+                cached = True
+                return
+
+            for result in self._single_flight(key, plan, stop_on_label):
+                count += 1
+                yield result if raw else result.asTerm()
+        finally:
+            self._fire('on_query_end', query=self, plan=plan, count=count,
+                       latency=time.monotonic() - start, cached=cached)
+
+    def _prepare(self,
+                 term=None,
+                 prefix=tuple(),
+                 category=None,
+                 label=None,
+                 abbrev=None,
+                 search=None,
+                 suffix=None,
+                 curie=None,
+                 iri=None,
+                 predicates=tuple(),
+                 exclude_prefix=tuple(),
+                 depth=1,
+                 direction='OUTGOING',
+                 limit=10,
+                 include_deprecated=False,
+                 include_supers=False,
+                 include_all_services=False,
+                 timeout=None,
+    ):
+        """ validate and normalize the arguments to a query
+            returns the cache key, the QueryPlan, and whether to stop on the first label """
         prefix = one_or_many(prefix) + self._prefix
         category = one_or_many(category) + self._category
         qualifiers = cullNone(prefix=prefix if prefix else None,
@@ -143,19 +903,502 @@ class OntQuery:
                              'Qualifiers are prefix=, category=.')
         # TODO more conditions here...
 
-        # TODO? this is one place we could normalize queries as well instead of having
-        # to do it for every single OntService
         kwargs = {**qualifiers, **queries, **graph_queries, **identifiers, **control}
-        for j, service in enumerate(self.services):
+        key = self._query_key({**kwargs, 'include_all_services': include_all_services})
+        stop_on_label = search is None and term is None and not include_all_services
+        # normalize once here instead of in every single OntService
+        if timeout is None:
+            timeout = self.timeout
+
+        plan = QueryPlan(kwargs, self._OntId, merge=include_all_services,
+                         deadline=None if timeout is None else time.monotonic() + timeout)
+        return key, plan, stop_on_label
+
+    def _single_flight(self, key, plan, stop_on_label):
+        """ run the query, or follow an identical query that is already running """
+        if not self.coalesce or plan.deadline is not None:
+            # followers can't hold the leader to their own deadline
+            yield from self._run(key, plan, stop_on_label)
+            return
+
+        with self._in_flight_lock:
+            flight = self._in_flight.get(key, None)
+            if flight is None:
+                flight = self._in_flight[key] = _Flight()
+                leader = True
+            elif flight.owner == threading.get_ident():
+                leader = None  # reentrant identical query, following would deadlock
+            else:
+                flight.followers += 1
+                leader = False
+
+        if leader is None:
+            yield from self._run(key, plan, stop_on_label)
+            return
+        elif not leader:
+            yield from flight.follow()
+            return
+
+        gen = self._run(key, plan, stop_on_label)
+        completed, error = False, None
+        try:
+            for result in gen:
+                flight.publish(result)
+                yield result
+
+            completed = True
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.pop(key)  # nothing else can join after this
+                followers = flight.followers
+
+            if not completed and error is None and followers:
+                # our consumer stopped early, finish the flight for the others
+                try:
+                    for result in gen:
+                        flight.publish(result)
+                except Exception as e:
+                    error = e
+
+            flight.finish(error)
+
+    def _route(self, plan):
+        """ the services that could answer plan, in priority order """
+        if (plan.prefixes and self.services and
+            all(service.served_prefixes is not None and
+                not any(p in service.served_prefixes for p in plan.prefixes)
+                for service in self.services)):
+            raise ValueError(f'None of {sorted(plan.prefixes)} are known to any service')
+
+        services = []
+        for service in self.services:
+            if service.serves(plan):
+                services.append(service)
+            else:
+                log.debug(f'{service} cannot answer {plan}, skipping')
+
+        return services
+
+    def _ordered(self, plan, stop_on_label):
+        """ the services to try for plan and the key to record their stats under """
+        services = self._route(plan)
+        skey = self._stats.key(plan)
+        if self.adaptive and stop_on_label and len(services) > 1:
+            # only the first answer is kept so try the likely fast hits first
+            services = self._stats.order(services, skey)
+
+        return services, skey
+
+    def _after_fork(self):
+        """ only the forking thread survives a fork, a lock that another
+            thread held at that moment would never be released and its
+            in flight queries would never finish, so start fresh """
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._setup_lock = threading.RLock()
+        for shared in (self._negative_cache, self._stats, self._breaker, self._metrics):
+            if shared is not None:
+                shared._lock = threading.Lock()
+
+    @staticmethod
+    def _reset_executors():
+        """ the worker threads of the executors do not survive a fork, without
+            this work submitted in the child would wait on them forever """
+        OntQuery._executor = OntQuery._hedge_executor = None
+        OntQuery._executor_lock = threading.Lock()
+
+    @classmethod
+    def _get_executor(cls):
+        """ the executor shared by all fan outs, or an inline one when
+            called from inside it so that nested fan outs can't deadlock """
+        if getattr(_worker, 'active', False):
+            return _inline_executor
+
+        with OntQuery._executor_lock:
+            if OntQuery._executor is None:
+                OntQuery._executor = ThreadPoolExecutor(
+                    max_workers=cls._max_workers,
+                    thread_name_prefix='OntQuery',
+                    initializer=_mark_worker)
+
+        return OntQuery._executor
+
+    @classmethod
+    def _get_hedge_executor(cls):
+        with OntQuery._executor_lock:
+            if OntQuery._hedge_executor is None:
+                OntQuery._hedge_executor = ThreadPoolExecutor(
+                    max_workers=cls._max_workers * 2,
+                    thread_name_prefix='OntQueryHedge')
+
+        return OntQuery._hedge_executor
+
+    def _hedged(self, service, plan, after, errors):
+        """ if service has not answered plan after seconds send the same
+            query again and keep whichever finishes first, the loser is
+            left to finish in the background since requests can't cancel.
+            NOTE results are only returned once an attempt has finished so
+            hedged calls do not stream, see OntQuery.stream """
+        def work():
+            failed = []
+            with deadline(plan.deadline), transport_errors(failed):
+                return list(service.query_plan(plan)), failed
+
+        def result(future):
+            results, failed = future.result()
+            errors.extend(failed)  # only the winner's count
+            return results
+
+        executor = self._get_hedge_executor()
+        first = executor.submit(work)
+        done, _ = wait((first,), timeout=after)
+        if done:
+            return result(first)
+
+        log.debug(f'{service} slower than p{self.hedge * 100:g}, hedging')
+        pending = {first, executor.submit(work)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return result(future)
+
+        return result(first)  # both failed
+
+    def _failed(self, service, error):
+        """ record a failure, raise it unless the breaker is on """
+        self._breaker.failure(service, error)
+        if self._breaker.threshold is None:
+            raise error
+
+        log.warning(f'{service} failed, trying the next service: {error!r}')
+
+    def _guarded(self, service, plan, incomplete, hedge=False):
+        """ service.query_plan(plan) through the circuit breaker and within
+            the plan's deadline, services that are skipped, fail, run out
+            of time or had requests fail along the way are appended to
+            incomplete so that an outage is not negative cached """
+        if plan.expired:
+            log.debug(f'deadline passed, not asking {service}')
+            incomplete.append(service)
+            return
+
+        if not self._breaker.allow(service):
+            log.debug(f'circuit open for {service}, skipping')
+            incomplete.append(service)
+            return
+
+        after = (self._stats.percentile(service, self.hedge)
+                 if hedge and self.hedge is not None and service.hedgeable else None)
+        errors = []
+        try:
+            if after is not None:
+                results = self._hedged(service, plan, after, errors)
+            else:
+                results = deadline_iter(service.query_plan(plan), plan.deadline, errors)
+
+            if self._hooks or service._hooks:
+                results = self._watched(service, plan, results)
+
+            yield from results
+        except GeneratorExit:
+            self._breaker.success(service)  # the caller already has what it needs
+            raise
+        except Exception as e:
+            incomplete.append(service)
+            if plan.expired:  # our budget ran out, not the service's fault
+                log.debug(f'deadline passed while asking {service}: {e!r}')
+            else:
+                self._failed(service, e)
+        else:
+            self._finished(service, incomplete, errors)
+
+    def _finished(self, service, incomplete, errors):
+        if errors:
+            log.debug(f'{service} returned after failed requests: {errors[0]!r}')
+            incomplete.append(service)
+            self._breaker.failure(service, errors[0])
+        else:
+            self._breaker.success(service)
+
+    def _watched(self, service, plan, results):
+        """ fire the service hooks around results from a single service """
+        service._fire('on_query_start', query=self, plan=plan)
+        start, count = time.monotonic(), 0
+        def fire(name, **kwargs):
+            kwargs.update(query=self, plan=plan, service=service,
+                          latency=time.monotonic() - start)
+            self._fire(name, **kwargs)
+            service._fire(name, **kwargs)
+
+        try:
+            for result in results:
+                count += result is not None
+                yield result
+        except GeneratorExit:
+            fire('on_service_result', count=count)  # the caller stopped early, still a result
+            raise
+        except BaseException as e:
+            fire('on_service_error', error=e)
+            raise
+        else:
+            fire('on_service_result', count=count)
+        finally:
+            service._fire('on_query_end', query=self, plan=plan, count=count,
+                          latency=time.monotonic() - start, service=service)
+
+    def _collect(self, service, plan, skey, incomplete):
+        start = time.monotonic()
+        results = [result for result in self._guarded(service, plan, incomplete) if result]
+        self._stats.record(service, skey, bool(results), time.monotonic() - start)
+        return results
+
+    @staticmethod
+    def _merge(results_by_service):
+        """ one QueryResult per iri, results_by_service is in priority order """
+        groups = {}
+        for results in results_by_service:
+            for result in results:
+                key = id(result) if result.iri is None else str(result.iri)
+                groups.setdefault(key, []).append(result)
+
+        return [results[0] if len(results) == 1 else type(results[0]).merge(results)
+                for results in groups.values()]
+
+    def _merge_services(self, plan):
+        # highest priority first, otherwise keep the order services were added
+        return sorted(self._route(plan), key=lambda service: -service.priority)
+
+    def _run_merged(self, key, plan):
+        """ ask all services at the same time and merge what they return """
+        services = self._merge_services(plan)
+        skey = self._stats.key(plan)
+        incomplete = []
+        if len(services) == 1:
+            results_by_service = [self._collect(services[0], plan, skey, incomplete)]
+        else:
+            executor = self._get_executor()
+            futures = [executor.submit(self._collect, service, plan, skey, incomplete)
+                       for service in services]
+            results_by_service = [future.result() for future in futures]
+
+        merged = self._merge(results_by_service)
+        if not merged and not incomplete:
+            self._negative_cache.add(key)
+
+        yield from merged
+
+    def _run(self, key, plan, stop_on_label):
+        if plan.merge:
+            yield from self._run_merged(key, plan)
+            return
+
+        found = False
+        incomplete = []  # a failed service doesn't mean there is nothing to find
+        services, skey = self._ordered(plan, stop_on_label)
+        for j, service in enumerate(services):
             # TODO query keyword precedence if there is more than one
             #print(red.format(str(kwargs)))
             # TODO don't pass empty kwargs to services that can't handle them?
-            for i, result in enumerate(service.query(**kwargs)):
+            start, hit = time.monotonic(), False
+            results = self._guarded(service, plan, incomplete, hedge=stop_on_label)
+            for i, result in enumerate(results):
                 #print(red.format('AAAAAAAAAA'), result)
                 if result:
-                    yield result if raw else result.asTerm()
-                    if search is None and term is None and result.label and not include_all_services:
-                        return  # FIXME order services based on which you want first for now, will work on merging later
+                    found = True
+                    if not hit:
+                        hit = True
+                        self._stats.record(service, skey, True, time.monotonic() - start)
+
+                    yield result
+                    if stop_on_label and result.label:
+                        results.close()
+                        return  # FIXME see adaptive=True for ordering, will work on merging later
+
+            if not hit:
+                self._stats.record(service, skey, False, time.monotonic() - start)
+
+        if not found and not incomplete:
+            self._negative_cache.add(key)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=OntQuery._reset_executors)
+
+
+class AsyncOntQuery(OntQuery):
+    """ OntQuery for asyncio. Calling it returns an async generator and
+        services are queried through OntService.aquery so that many
+        queries can run concurrently on a single event loop.
+
+        Remote services open one aiohttp session per event loop, close
+        them with await query.aclose() before the loop finishes or use
+        async with AsyncOntQuery(...) as query: which does it for you. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_in_flight = {}
+
+    async def __call__(self, *args, raw=False, **kwargs):
+        self.setup()
+        key, plan, stop_on_label = self._prepare(*args, **kwargs)
+        if self._hooks:
+            self._fire('on_query_start', query=self, plan=plan)
+
+        start, count, cached = time.monotonic(), 0, False
+        try:
+            if key in self._negative_cache:
+                log.debug(f'negative cache hit for {plan}')
+                cached = True
+                return
+
+            for result in await self._asingle_flight(key, plan, stop_on_label):
+                count += 1
+                yield result if raw else result.asTerm()
+        finally:
+            if self._hooks:
+                self._fire('on_query_end', query=self, plan=plan, count=count,
+                           latency=time.monotonic() - start, cached=cached)
+
+    async def _asingle_flight(self, key, plan, stop_on_label):
+        if not self.coalesce or plan.deadline is not None:
+            # followers can't hold the leader to their own deadline
+            return await self._arun(key, plan, stop_on_label)
+
+        fkey = asyncio.get_event_loop(), key  # tasks cannot be shared between loops
+        if fkey not in self._async_in_flight:
+            task = asyncio.ensure_future(self._arun(key, plan, stop_on_label))
+            task.add_done_callback(lambda t: self._async_in_flight.pop(fkey, None))
+            self._async_in_flight[fkey] = task
+
+        # shield so that one cancelled caller does not cancel the others
+        return await asyncio.shield(self._async_in_flight[fkey])
+
+    async def _aguarded(self, service, plan, incomplete):
+        if plan.expired:
+            incomplete.append(service)
+            return
+
+        if not self._breaker.allow(service):
+            log.debug(f'circuit open for {service}, skipping')
+            incomplete.append(service)
+            return
+
+        results = service.aquery_plan(plan)
+        if self._hooks or service._hooks:
+            results = self._awatched(service, plan, results)
+
+        errors = []
+        try:
+            while True:
+                with deadline(plan.deadline), transport_errors(errors):
+                    try:
+                        result = await asyncio.wait_for(
+                            results.__anext__(),
+                            None if plan.deadline is None else
+                            max(plan.deadline - time.monotonic(), 0))
+                    except StopAsyncIteration:
+                        break
+
+                yield result
+        except GeneratorExit:
+            self._breaker.success(service)
+            raise
+        except Exception as e:
+            incomplete.append(service)
+            if plan.expired:
+                log.debug(f'deadline passed while asking {service}: {e!r}')
+            else:
+                self._failed(service, e)
+        else:
+            self._finished(service, incomplete, errors)
+
+    async def _awatched(self, service, plan, results):
+        """ _watched for async generators """
+        service._fire('on_query_start', query=self, plan=plan)
+        start, count = time.monotonic(), 0
+        def fire(name, **kwargs):
+            kwargs.update(query=self, plan=plan, service=service,
+                          latency=time.monotonic() - start)
+            self._fire(name, **kwargs)
+            service._fire(name, **kwargs)
+
+        try:
+            async for result in results:
+                count += result is not None
+                yield result
+        except GeneratorExit:
+            fire('on_service_result', count=count)
+            raise
+        except BaseException as e:
+            fire('on_service_error', error=e)
+            raise
+        else:
+            fire('on_service_result', count=count)
+        finally:
+            service._fire('on_query_end', query=self, plan=plan, count=count,
+                          latency=time.monotonic() - start, service=service)
+
+    async def _acollect(self, service, plan, skey, incomplete):
+        start = time.monotonic()
+        results = [result async for result in self._aguarded(service, plan, incomplete)
+                   if result]
+        self._stats.record(service, skey, bool(results), time.monotonic() - start)
+        return results
+
+    async def _arun_merged(self, key, plan):
+        skey = self._stats.key(plan)
+        incomplete = []
+        results_by_service = await asyncio.gather(
+            *(self._acollect(service, plan, skey, incomplete)
+              for service in self._merge_services(plan)))
+        merged = self._merge(results_by_service)
+        if not merged and not incomplete:
+            self._negative_cache.add(key)
+
+        return merged
+
+    async def _arun(self, key, plan, stop_on_label):
+        if plan.merge:
+            return await self._arun_merged(key, plan)
+
+        results, incomplete = [], []
+        services, skey = self._ordered(plan, stop_on_label)
+        for service in services:
+            start, hit = time.monotonic(), False
+            aresults = self._aguarded(service, plan, incomplete)
+            async for result in aresults:
+                if result:
+                    results.append(result)
+                    if not hit:
+                        hit = True
+                        self._stats.record(service, skey, True, time.monotonic() - start)
+
+                    if stop_on_label and result.label:
+                        await aresults.aclose()
+                        return results
+
+            if not hit:
+                self._stats.record(service, skey, False, time.monotonic() - start)
+
+        if not results and not incomplete:
+            self._negative_cache.add(key)
+
+        return results
+
+    async def aclose(self):
+        """ release any connections held by the services for this loop """
+        for service in self.services:
+            await service.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
 
 
 class OntQueryCli(OntQuery):
@@ -173,6 +1416,9 @@ class OntQueryCli(OntQuery):
             self._services = query.services
             self._instrumented = query._instrumented
             self._OntId = query._OntId
+            self._configure(**query._config)
+            for attr in self._shared_attrs:
+                setattr(self, attr, getattr(query, attr))
 
         else:
             super().__init__(*services, prefix=prefix, category=category,
@@ -1,10 +1,18 @@
-from .utils import Graph, QueryResult
+import asyncio
+import contextvars
+from .utils import Graph, QueryResult, Hooks
 
 
-class OntService:
+class OntService(Hooks):
     """ Base class for ontology wrappers that define setup, dispatch, query,
         add ontology, and list ontologies methods for a given type of endpoint. """
 
+    _accepts_plan = False  # set if query and aquery take a _plan= keyword
+    priority = 0  # OntQuery(adaptive=True) never tries a service before a higher priority one
+    hedgeable = False  # OntQuery(hedge=q) may send a slow query to this service twice
+    query_keywords = None  # the query keywords this service can answer, None for all
+    _routed_keywords = 'term', 'label', 'search', 'abbrev', 'iri', 'curie'
+
     def __init__(self):
         if not hasattr(self, '_onts'):
             self._onts = []
@@ -34,10 +42,71 @@ class OntService:
         self.started = True
         return self
 
+    @property
+    def served_prefixes(self):
+        """ curie prefixes this service can answer for, None if unrestricted """
+        return None
+
+    @property
+    def served_namespaces(self):
+        """ tuple of iri namespaces this service has identifiers in,
+            None if it could have identifiers in any namespace """
+        return None
+
+    def serves(self, plan):
+        """ False if this service cannot answer the QueryPlan at all.
+            OntQuery checks this before making any call to the service. """
+        keywords = self.query_keywords
+        if keywords is not None:
+            for keyword in self._routed_keywords:
+                if plan.get(keyword, None) and keyword not in keywords:
+                    return False
+
+        prefixes = self.served_prefixes
+        if (prefixes is not None and plan.prefixes and
+            not any(p in prefixes for p in plan.prefixes)):
+            return False
+
+        namespaces = self.served_namespaces
+        if (namespaces is not None and plan.identifier is not None and
+            not plan.iri.startswith(namespaces)):
+            return False
+
+        return True
+
     def query(self, *args, **kwargs):  # needs to conform to the OntQuery __call__ signature
         yield 'Queries should return an iterable'
         raise NotImplementedError()
 
+    async def aquery(self, *args, **kwargs):
+        """ Async version of query for use with AsyncOntQuery. The default
+            runs query in the loop's executor so that every service works,
+            remote services should override this to avoid the thread. """
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()  # carry the deadline into the thread
+        results = await loop.run_in_executor(
+            None, lambda: context.run(lambda: list(self.query(*args, **kwargs))))
+        for result in results:
+            yield result
+
+    def query_plan(self, plan):
+        """ Run a QueryPlan built by OntQuery. Services that set _accepts_plan
+            receive it as _plan= so they can use its normalized forms. """
+        if self._accepts_plan:
+            return self.query(_plan=plan, **plan)
+        else:
+            return self.query(**plan)
+
+    def aquery_plan(self, plan):
+        """ Async version of query_plan. """
+        if self._accepts_plan:
+            return self.aquery(_plan=plan, **plan)
+        else:
+            return self.aquery(**plan)
+
+    async def aclose(self):
+        """ close any connections opened by aquery """
+
 
 class BasicService(OntService):
     """ A very simple service for local use only """
@@ -1,9 +1,12 @@
 import sys
 import copy
-from itertools import chain
+import time
+import threading
+from collections import deque
 from urllib.parse import quote
 from . import exceptions as exc, trie
-from .utils import cullNone, subclasses, log, SubClassCompare, _already_logged
+from .utils import cullNone, one_or_many, subclasses, log, SubClassCompare, _already_logged
+from .utils import QueryResult
 from .query import OntQuery
 
 # FIXME ipython notebook?
@@ -193,6 +196,9 @@ class Identifier(Id):
 
         instrumented = cls._instrumented_class()
         cls.query = query_class(*services, instrumented=instrumented, **kwargs)
+        if hasattr(cls, '_preferred_cache'):
+            cls._preferred_cache = {}  # different services may prefer differently
+
         return cls.query
 
     @classmethod
@@ -289,6 +295,28 @@ class InstrumentedIdentifier(Identifier):
     skip_for_instrumentation = False
 
 
+_repr_local = threading.local()  # one shot repr args, see OntId.set_next_repr
+
+
+def _oneshot_repr_args():
+    if not hasattr(_repr_local, 'args'):
+        _repr_local.args = {}
+
+    return _repr_local.args
+
+
+def _restore_identifier(cls, iri, state):
+    """ unpickle without going through __new__, see OntId.__reduce__ """
+    if isinstance(cls, tuple):
+        instrumented, = cls
+        cls = instrumented._uninstrumented_class()
+
+    cls._setup_class()
+    self = str.__new__(cls, iri)
+    self.__dict__.update(state)
+    return self
+
+
 class OntId(Identifier, str):  # TODO all terms singletons to prevent nastyness
     _namespaces = OntCuries  # overwrite when subclassing to switch curies...
     _valid_repr_args = ('curie', 'iri', 'prefix', 'suffix')
@@ -308,12 +336,7 @@ class OntId(Identifier, str):  # TODO all terms singletons to prevent nastyness
         elif isinstance(curie_or_iri, cls):
             return cls(str(curie_or_iri))
 
-        if not hasattr(cls, f'_{cls.__name__}__repr_level'):
-            cls.__repr_level = 0
-            cls._oneshot_old_repr_args = None
-            if not hasattr(cls, 'repr_args'):
-                cls.repr_args = cls.repr_arg_order[0]
-
+        cls._setup_class()
         iri_ps, iri_ci, iri_c = None, None, None
 
         if prefix is not None and suffix is not None:
@@ -394,6 +417,27 @@ class OntId(Identifier, str):  # TODO all terms singletons to prevent nastyness
         self.suffix = suffix
         return self
 
+    @classmethod
+    def _setup_class(cls):
+        if not hasattr(cls, f'_{cls.__name__}__repr_level'):
+            cls.__repr_level = 0
+            cls._oneshot_old_repr_args = None
+            if not hasattr(cls, 'repr_args'):
+                cls.repr_args = cls.repr_arg_order[0]
+
+    def __reduce__(self):
+        # the iri, prefix and suffix are already known so skip __new__
+        # entirely, for OntTerm this also means no query on unpickle
+        cls = self.__class__
+        if '_instrumented_class' in cls.__dict__:
+            # made by _uninstrumented_class and can't be found by name
+            cls = cls._instrumented_class(),
+
+        return _restore_identifier, (cls, str(self), self._pickle_state())
+
+    def _pickle_state(self):
+        return dict(self.__dict__)
+
     @property
     def namespaces(self):
         return self._namespaces()
@@ -463,14 +507,17 @@ class OntId(Identifier, str):  # TODO all terms singletons to prevent nastyness
 
     @classmethod
     def set_next_repr(cls, *repr_args):
-        cls._oneshot_old_repr_args = cls.repr_args
-        cls.repr_args = repr_args
+        """ repr_args for the next repr of cls, only in the current thread
+            so that concurrent reprs don't see each other's settings """
+        _oneshot_repr_args()[cls] = repr_args
 
     @classmethod
     def reset_repr_args(cls):
-        if hasattr(cls, '_oneshot_old_repr_args') and cls._oneshot_old_repr_args is not None:
-            cls.repr_args = cls._oneshot_old_repr_args
-            cls._oneshot_old_repr_args = None
+        _oneshot_repr_args().pop(cls, None)
+
+    @classmethod
+    def _current_repr_args(cls):
+        return _oneshot_repr_args().get(cls, cls.repr_args)
 
     @property
     def _repr_level(self):
@@ -488,7 +535,7 @@ class OntId(Identifier, str):  # TODO all terms singletons to prevent nastyness
         first_done = False
         #firsts = getattr(self.__class__, f'_{self.__class__.__name__}__firsts')
         firsts = self._firsts
-        for arg in self.__class__.repr_args:  # always use class repr args
+        for arg in self._current_repr_args():  # always use class repr args
             if not hasattr(self, arg) or getattr(self, arg) is None:  # allow repr of uninitialized classes
                 continue
             is_arg = False
@@ -577,6 +624,22 @@ class OntTerm(InstrumentedIdentifier, OntId):
     def __init__(self, *args, **kwargs):
         pass
 
+    _pickle_heavy = '_graph', '_blob'
+
+    def _pickle_state(self):
+        """ the bound fields, provenance only if QueryResult.pickle_provenance """
+        state = super()._pickle_state()
+        state.pop('query', None)  # _OntTerm can carry its own query and all its services
+        if '_source' in state:
+            state['_source'] = None  # services don't travel, see QueryResult.__reduce__
+
+        if not QueryResult.pickle_provenance:
+            for key in self._pickle_heavy:
+                if key in state:
+                    state[key] = None
+
+        return state
+
     def _bind_result(self, **kwargs):
         try:
             result = self._get_query_result(**kwargs)
@@ -584,6 +647,7 @@ class OntTerm(InstrumentedIdentifier, OntId):
         except StopIteration:
             self.validated = False
             self.label = None  # the label attr should always be present even on failure
+            self._query_result = None  # so that deferred fields do not query again
 
     def _get_query_result(self, **kwargs):
         extra_kwargs = {}
@@ -613,7 +677,8 @@ class OntTerm(InstrumentedIdentifier, OntId):
                     #log.info(repr(TermRepr(**result)) + '\n')
                     continue
 
-                # TODO merge from multiple goes here?
+                # earlier results are from higher priority services
+                result = result.merge((old_result, result))
 
             if i == 0:
                 old_result = result
@@ -732,27 +797,109 @@ class OntTerm(InstrumentedIdentifier, OntId):
         if self._graph:
             print(self._graph.serialize(format='nifttl').decode())
 
-    def asPreferred(self):
-        """ Return the term attached to its preferred id """
+    _preferred_cache = {}  # iri -> (iri at the end of its replacement chain, time cached)
+    preferred_cache_size = 10000  # oldest entries are dropped first
+    preferred_cache_ttl = 3600  # seconds, None never expires, replacements change upstream
+
+    @classmethod
+    def _preferred_get(cls, iri):
+        try:
+            preferred, stamp = cls._preferred_cache[iri]
+        except KeyError:
+            return None
+
+        ttl = cls.preferred_cache_ttl
+        if ttl is not None and time.monotonic() - stamp >= ttl:
+            cls._preferred_cache.pop(iri, None)
+            return None
+
+        return preferred
+
+    @classmethod
+    def _preferred_set(cls, iris, preferred):
+        cache, now = cls._preferred_cache, time.monotonic()
+        for iri in iris:
+            cache[iri] = preferred, now
+
+        while len(cache) > cls.preferred_cache_size:
+            try:
+                cache.pop(next(iter(cache)), None)
+            except (StopIteration, RuntimeError):  # another thread got there first
+                break
+
+    def _preferred_step(self):
+        """ the next term in a replacement chain, None at the end """
         if not self.validated:
             # FIXME sort of a nullability issue
-            return self
+            return None
 
         if 'TEMP:preferredId' in self.predicates:
             # NOTE having predicates by default is not supported by all remotes
-            term = self.predicates['TEMP:preferredId'][0].asTerm()  # FIXME produces wrong instrumented
+            term = self.predicates['TEMP:preferredId'][0]
+            return term if isinstance(term, self.__class__) else term.asTerm()  # FIXME produces wrong instrumented
         elif self.deprecated:
             rb = self('replacedBy:', asTerm=True)
             if rb:
-                term = rb[0]
-        else:
-            term = self
+                return rb[0]
 
-        if term != self:
-            term._original_term = self  # FIXME naming for prov ...
+    def asPreferred(self):
+        """ Return the term attached to its preferred id, following chains
+            of replacements. The preferred iri is cached for every iri on
+            the chain, the term returned is new on every call. """
+        if not self.validated:
+            return self
+
+        term, preferred = None, self._preferred_get(self.iri)
+        if preferred is None:
+            term, chain = self, [self.iri]
+            while True:
+                next_term = term._preferred_step()
+                if next_term is None or next_term.iri == term.iri:
+                    break
+
+                preferred = self._preferred_get(next_term.iri)
+                if preferred is not None:
+                    break
+                elif next_term.iri in chain:
+                    log.warning(f'replacement cycle {chain} -> {next_term.iri}')
+                    break
+
+                term = next_term
+                chain.append(term.iri)
 
+            if preferred is None:
+                preferred = term.iri
+
+            self._preferred_set(chain, preferred)
+
+        if preferred == self.iri:
+            return self
+        elif term is None or term.iri != preferred:
+            term = self.__class__(iri=preferred)
+
+        term._original_term = self  # FIXME naming for prov ...
         return term
 
+    @classmethod
+    def asPreferred_many(cls, terms):
+        """ asPreferred for many terms or identifiers at once, returns
+            the preferred terms in the same order. Each distinct iri is
+            resolved once and concurrently. """
+        terms = list(terms)
+        unique = {}
+        for term in terms:
+            unique.setdefault(OntId(term).iri, term)
+
+        def preferred(term):
+            if not isinstance(term, cls):
+                term = cls(term)
+
+            return term.asPreferred()
+
+        executor = cls.query._get_executor()
+        resolved = dict(zip(unique, executor.map(preferred, unique.values())))
+        return [resolved[OntId(term).iri] for term in terms]
+
     def asId(self):
         uninst_class = self._uninstrumented_class()
         return uninst_class(self)
@@ -779,12 +926,57 @@ class OntTerm(InstrumentedIdentifier, OntId):
                           for qr in OntTerm.query(search=expression,
                                                   prefix=prefix, limit=limit))
 
-        return sorted(set(next(OntTerm.query(term=s)).OntTerm
-                          for qr in OntTerm.query(search=expression,
-                                                  prefix=prefix, limit=limit)
-                          for s in chain(OntTerm(qr.iri).synonyms, (qr.label,))
-                          if all(f in s for f in filters)),
-                          key=lambda t:t.label)
+        return sorted(set(cls.search_iter(expression, prefix=prefix,
+                                          filters=filters, limit=limit)),
+                      key=lambda t:t.label)
+
+    @classmethod
+    def search_iter(cls, expression, prefix=None, filters=tuple(), limit=40, buffer=16):
+        """ Like search but yields each term once as soon as it is found.
+            Terms for search hits are built from the search results, the
+            only other calls are term lookups for the synonyms of the hits,
+            each distinct synonym is looked up once and concurrently.
+            At most buffer hits are in flight, so breaking out early
+            skips the lookups for the remaining hits. """
+        OntTerm = cls
+        if expression is None and prefix is not None:
+            for qr in OntTerm.query.stream(search=expression, prefix=prefix,
+                                           limit=limit, buffer=buffer, raw=True):
+                yield OntTerm._from_query_result(qr)
+
+            return
+
+        def lookup(synonym):
+            return next(OntTerm.query(term=synonym), None)
+
+        def match(s):
+            return s is not None and all(f in s for f in filters)
+
+        executor = OntTerm.query._get_executor()
+        lookups = {}
+        pending = deque()
+        seen = set()
+        def drain(n):
+            while len(pending) > n:
+                term, futures = pending.popleft()
+                for term in (term, *(f.result() for f in futures)):
+                    if term is not None and term not in seen:
+                        seen.add(term)
+                        yield term
+
+        for qr in OntTerm.query.stream(search=expression, prefix=prefix,
+                                       limit=limit, buffer=buffer, raw=True):
+            # the hit is the term for its own label, no need to look it up again
+            term = OntTerm._from_query_result(qr) if match(qr.label) else None
+            synonyms = [s for s in (qr.synonyms or ()) if match(s) and s != qr.label]
+            for synonym in synonyms:
+                if synonym not in lookups:
+                    lookups[synonym] = executor.submit(lookup, synonym)
+
+            pending.append((term, [lookups[s] for s in synonyms]))
+            yield from drain(buffer)
+
+        yield from drain(0)
 
     def __call__(self, predicate, *predicates, depth=1, direction='OUTGOING',
                  asTerm=False, asPreferred=False, include_supers=False):
@@ -833,21 +1025,92 @@ class OntTerm(InstrumentedIdentifier, OntId):
         else:
             return out
 
+    @classmethod
+    def neighbors_many(cls, terms, predicates, depth=1, direction='OUTGOING',
+                       asTerm=False, asPreferred=False, include_supers=False):
+        """ Like calling each term with predicates, but for many terms at once.
+            Each distinct subject is queried once with all subjects in flight
+            at the same time, then the union of all the neighbors is resolved
+            in a single pass so that a neighbor shared by many subjects is
+            only constructed once. Returns {term: {predicate: objects}}. """
+        asTerm = asTerm or asPreferred
+        predicates = tuple(one_or_many(predicates))
+        terms = [(term, OntId(term).iri) for term in terms]
+        subjects = list(dict.fromkeys(iri for _, iri in terms))
+
+        def neighbors(iri):
+            out = {}
+            for result in cls.query(iri=iri, predicates=predicates, depth=depth,
+                                    direction=direction, include_supers=include_supers,
+                                    raw=True):
+                for k, v in result.predicates.items():
+                    v = v if isinstance(v, tuple) else (v,)
+                    out[k] = out[k] + v if k in out else v
+
+            return out
+
+        executor = cls.query._get_executor()
+        outs = dict(zip(subjects, executor.map(neighbors, subjects)))
+
+        if asTerm:
+            # one construction per distinct neighbor across all subjects
+            objects = {o for out in outs.values() for v in out.values() for o in v
+                       if isinstance(o, OntId) and not isinstance(o, cls)}
+            convert = lambda o: cls(o).asPreferred() if asPreferred else cls(o)
+            resolved = dict(zip(objects, executor.map(convert, objects)))
+            if asPreferred:
+                already = {o for out in outs.values() for v in out.values() for o in v
+                           if isinstance(o, cls)}
+                resolved.update(zip(already, executor.map(lambda t: t.asPreferred(), already)))
+
+            outs = {iri: {k: tuple(resolved.get(o, o) for o in v) for k, v in out.items()}
+                    for iri, out in outs.items()}
+
+        result = {}
+        for term, iri in terms:  # every form of a subject maps to its shared neighbors
+            if isinstance(term, cls):
+                if not hasattr(term, 'predicates'):
+                    term.predicates = {}
+
+                term.predicates.update(outs[iri])  # FIXME klobbering issues
+
+            result[term] = outs[iri]
+
+        return result
+
+    # fields that are not always returned by a service, they are filled
+    # in from a single cached fetch the first time any of them is accessed
+    _deferred_fields = {'type': '_type', 'types': '_types'}
+
+    def _fetch(self):
+        """ The QueryResult for this term. Services are queried at most once
+            per term, the result from _bind_result is reused if there is one. """
+        if not hasattr(self, '_query_result'):
+            try:
+                self._query_result = next(self.query(iri=self.iri, raw=True))
+            except StopIteration:
+                self._query_result = None
+
+        return self._query_result
+
+    def _load_deferred(self):
+        qr = self._fetch()
+        if qr is None:
+            # FIXME this happens when a term is moved
+            # from one term type to another and its
+            # original source is lost
+            log.warning(f'No results for {self.__class__.__name__}('
+                        f'{self.iri})')
+
+        for field, attr in self._deferred_fields.items():
+            if not hasattr(self, attr):
+                value = None if qr is None else qr[field]
+                setattr(self, attr, tuple() if value is None and field == 'types' else value)
+
     @property
     def type(self):
         if not hasattr(self, '_type'):
-            try:
-                qr = next(self.query(self.iri))
-                self._type = qr.type
-                self._types = qr.types
-            except StopIteration as e:
-                # FIXME this happens when a term is moved
-                # from one term type to another and its
-                # original source is lost
-                log.warning(f'No results for {self.__class__.__name__}('
-                            f'{self.iri})')
-                self._type = None
-                self._types = tuple()
+            self._load_deferred()
 
         return self._type
 
@@ -858,18 +1121,7 @@ class OntTerm(InstrumentedIdentifier, OntId):
     @property
     def types(self):
         if not hasattr(self, '_types'):
-            try:
-                qr = next(self.query(self.iri))
-                self._type = qr.type
-                self._types = qr.types
-            except StopIteration as e:
-                # FIXME this happens when a term is moved
-                # from one term type to another and its
-                # original source is lost
-                log.warning(f'No results for {self.__class__.__name__}('
-                            f'{self.iri})')
-                self._type = None
-                self._types = tuple()
+            self._load_deferred()
 
         return self._types
 
@@ -1,4 +1,9 @@
+import os
+import time
 import logging
+import threading
+import contextvars
+from contextlib import contextmanager
 from functools import wraps
 
 red = '\x1b[31m{}\x1b[0m'
@@ -22,14 +27,25 @@ log = makeSimpleLogger('ontquery')
 
 
 __logged = set()
+__logged_lock = threading.Lock()
 def _already_logged(thing):
-    case = thing in __logged
-    if not case:
-        __logged.add(thing)
+    with __logged_lock:
+        case = thing in __logged
+        if not case:
+            __logged.add(thing)
 
     return case
 
 
+def _reset_logged_lock():
+    global __logged_lock
+    __logged_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):  # another thread may hold it when we fork
+    os.register_at_fork(after_in_child=_reset_logged_lock)
+
+
 def subclasses(start, done=None):
     if done is None:
         done = set()
@@ -129,11 +145,29 @@ class Graph():
                 yield p, o
 
 
+_result_classes = {}
+
+
+def _restore_result(instrumented, query_args, fields):
+    """ unpickle a QueryResult, see QueryResult.__reduce__ """
+    if instrumented is None:
+        cls = QueryResult
+    else:
+        if instrumented not in _result_classes:
+            _result_classes[instrumented] = QueryResult.new_from_instrumented(instrumented)
+
+        cls = _result_classes[instrumented]
+
+    return cls(query_args, **fields)
+
+
 class QueryResult:
     """ Encapsulate query results and allow for clear and clean documentation
         of how a particular service maps their result terminology onto the
         ontquery keyword api. """
 
+    pickle_provenance = False  # whether pickled results and terms keep _graph and _blob
+
     @classmethod
     def new_from_instrumented(cls, instrumented):
         return type(cls.__name__, (cls,), dict(_instrumented=instrumented))
@@ -181,6 +215,117 @@ class QueryResult:
             self.__dict[k] = v
             #self.__dict__[k] = v
 
+    @classmethod
+    def merge(cls, results):
+        """ Combine results about the same iri from different services.
+            results are in priority order, the label and other single
+            values come from the first result that has them, synonyms,
+            labels, types and predicates are unioned. """
+        def union(*iterables):
+            out = []
+            for iterable in iterables:
+                for value in iterable:
+                    if value not in out:
+                        out.append(value)
+
+            return tuple(out)
+
+        def astuple(value):
+            return value if isinstance(value, tuple) else (value,)
+
+        def first(key):
+            for result in results:
+                if result[key] is not None:
+                    return result[key]
+
+        predicates = {}
+        for result in results:
+            for k, v in (result.predicates or {}).items():
+                if k not in predicates:
+                    predicates[k] = v
+                else:
+                    merged = union(astuple(predicates[k]), astuple(v))
+                    if (len(merged) == 1 and
+                        not isinstance(predicates[k], tuple) and
+                        not isinstance(v, tuple)):
+                        merged, = merged
+
+                    predicates[k] = merged
+
+        label = first('label')
+        return cls(results[0].__query_args,
+                   iri=results[0].iri,
+                   curie=first('curie'),
+                   label=label,
+                   labels=union(*(r.labels for r in results if r.labels)),
+                   definition=first('definition'),
+                   synonyms=union(*(r.synonyms for r in results if r.synonyms)),
+                   deprecated=first('deprecated'),
+                   predicates=predicates,
+                   type=first('type'),
+                   types=union(*(r.types for r in results if r.types)),
+                   _graph=first('_graph'),
+                   _blob=first('_blob'),
+                   source=next((r.source for r in results if r.label == label),
+                               results[0].source))
+
+    _wire_fields = ('iri', 'curie', 'label', 'labels', 'definition', 'synonyms',
+                    'deprecated', 'predicates', 'type', 'types')
+
+    @staticmethod
+    def _to_wire_value(value):
+        # identifiers become 1-tuples of their iri and tuples become lists
+        # so that everything else can pass through as is
+        if isinstance(value, tuple):
+            return [QueryResult._to_wire_value(v) for v in value]
+        elif hasattr(value, 'iri') and hasattr(value, 'curie'):
+            return str(value.iri),
+        else:
+            return value
+
+    @staticmethod
+    def _from_wire_value(value, OntId):
+        if isinstance(value, list):
+            return tuple(QueryResult._from_wire_value(v, OntId) for v in value)
+        elif isinstance(value, tuple):
+            return OntId(value[0])
+        else:
+            return value
+
+    def to_wire(self, sources=()):
+        """ plain tuple for sending between processes, _graph and _blob are
+            dropped and source becomes its index in sources or None """
+        predicates = self.predicates
+        if predicates:
+            predicates = {str(k): self._to_wire_value(v) for k, v in predicates.items()}
+
+        source = next((i for i, s in enumerate(sources) if s is self.source), None)
+        return (str(self.iri) if self.iri is not None else None,
+                self.curie,
+                self.label,
+                tuple(self.labels),
+                self.definition,
+                tuple(self.synonyms),
+                self.deprecated,
+                predicates,
+                self._to_wire_value(self.type),
+                self._to_wire_value(tuple(self.types)),
+                source)
+
+    @classmethod
+    def from_wire(cls, wire, OntId, query_args=None, sources=()):
+        """ inverse of to_wire """
+        *values, source = wire
+        fields = dict(zip(cls._wire_fields, values))
+        if fields['predicates']:
+            fields['predicates'] = {k: cls._from_wire_value(v, OntId)
+                                    for k, v in fields['predicates'].items()}
+
+        fields['type'] = cls._from_wire_value(fields['type'], OntId)
+        fields['types'] = cls._from_wire_value(fields['types'], OntId)
+
+        return cls(query_args, source=None if source is None else sources[source], **fields)
+
     @property
     def OntTerm(self):  # FIXME naming XXXX deprecate this
         if self.iri is None:
@@ -195,6 +340,18 @@ class QueryResult:
         # run against _OntTerm to prevent recursion
         return hasattr(self, '_instrumented')
 
+    def __reduce__(self):
+        # the per service classes made by new_from_instrumented can't be
+        # pickled by reference so rebuild from the instrumented class
+        # source is a live service with sessions and locks so it never goes
+        fields = dict(self.__dict, source=None)
+        if not self.pickle_provenance:
+            fields.update(_graph=None, _blob=None)
+
+        return _restore_result, (getattr(self, '_instrumented', None),
+                                 self.__query_args,
+                                 fields)
+
     def keys(self):
         yield from self.__dict.keys()
 
@@ -224,3 +381,219 @@ class QueryResult:
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.__dict!r})'
+
+
+_deadline = contextvars.ContextVar('ontquery_deadline', default=None)
+
+
+@contextmanager
+def deadline(when):
+    """ http calls made inside must finish by time.monotonic() == when,
+        None for no limit. This is a context variable so it follows
+        asyncio tasks but has to be set again in worker threads. """
+    token = _deadline.set(when)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left():
+    """ seconds until the current deadline, None if there isn't one """
+    when = _deadline.get()
+    if when is not None:
+        return max(when - time.monotonic(), 0)
+
+
+_transport_errors = contextvars.ContextVar('ontquery_transport_errors', default=None)
+
+
+@contextmanager
+def transport_errors(into):
+    """ Failed http requests made inside are appended to the list into.
+        Services tend to turn a failed request into an empty result, this
+        is how OntQuery tells a transient outage from nothing to find.
+        Like deadline it follows asyncio tasks but not threads. """
+    token = _transport_errors.set(into)
+    try:
+        yield
+    finally:
+        _transport_errors.reset(token)
+
+
+def transport_error(error):
+    """ report a failed request to the enclosing transport_errors, if any """
+    errors = _transport_errors.get()
+    if errors is not None:
+        errors.append(error)
+
+
+def deadline_iter(results, when, errors=None):
+    """ iterate results with the deadline set only while they are being
+        produced so it does not leak into whatever the consumer does,
+        failed requests made while producing them go in errors """
+    results = iter(results)
+    while True:
+        with deadline(when), transport_errors(errors):
+            try:
+                result = next(results)
+            except StopIteration:
+                return
+
+        yield result
+
+
+def deadline_session(session):
+    """ make every request sent through a requests.Session respect deadline()
+        and report server errors and failed requests to transport_errors() """
+    if getattr(session, '_deadline_aware', False):
+        return session
+
+    send = session.send
+    def send_by_deadline(request, **kwargs):
+        left = time_left()
+        if left is not None:
+            if left <= 0:
+                raise TimeoutError(f'deadline passed before sending {request.url}')
+
+            timeout = kwargs.get('timeout', None)
+            if timeout is None:
+                kwargs['timeout'] = left
+            elif isinstance(timeout, tuple):
+                kwargs['timeout'] = tuple(left if t is None else min(t, left) for t in timeout)
+            else:
+                kwargs['timeout'] = min(timeout, left)
+
+        try:
+            resp = send(request, **kwargs)
+        except Exception as e:
+            transport_error(e)
+            raise
+
+        if resp.status_code >= 500:
+            transport_error(f'{resp.status_code} {resp.reason} {request.url}')
+
+        return resp
+
+    session.send = send_by_deadline
+    session._deadline_aware = True
+    return session
+
+
+class Hooks:
+    """ Callbacks fired by OntQuery as a query runs, all take keyword arguments.
+
+        on_query_start(query, plan)
+        on_service_result(query, plan, service, count, latency)
+        on_service_error(query, plan, service, error, latency)
+        on_query_end(query, plan, count, latency, cached)
+
+        cached is True when the negative cache answered. Hooks on an
+        OntService only hear about that service, for them on_query_start
+        and on_query_end bracket the service's own part of the query and
+        on_query_end gets service= instead of cached=. A hook that raises
+        is logged and otherwise ignored. With no hooks the service
+        results are not wrapped and nothing is counted. """
+
+    hook_names = 'on_query_start', 'on_service_result', 'on_service_error', 'on_query_end'
+    _hooks = {}  # never mutated, instances get their own on the first add_hook
+
+    def _own_hooks(self):
+        if '_hooks' not in vars(self):
+            self._hooks = {}  # name -> tuple of functions, tuples are replaced so firing needs no lock
+
+        return self._hooks
+
+    def add_hook(self, name, function):
+        if name not in self.hook_names:
+            raise ValueError(f'unknown hook {name}, not one of {self.hook_names}')
+
+        hooks = self._own_hooks()
+        hooks[name] = hooks.get(name, ()) + (function,)
+
+    def remove_hook(self, name, function):
+        hooks = self._own_hooks()
+        functions = tuple(f for f in hooks.get(name, ()) if f != function)
+        if functions:
+            hooks[name] = functions
+        else:
+            hooks.pop(name, None)
+
+    def _fire(self, name, **kwargs):
+        for function in self._hooks.get(name, ()):
+            try:
+                function(**kwargs)
+            except Exception as e:
+                log.exception(e)
+
+
+class QueryPlan(dict):
+    """ The kwargs for a single OntQuery call together with the normalized
+        forms of its identifiers, predicates and prefixes. OntQuery builds
+        one per call and every service it dispatches to shares it instead
+        of redoing the conversions. Since it is also the plain kwargs dict
+        services that know nothing about plans can use query(**plan). """
+
+    def __init__(self, kwargs, OntId, merge=False, deadline=None):
+        super().__init__(kwargs)
+        self.OntId = OntId
+        self.merge = merge  # ask every service and combine results per iri
+        self.deadline = deadline  # time.monotonic() by which the query has to be done
+        self.prefixes = frozenset(one_or_many(self.get('prefix', None)))
+        self.exclude_prefixes = frozenset(one_or_many(self.get('exclude_prefix', None)))
+        self.predicates = tuple(self._predicate(p) for p in self.get('predicates', tuple()))
+        self.identifier = None
+        iri, curie = self.get('iri', None), self.get('curie', None)
+        if iri or curie:
+            try:
+                self.identifier = OntId(iri) if iri else OntId(curie)
+            except (OntId.Error, ValueError, TypeError) as e:
+                # leave malformed identifiers for the services to report
+                log.debug(e)
+
+        self._uriref = None
+        self._predicate_urirefs = None
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def _predicate(self, p):
+        if isinstance(p, self.OntId):
+            return p
+        elif hasattr(p, 'curie') or ':' in p:
+            return self.OntId(p)
+        elif isinstance(p, str):
+            return p
+        else:
+            raise TypeError(f'wat {type(p)} {p}')
+
+    @property
+    def iri(self):
+        if self.identifier is not None:
+            return self.identifier.iri
+
+    @property
+    def curie(self):
+        if self.identifier is not None:
+            return self.identifier.curie
+
+    @property
+    def uriref(self):
+        """ the identifier as an rdflib.URIRef """
+        if self._uriref is None and self.identifier is not None:
+            import rdflib
+            self._uriref = rdflib.URIRef(self.identifier.iri)
+
+        return self._uriref
+
+    @property
+    def predicate_urirefs(self):
+        """ predicates as rdflib.URIRefs, bare strings are left alone """
+        if self._predicate_urirefs is None:
+            import rdflib
+            self._predicate_urirefs = tuple(rdflib.URIRef(p.iri)
+                                            if isinstance(p, self.OntId) else
+                                            p for p in self.predicates)
+
+        return self._predicate_urirefs
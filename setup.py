@@ -88,7 +88,8 @@ try:
         tests_require=tests_require,
         install_requires=[
         ],
-        extras_require={'dev': ['pyontutils>=0.1.5',
+        extras_require={'async': ['aiohttp'],
+                        'dev': ['pyontutils>=0.1.5',
                                 'pytest-cov',
                                 'wheel',
                                 ],
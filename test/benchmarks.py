@@ -0,0 +1,330 @@
+""" Offline benchmarks for the ontquery hot paths
+
+    python -m test.benchmarks                     # compare against stored baselines
+    python -m test.benchmarks --triples 1000000   # larger synthetic ontology
+    python -m test.benchmarks --update            # store the current numbers
+
+Everything runs against a synthetic ontology built in memory, no network,
+the remote services are timed against the local stand-ins in test/servers.py.
+Baselines are seconds per operation and depend on the machine, so rerun
+with --update when the hardware changes, not when the code gets slower. """
+import sys
+import json
+import time
+import random
+import argparse
+import pathlib
+import rdflib
+import ontquery as oq
+from ontquery import trie
+from .servers import FakeSciGraph, FakeInterLex
+
+BASELINES = pathlib.Path(__file__).with_name('benchmarks.json')
+THRESHOLD = 1.5  # a benchmark regresses when it is this many times slower than baseline
+SIZES = 10_000, 100_000, 1_000_000, 5_000_000
+
+# the minimum needed to construct an rdflibLocal and read interlex records
+BENCH_CURIES = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'oboInOwl': 'http://www.geneontology.org/formats/oboInOwl#',
+    'NIFRID': 'http://uri.neuinfo.org/nif/nifstd/readable/',
+    'definition': 'http://purl.obolibrary.org/obo/IAO_0000115',
+    'ilx.anno.hasExactSynonym': 'http://uri.interlex.org/base/ilx_0737161',
+    'ilx.anno.hasNarrowSynonym': 'http://uri.interlex.org/base/ilx_0737163',
+    'ILX': 'http://uri.interlex.org/base/ilx_',
+    'ilx.type': 'http://uri.interlex.org/base/readable/type/',
+}
+
+TRIPLES_PER_CLASS = 5  # type, label, synonym, definition, subClassOf
+
+
+def synthetic_graph(triples, prefixes=20):
+    """ Build a graph of roughly triples triples spread over prefixes namespaces.
+        Every other namespace is nested inside the previous one so that qname
+        has to find the longest match, and subClassOf forms a binary tree so
+        depth queries have somewhere to go. """
+    curies = dict(BENCH_CURIES)
+    namespaces = []
+    for k in range(prefixes):
+        if k % 2:
+            namespace = f'{namespaces[-1]}sub{k}/'
+        else:
+            namespace = f'http://bench.example.org/ns{k}/'
+
+        curies[f'BENCH{k}'] = namespace
+        namespaces.append(namespace)
+
+    graph = rdflib.Graph()
+    for prefix, namespace in curies.items():
+        graph.bind(prefix, namespace)
+
+    RDF, RDFS, OWL, Literal = rdflib.RDF, rdflib.RDFS, rdflib.OWL, rdflib.Literal
+    synonym = rdflib.URIRef(curies['NIFRID'] + 'synonym')
+    definition = rdflib.URIRef(curies['definition'])
+    iris = []
+    def gen():
+        for i in range(max(triples // TRIPLES_PER_CLASS, prefixes)):
+            s = rdflib.URIRef(f'{namespaces[i % prefixes]}{i:07d}')
+            yield s, RDF.type, OWL.Class, graph
+            yield s, RDFS.label, Literal(f'bench term {i}'), graph
+            yield s, synonym, Literal(f'bench synonym {i}'), graph
+            yield s, definition, Literal(f'definition of bench term {i}'), graph
+            if iris:
+                yield s, RDFS.subClassOf, iris[(i - 1) // 2], graph
+
+            iris.append(s)
+
+    graph.addN(gen())
+    return graph, curies, iris
+
+
+class Bench:
+    """ A synthetic ontology and the classes bound to it, built once per size. """
+
+    def __init__(self, triples, sample=1000, seed=0):
+        self.triples = triples
+        self.graph, self.curies, self.iris = synthetic_graph(triples)
+        rng = random.Random(seed)
+        self.sample = [str(i) for i in rng.sample(self.iris, min(sample, len(self.iris)))]
+
+        # OntTerm queries resolve through the global curies so the synthetic
+        # prefixes go there too, none of them collide with real ones
+        oq.OntCuries(self.curies)
+        self.OntCuries = oq.OntCuries
+        self.OntId = oq.OntId
+        self.curies_sample = [self.OntCuries.qname(i) for i in self.sample]
+
+        class BenchTerm(oq.OntTerm): pass
+
+        self.remote = oq.plugin.get('rdflib')(self.graph)
+        BenchTerm.query_init(self.remote)
+        BenchTerm.query.setup()  # so the rdflib benchmarks can run alone
+        self.OntTerm = BenchTerm
+        self._servers = []
+
+    def serve(self, server_class, **kwargs):
+        server = server_class(self.graph, self.curies, **kwargs).start()
+        self._servers.append(server)
+        return server
+
+    def close(self):
+        for server in self._servers:
+            server.stop()
+
+
+def bench_qname(b):
+    qname, iris = b.OntCuries.qname, b.sample
+    def run():
+        for iri in iris:
+            qname(iri)
+
+    return len(iris), run
+
+
+def bench_trie(b):
+    namespaces, iris = list(b.curies.values()), b.sample
+    def run():
+        t = {}
+        for namespace in namespaces:
+            trie.insert_trie(t, namespace)
+
+        for iri in iris:
+            trie.get_longest_namespace(t, iri)
+
+    return len(namespaces) + len(iris), run
+
+
+def bench_ontid_curie(b):
+    OntId, curies = b.OntId, b.curies_sample
+    def run():
+        for curie in curies:
+            OntId(curie)
+
+    return len(curies), run
+
+
+def bench_ontid_iri(b):
+    OntId, iris = b.OntId, b.sample
+    def run():
+        for iri in iris:
+            OntId(iri)
+
+    return len(iris), run
+
+
+def bench_ontterm(b):
+    OntTerm, curies = b.OntTerm, b.curies_sample[:100]
+    def run():
+        for curie in curies:
+            OntTerm(curie)
+
+    return len(curies), run
+
+
+def bench_rdflib_label(b):
+    query = b.remote.query
+    labels = [f'bench term {int(i.rsplit("/", 1)[-1])}' for i in b.sample[:100]]
+    def run():
+        for label in labels:
+            list(query(label=label))
+
+    return len(labels), run
+
+
+def bench_rdflib_prefix(b):
+    query = b.remote.query
+    def run():
+        list(query(prefix='BENCH3'))
+
+    return 1, run
+
+
+def bench_rdflib_depth(b):
+    query = b.remote.query
+    leaves = [str(i) for i in b.iris[-10:]]
+    predicates = b.OntId('rdfs:subClassOf'),
+    def run():
+        for leaf in leaves:
+            list(query(iri=leaf, predicates=predicates, depth=40))
+
+    return len(leaves), run
+
+
+def bench_merge_records(b):
+    from ontquery.plugins.services.interlex_client import InterLexClient
+    n = 200
+    def run():
+        # _merge_records mutates its inputs so build fresh ones every time
+        ref = [{'literal': f'synonym {i}', 'type': ''} for i in range(n)]
+        new = [{'literal': f'Synonym {i} ', 'type': 'exact'} for i in range(n // 2, n + n // 2)]
+        InterLexClient._merge_records(ref, new, on=['literal'], alt=['type'])
+
+    return 1, run
+
+
+def bench_scigraph_id(b):
+    class SciGraphNoCache(oq.plugin.get('SciGraph')):
+        cache = False  # time the round trip, not the client cache
+
+    server = b.serve(FakeSciGraph)
+    remote = SciGraphNoCache(apiEndpoint=server.url)
+    remote.setup(instrumented=b.OntTerm)
+    curies = b.curies_sample[:100]
+    def run():
+        for curie in curies:
+            list(remote.query(curie=curie))
+
+    return len(curies), run
+
+
+def bench_interlex_id(b):
+    server = b.serve(FakeInterLex)
+    remote = oq.plugin.get('InterLex')(apiEndpoint=None, api_first=True)
+    remote.setup(instrumented=b.OntTerm)
+    remote.ilx_cli = server.client()
+    curies = b.curies_sample[:100]
+    def run():
+        for curie in curies:
+            list(remote.query(curie=curie))
+
+    return len(curies), run
+
+
+BENCHMARKS = {
+    'qname': bench_qname,
+    'trie': bench_trie,
+    'ontid_curie': bench_ontid_curie,
+    'ontid_iri': bench_ontid_iri,
+    'ontterm': bench_ontterm,
+    'rdflib_label': bench_rdflib_label,
+    'rdflib_prefix': bench_rdflib_prefix,
+    'rdflib_depth': bench_rdflib_depth,
+    'merge_records': bench_merge_records,
+    'scigraph_id': bench_scigraph_id,
+    'interlex_id': bench_interlex_id,
+}
+
+
+def timeit(ops, run, repeat=5):
+    """ best of repeat, in seconds per operation """
+    run()  # warm up caches, the steady state is what we care about
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / ops
+
+
+def run_benchmarks(triples=SIZES[0], names=None, repeat=5, sample=1000):
+    bench = Bench(triples, sample=sample)
+    try:
+        return {name:timeit(*BENCHMARKS[name](bench), repeat=repeat)
+                for name in (names or BENCHMARKS)}
+    finally:
+        bench.close()
+
+
+def load_baselines(path=BASELINES):
+    if not path.exists():
+        return {'threshold': THRESHOLD, 'thresholds': {}, 'baselines': {}}
+
+    with open(path, 'rt') as f:
+        return json.load(f)
+
+
+def compare(results, baselines, triples, threshold=None):
+    """ yield name, seconds, baseline, ratio, regressed for each result """
+    stored = baselines['baselines'].get(str(triples), {})
+    for name, seconds in results.items():
+        limit = threshold or baselines['thresholds'].get(name, baselines['threshold'])
+        if name not in stored:
+            yield name, seconds, None, None, False
+            continue
+
+        ratio = seconds / stored[name]
+        yield name, seconds, stored[name], ratio, ratio > limit
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m test.benchmarks',
+                                     description='benchmark ontquery hot paths offline')
+    parser.add_argument('--triples', type=int, default=SIZES[0],
+                        help=f'synthetic ontology size, baselines exist for {SIZES}')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='override the stored regression thresholds')
+    parser.add_argument('--update', action='store_true', help='store the results as baselines')
+    args = parser.parse_args(argv)
+
+    baselines = load_baselines()
+    results = run_benchmarks(args.triples, names=args.only, repeat=args.repeat)
+    regressed = []
+    print(f'{"benchmark":<16}{"us/op":>12}{"baseline":>12}{"ratio":>8}')
+    for name, seconds, base, ratio, bad in compare(results, baselines, args.triples,
+                                                   args.threshold):
+        base = '-' if base is None else f'{base * 1e6:.2f}'
+        ratio = '-' if ratio is None else f'{ratio:.2f}'
+        print(f'{name:<16}{seconds * 1e6:>12.2f}{base:>12}{ratio:>8}{"  REGRESSED" if bad else ""}')
+        if bad:
+            regressed.append(name)
+
+    if args.update:
+        baselines['baselines'].setdefault(str(args.triples), {}).update(results)
+        with open(BASELINES, 'wt') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+        return 0
+
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,538 @@
+""" Local stand-ins for the SciGraph and InterLex web services
+
+    Both serve a fixture rdflib graph over http on localhost so that the
+    remote code paths, their caches and their concurrency can be exercised
+    and benchmarked without a network.
+
+    with FakeSciGraph(graph, curies) as server:
+        remote = oq.plugin.get('SciGraph')(apiEndpoint=server.url)
+
+    with FakeInterLex(graph, curies) as server:
+        remote = oq.plugin.get('InterLex')(apiEndpoint=None)
+        remote.host, remote.port = server.host, server.port  # dev resolver
+        # or remote.ilx_cli = server.client() after setup for the scicrunch api
+
+Latency and errors can be injected into any request, see FakeServer.
+Only the read endpoints that ontquery uses are implemented. """
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+import rdflib
+from rdflib import RDF, RDFS, OWL, URIRef, BNode, Literal
+
+IAO_DEFINITION = URIRef('http://purl.obolibrary.org/obo/IAO_0000115')
+IAO_ISABOUT = URIRef('http://purl.obolibrary.org/obo/IAO_0000136')
+DEFINITIONS = IAO_DEFINITION, URIRef('http://www.w3.org/2004/02/skos/core#definition')
+SYNONYMS = (URIRef('http://uri.neuinfo.org/nif/nifstd/readable/synonym'),
+            URIRef('http://www.geneontology.org/formats/oboInOwl#hasSynonym'),
+            URIRef('http://www.geneontology.org/formats/oboInOwl#hasExactSynonym'),)
+SHORT_NAMESPACES = str(RDF), str(RDFS), str(OWL)  # scigraph uses bare names for these
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep alive so pooled sessions behave like production
+    disable_nagle_algorithm = True  # otherwise every response waits on a delayed ack
+
+    def do_GET(self):
+        self.server.fake._handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.fake._handle(self, 'POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer:
+    """ Threaded http server on localhost backed by an rdflib graph.
+
+        latency      seconds added to every request, plus up to jitter more
+        error_rate   fraction of requests answered with error_status
+        fail(n)      the next n requests, or n requests to one route, fail
+
+        All randomness comes from seed so runs are repeatable. hits counts
+        requests per route name, failed ones included, unknown paths are None. """
+
+    routes = ()  # (name, method, regex) matched against the path in order
+
+    def __init__(self, graph, curies=None, latency=0, jitter=0, error_rate=0,
+                 error_status=500, seed=0, host='127.0.0.1', port=0):
+        self.graph = graph
+        self.curies = dict(curies) if curies is not None else {
+            p:str(n) for p, n in graph.namespaces()}
+        self._namespaces = sorted(((n, p) for p, n in self.curies.items()),
+                                  key=lambda np: len(np[0]), reverse=True)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.host = host
+        self.port = port
+        self.hits = Counter()
+        self._routes = [(name, method, re.compile(regex))
+                        for name, method, regex in self.routes]
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._failures = []  # [route, status], route None matches anything
+        self._httpd = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self.port = self._httpd.server_address[1]
+        thread = threading.Thread(target=self._httpd.serve_forever,
+                                  name=f'{self.__class__.__name__}-{self.port}',
+                                  daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def fail(self, count=1, status=None, route=None):
+        """ queue count failures, restricted to one route name if given """
+        with self._lock:
+            self._failures.extend([route, status or self.error_status]
+                                  for _ in range(count))
+
+    def reset(self):
+        """ clear hits and any queued failures """
+        with self._lock:
+            self.hits.clear()
+            self._failures.clear()
+
+    def _inject(self, name):
+        with self._lock:
+            status = None
+            for i, (route, _status) in enumerate(self._failures):
+                if route is None or route == name:
+                    status = _status
+                    del self._failures[i]
+                    break
+            else:
+                if self.error_rate and self._rng.random() < self.error_rate:
+                    status = self.error_status
+
+            delay = self.latency + (self._rng.random() * self.jitter if self.jitter else 0)
+
+        return status, delay
+
+    def _handle(self, handler, method):
+        split = urlsplit(handler.path)
+        params = {k:v if len(v) > 1 else v[0]
+                  for k, v in parse_qs(split.query).items()}
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+
+        name, groups = None, ()
+        for _name, _method, regex in self._routes:
+            match = regex.fullmatch(split.path)
+            if match and _method == method:
+                name, groups = _name, tuple(g and unquote(g) for g in match.groups())
+                break
+
+        with self._lock:
+            self.hits[name] += 1
+
+        status, delay = self._inject(name)
+        if delay:
+            time.sleep(delay)
+
+        if name is None:
+            status, ctype, content = self._json({'error': f'no route {split.path}'}, 404)
+        elif status is not None:
+            status, ctype, content = self._json({'error': 'injected failure'}, status)
+        else:
+            try:
+                status, ctype, content = getattr(self, name)(*groups, params=params, body=body)
+            except Exception as e:
+                status, ctype, content = self._json({'error': repr(e)}, 500)
+
+        try:
+            handler.send_response(status)
+            handler.send_header('Content-Type', ctype)
+            handler.send_header('Content-Length', str(len(content)))
+            handler.end_headers()
+            handler.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up, probably a deadline
+
+    @staticmethod
+    def _json(obj, status=200):
+        # exactly application/json, the scigraph client compares it verbatim
+        return status, 'application/json', json.dumps(obj).encode()
+
+    @staticmethod
+    def _true(value):
+        return str(value).lower() == 'true'
+
+    def _expand(self, curie_or_iri):
+        """ iri for an identifier in a path, None if the prefix is unknown """
+        if '://' in curie_or_iri:
+            return URIRef(curie_or_iri)
+
+        prefix, _, suffix = curie_or_iri.partition(':')
+        if prefix in self.curies:
+            return URIRef(self.curies[prefix] + suffix)
+
+    def _curie(self, iri):
+        for namespace, prefix in self._namespaces:
+            if iri.startswith(namespace):
+                return prefix + ':' + iri[len(namespace):]
+
+    def _first(self, s, predicates):
+        for p in predicates:
+            for o in self.graph.objects(s, p):
+                return str(o)
+
+    def _all(self, s, predicates):
+        return sorted(str(o) for p in predicates for o in self.graph.objects(s, p))
+
+    def _index(self, subjects, synonyms=True):
+        """ lowercased label (and synonym) -> sorted subjects """
+        index = {}
+        predicates = (RDFS.label,) + (SYNONYMS if synonyms else ())
+        for p in predicates:
+            for s, o in self.graph.subject_objects(p):
+                if s in subjects:
+                    index.setdefault(str(o).lower(), set()).add(s)
+
+        return {k:sorted(v) for k, v in index.items()}
+
+
+class FakeSciGraph(FakeServer):
+    """ SciGraph vocabulary, graph and cypher endpoints.
+
+        entail is accepted and ignored, there are no subproperties to entail over. """
+
+    routes = (
+        ('cypher_curies', 'GET', r'/cypher/curies'),
+        ('execute', 'GET', r'/cypher/execute(\.json)?'),
+        ('categories', 'GET', r'/vocabulary/categories'),
+        ('find_by_id', 'GET', r'/vocabulary/id/(.+)'),
+        ('find_by_term', 'GET', r'/vocabulary/term/(.+)'),
+        ('search_by_term', 'GET', r'/vocabulary/search/(.+)'),
+        ('relationship_types', 'GET', r'/graph/relationship_types'),
+        ('neighbors', 'GET', r'/graph/neighbors/(.+)'),
+        ('node', 'GET', r'/graph/(.+)'),
+    )
+
+    def __init__(self, graph, curies=None, **kwargs):
+        super().__init__(graph, curies, **kwargs)
+        self._subjects = {s for s in graph.subjects() if isinstance(s, URIRef)}
+        self._labels = self._index(self._subjects, synonyms=False)
+        self._terms = self._index(self._subjects)
+
+    def _id(self, node):
+        return self._curie(node) or str(node)
+
+    def _pred(self, p):
+        for namespace in SHORT_NAMESPACES:
+            if p.startswith(namespace):
+                return p[len(namespace):]
+
+        return self._id(p)
+
+    def _concept(self, s):
+        concept = {
+            'iri': str(s),
+            'labels': self._all(s, (RDFS.label,)),
+            'definitions': self._all(s, DEFINITIONS),
+            'synonyms': self._all(s, SYNONYMS),
+            'acronyms': [],
+            'abbreviations': [],
+            'categories': [],
+            'deprecated': (s, OWL.deprecated, Literal(True)) in self.graph,
+        }
+        curie = self._curie(s)
+        if curie is not None:
+            concept['curie'] = curie
+
+        return concept
+
+    def _matches(self, index, term, params):
+        prefixes = params.get('prefix', ())
+        prefixes = (prefixes,) if isinstance(prefixes, str) else prefixes
+        limit = int(params.get('limit', 20) or 20)
+        out = []
+        for s in index:
+            concept = self._concept(s)
+            if prefixes and concept.get('curie', ':').split(':')[0] not in prefixes:
+                continue
+
+            out.append(concept)
+            if len(out) >= limit:
+                break
+
+        return out
+
+    def cypher_curies(self, params, body):
+        return self._json(self.curies)
+
+    def execute(self, json_output, params, body):
+        onts = sorted(self.graph.subjects(RDF.type, OWL.Ontology))
+        if json_output:
+            return self._json([{'n': {'iri': str(o)}} for o in onts])
+
+        # the neo4j text table that Cypher.execute picks apart
+        rows = ''.join(f'| Node[{i}]{{iri:"{o}"}} |\n' for i, o in enumerate(onts))
+        text = f'+---+\n| n |\n+---+\n{rows}+---+\n'
+        return 200, 'text/plain', text.encode()
+
+    def categories(self, params, body):
+        return self._json([])
+
+    def find_by_id(self, id, params, body):
+        s = self._expand(id)
+        if s is None or s not in self._subjects:
+            return self._json({'error': f'{id} not found'}, 404)
+
+        return self._json(self._concept(s))
+
+    def find_by_term(self, term, params, body):
+        index = self._terms if self._true(params.get('searchSynonyms')) else self._labels
+        return self._json(self._matches(index.get(term.lower(), ()), term, params))
+
+    def search_by_term(self, term, params, body):
+        term = term.lower()
+        index = self._terms if self._true(params.get('searchSynonyms', True)) else self._labels
+        subjects = sorted({s for k, ss in index.items() if term in k for s in ss})
+        return self._json(self._matches(subjects, term, params))
+
+    def relationship_types(self, params, body):
+        return self._json(sorted({self._pred(p) for p in self.graph.predicates()
+                                  if p != RDF.type}))
+
+    def node(self, id, params, body):
+        s = self._expand(id)
+        if s is None or s not in self._subjects:
+            return self._json({'nodes': [], 'edges': []})
+
+        types = [self._pred(o) for o in self.graph.objects(s, RDF.type)
+                 if str(o).startswith(str(OWL))]
+        return self._json({'nodes': [{'id': self._id(s),
+                                      'lbl': self._first(s, (RDFS.label,)),
+                                      'meta': {'types': types}}],
+                           'edges': []})
+
+    def neighbors(self, id, params, body):
+        start = self._expand(id)
+        if start is None:
+            return self._json({'nodes': [], 'edges': []})
+
+        depth = int(params.get('depth', 1) or 1)
+        direction = params.get('direction', 'BOTH') or 'BOTH'
+        blank = self._true(params.get('blankNodes'))
+        wanted = params.get('relationshipType')
+        if wanted:
+            expanded = self._expand(wanted)  # curie or iri -> the name edges use
+            wanted = self._pred(expanded) if expanded is not None else wanted
+
+        def ok(p, o):
+            return (p != RDF.type and
+                    not isinstance(o, Literal) and
+                    (blank or not isinstance(o, BNode)) and
+                    (not wanted or self._pred(p) == wanted))
+
+        nodes, edges, frontier = {start}, {}, [start]
+        for _ in range(depth):
+            new = []
+            for node in frontier:
+                steps = []
+                if direction in ('OUTGOING', 'BOTH'):
+                    steps += [(node, p, o, o) for p, o in self.graph.predicate_objects(node)]
+                if direction in ('INCOMING', 'BOTH'):
+                    steps += [(s, p, node, s) for s, p in self.graph.subject_predicates(node)]
+
+                for s, p, o, other in steps:
+                    if not ok(p, other) or (s, p, o) in edges:
+                        continue
+
+                    edges[s, p, o] = {'sub': self._id(s), 'pred': self._pred(p),
+                                      'obj': self._id(o), 'meta': {}}
+                    if other not in nodes:
+                        nodes.add(other)
+                        new.append(other)
+
+            frontier = new
+
+        return self._json({'nodes': [{'id': self._id(n),
+                                      'lbl': self._first(n, (RDFS.label,)),
+                                      'meta': {}} for n in sorted(nodes)],
+                           'edges': list(edges.values())})
+
+
+class FakeInterLex(FakeServer):
+    """ The scicrunch interlex api under /api/1/ and the /base/ n-triples resolver.
+
+        Every class in the graph gets an ilx id, in sorted order unless its
+        iri already is one, and keeps its own iri as the preferred existing id.
+        If api_key is set requests with any other key get a 401. """
+
+    ilx_base = 'http://uri.interlex.org/base/'
+    routes = (
+        ('user_info', 'GET', r'/api/1/user/info'),
+        ('entity', 'GET', r'/api/1/term/ilx/([^/]+)'),
+        ('entity_from_curie', 'GET', r'/api/1/term/curie/([^/]+)'),
+        ('elastic', 'GET', r'/api/1/term/elastic/search'),
+        ('annotations', 'GET', r'/api/1/term/get-annotations/([^/]+)'),
+        ('relationships', 'GET', r'/api/1/term/get-relationships/([^/]+)'),
+        ('curie_ntriples', 'GET', r'/base/curies/([^/]+)'),
+        ('lexical_ntriples', 'GET', r'/base/lexical/(.+)'),
+        ('ilx_ntriples', 'GET', r'/base/((?:ilx|tmp|cde|set|pde)_[^/.]+)'),
+    )
+
+    def __init__(self, graph, curies=None, api_key=None, **kwargs):
+        super().__init__(graph, curies, **kwargs)
+        self.api_key = api_key
+        classes = sorted({s for s in graph.subjects(RDF.type, OWL.Class)
+                          if isinstance(s, URIRef)})
+        self.fragments = {}  # subject -> ilx fragment
+        for i, s in enumerate(classes):
+            self.fragments[s] = (s[len(self.ilx_base):]
+                                 if s.startswith(self.ilx_base + 'ilx_') else
+                                 f'ilx_{i + 1:07d}')
+
+        self._subjects = {f:s for s, f in self.fragments.items()}
+        self._tids = {s:str(i + 1) for i, s in enumerate(classes)}
+        self._by_tid = {t:s for s, t in self._tids.items()}
+        self._by_curie = {}
+        for s in classes:
+            self._by_curie[self._ilx_curie(s)] = s
+            curie = self._curie(s)
+            if curie is not None:
+                self._by_curie[curie] = s
+
+        self._terms = self._index(set(classes))
+
+    @property
+    def api(self):
+        return f'{self.url}/api/1/'
+
+    def client(self, **kwargs):
+        """ an InterLexClient pointed at this server """
+        from ontquery.plugins.services.interlex_client import InterLexClient
+        return InterLexClient(base_url=self.api, key=self.api_key or 'fake-key', **kwargs)
+
+    def ilx_iri(self, subject):
+        return self.ilx_base + self.fragments[URIRef(subject)]
+
+    def _ilx_curie(self, s):
+        return 'ILX:' + self.fragments[s].split('_', 1)[1]
+
+    def _entity(self, s):
+        existing = [{'iri': self.ilx_iri(s), 'curie': self._ilx_curie(s), 'preferred': '0'}]
+        if not s.startswith(self.ilx_base):
+            existing.append({'iri': str(s), 'curie': self._curie(s) or str(s), 'preferred': '1'})
+
+        return {
+            'id': self._tids[s],
+            'ilx': self.fragments[s],
+            'type': 'term',
+            'label': self._first(s, (RDFS.label,)) or '',
+            'definition': self._first(s, DEFINITIONS) or '',
+            'synonyms': [{'literal': o, 'type': ''} for o in self._all(s, SYNONYMS)],
+            'existing_ids': existing,
+            'superclasses': [{'id': self._tids[o], 'ilx': self.fragments[o]}
+                             for o in sorted(self.graph.objects(s, RDFS.subClassOf))
+                             if o in self._tids],
+            'annotations': [],
+            'relationships': [],
+            'version': '1',
+            'status': '0',
+        }
+
+    def _api(self, body, data):
+        try:
+            params = json.loads(body) if body else {}
+        except ValueError:
+            params = {}
+
+        if self.api_key is not None and params.get('key') != self.api_key:
+            return self._json({'errormsg': 'bad api key'}, 401)
+
+        return self._json({'data': data})
+
+    def _missing(self):
+        return {'id': None}
+
+    def user_info(self, params, body):
+        return self._api(body, {'id': '0', 'email': 'fake@localhost'})
+
+    def entity(self, fragment, params, body):
+        s = self._subjects.get(fragment)
+        return self._api(body, self._missing() if s is None else self._entity(s))
+
+    def entity_from_curie(self, curie, params, body):
+        s = self._by_curie.get(curie)
+        return self._api(body, self._missing() if s is None else self._entity(s))
+
+    def elastic(self, params, body):
+        try:
+            query = json.loads(body) if body else {}
+        except ValueError:
+            query = {}
+
+        term = str(query.get('term', '')).lower()
+        size = int(query.get('size', 10))
+        start = int(query.get('from', 0))
+        subjects = sorted({s for k, ss in self._terms.items() if term and term in k
+                           for s in ss})
+        hits = [{'_source': self._entity(s)} for s in subjects[start:start + size]]
+        return self._api(body, {'hits': {'hits': hits}})
+
+    def annotations(self, tid, params, body):
+        return self._api(body, [])
+
+    def relationships(self, tid, params, body):
+        return self._api(body, [])
+
+    def _ntriples(self, s):
+        if s is None:
+            return self._json({'error': 'not found'}, 404)
+
+        ilx = URIRef(self.ilx_iri(s))
+        ont = URIRef(self.ilx_base + 'ontologies/' + self.fragments[s])
+        g = rdflib.Graph()
+        g.add((ont, RDF.type, OWL.Ontology))
+        g.add((ont, IAO_ISABOUT, ilx))
+        for p, o in self.graph.predicate_objects(s):
+            if isinstance(o, BNode):
+                continue
+
+            if o in self.fragments:
+                o = URIRef(self.ilx_iri(o))
+
+            g.add((ilx, p, o))
+
+        return 200, 'application/n-triples', g.serialize(format='nt', encoding='utf-8')
+
+    def ilx_ntriples(self, fragment, params, body):
+        return self._ntriples(self._subjects.get(fragment))
+
+    def curie_ntriples(self, curie, params, body):
+        return self._ntriples(self._by_curie.get(curie))
+
+    def lexical_ntriples(self, label, params, body):
+        subjects = [s for s in self._terms.get(label.lower(), ())
+                    if label.lower() in (l.lower() for l in self._all(s, (RDFS.label,)))]
+        return self._ntriples(subjects[0] if subjects else None)
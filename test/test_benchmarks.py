@@ -0,0 +1,27 @@
+import unittest
+from . import benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+    """ keep the benchmarks runnable, the timings themselves are checked
+        by running python -m test.benchmarks """
+
+    def test_run(self):
+        results = benchmarks.run_benchmarks(triples=500, repeat=1, sample=20)
+        assert set(results) == set(benchmarks.BENCHMARKS), results
+        assert all(seconds > 0 for seconds in results.values()), results
+
+    def test_baselines(self):
+        baselines = benchmarks.load_baselines()
+        for size, stored in baselines['baselines'].items():
+            assert int(size) in benchmarks.SIZES, size
+            assert set(stored) <= set(benchmarks.BENCHMARKS), stored
+
+    def test_compare(self):
+        baselines = {'threshold': 1.5,
+                     'thresholds': {'slow': 3},
+                     'baselines': {'10': {'fast': 1.0, 'slow': 1.0}}}
+        results = {'fast': 2.0, 'slow': 2.0, 'new': 1.0}
+        regressed = {name:bad for name, *_, bad in
+                     benchmarks.compare(results, baselines, 10)}
+        assert regressed == {'fast': True, 'slow': False, 'new': False}, regressed
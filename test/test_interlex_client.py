@@ -1,8 +1,10 @@
+import asyncio
 from copy import deepcopy
 import json
 import os
 import random
 import string
+import threading
 import time
 import unittest
 
@@ -746,4 +748,211 @@ class Test(unittest.TestCase):
             records = complex_syn_wt2 + complex_syn,
             on = ['literal', 'type'],
         )
-        assert exact == complex_syn_wt2 + complex_syn
\ No newline at end of file
+        assert exact == complex_syn_wt2 + complex_syn
+
+class FakeIlxCli:
+    """ Offline stand in for InterLexClient that only knows curies. """
+
+    get_ilx_fragment = staticmethod(InterLexClient.get_ilx_fragment)
+
+    def __init__(self, known):
+        self.known = known
+        self.calls = []
+
+    def get_entity(self, ilx_id):
+        self.calls.append(('iri', ilx_id))
+        return {'id': None, 'ilx': None}
+
+    def get_entity_from_curie(self, curie):
+        self.calls.append(('curie', curie))
+        if curie in self.known:
+            return {'id': '1', 'ilx': self.known[curie]}
+
+        return {'id': None, 'ilx': None}
+
+    async def aget_entity(self, ilx_id):
+        return self.get_entity(ilx_id)
+
+    async def aget_entity_from_curie(self, curie):
+        return self.get_entity_from_curie(curie)
+
+
+class TestResolveEntity(unittest.TestCase):
+    def setUp(self):
+        self.remote = InterLexRemote(apiEndpoint=None)
+        self.remote.ilx_cli = FakeIlxCli({'UBERON:0000955': 'ilx_0101431'})
+
+    def test_remembers_path(self):
+        iri = 'http://purl.obolibrary.org/obo/UBERON_0000955'
+        resp = self.remote._resolve_entity(iri, 'UBERON:0000955')
+        assert resp['ilx'] == 'ilx_0101431'
+        assert self.remote.resolution_paths == {'UBERON': 'curie'}
+
+        self.remote.ilx_cli.calls = []
+        resp = self.remote._resolve_entity(iri, 'UBERON:0000955')
+        assert resp['ilx'] == 'ilx_0101431'
+        assert self.remote.ilx_cli.calls == [('curie', 'UBERON:0000955')]
+
+    def test_race_ilx(self):
+        iri = 'http://uri.interlex.org/base/ilx_0101431'
+        resp = self.remote._resolve_entity(iri, 'ILX:0101431')
+        assert resp is None
+        assert ('iri', iri) in self.remote.ilx_cli.calls
+        assert ('curie', 'ILX:0101431') in self.remote.ilx_cli.calls
+        assert not self.remote.resolution_paths
+
+    def test_async_race(self):
+        iri = 'http://purl.obolibrary.org/obo/UBERON_0000955'
+        resp = asyncio.run(self.remote._aresolve_entity(iri, 'UBERON:0000955'))
+        assert resp['ilx'] == 'ilx_0101431'
+        assert self.remote.resolution_paths == {'UBERON': 'curie'}
+
+
+class FakeResponse:
+    status_code = 201
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return {'data': self.data}
+
+
+class TestEntityMeta(unittest.TestCase):
+    def setUp(self):
+        # skip __init__ so nothing goes over the network
+        self.cli = InterLexClient.__new__(InterLexClient)
+        self.cli._entity_meta = {}
+        self.gets, self.posts = [], []
+        self.versions = {'ilx_0101431': 1, 'ilx_0381360': 3}
+
+        def _get(endpoint, params=None):
+            self.gets.append(endpoint)
+            if endpoint.startswith('term/ilx/'):
+                frag = endpoint.rsplit('/', 1)[-1]
+                return FakeResponse({'id': frag[-3:], 'ilx': frag, 'version': self.versions[frag],
+                                     'curie': None, 'annotations': []})
+
+            return FakeResponse([{'id': 'a1', 'tid': '431', 'annotation_tid': '360',
+                                  'value': 'v'}])
+
+        def _post(endpoint, data=None):
+            self.posts.append((endpoint, data))
+            return FakeResponse(dict(data, superclasses=[]))
+
+        self.cli._get, self.cli._post = _get, _post
+
+    def test_withdraw_resolves_once(self):
+        for _ in range(3):
+            self.cli.withdraw_annotation('ILX:0101431', 'ILX:0381360', 'v')
+
+        assert len([g for g in self.gets if g.startswith('term/ilx/')]) == 2, self.gets
+        assert self.posts[-1][1]['annotation_term_version'] == 3
+
+    def test_edit_invalidates(self):
+        self.cli.withdraw_annotation('ILX:0101431', 'ILX:0381360', 'v')
+        self.versions['ilx_0101431'] = 2
+        self.cli.update_entity('ILX:0101431', definition='new')
+        self.cli.withdraw_annotation('ILX:0101431', 'ILX:0381360', 'v')
+        assert self.posts[-1][1]['term_version'] == 2
+
+    def test_read_during_edit(self):
+        post = self.cli._post
+        def _post(endpoint, data=None):
+            if endpoint.startswith('term/edit/'):
+                self.cli.get_entity_meta('ILX:0101431')  # another thread reads first
+                self.versions['ilx_0101431'] = 2
+                if data.get('definition') == 'fail':
+                    raise ConnectionError('write may have been applied')
+
+            return post(endpoint, data)
+
+        self.cli._post = _post
+        self.cli.update_entity('ILX:0101431', definition='new')
+        assert self.cli.get_entity_meta('ILX:0101431')['version'] == 2
+        with self.assertRaises(ConnectionError):
+            self.cli.update_entity('ILX:0101431', definition='fail')
+
+        assert 'ilx_0101431' not in self.cli._entity_meta
+
+
+class FakeSyncCli:
+    """ records writes against a single existing entity """
+
+    get_ilx_fragment = staticmethod(InterLexClient.get_ilx_fragment)
+
+    def __init__(self):
+        self.gets = []
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def get_entity(self, ilx_id):
+        self.gets.append(ilx_id)
+        return {'id': '1', 'ilx': ilx_id,
+                'annotations': [
+                    {'annotation_term_ilx': 'ilx_0000001', 'value': 'keep', 'withdrawn': '0'},
+                    {'annotation_term_ilx': 'ilx_0000001', 'value': 'drop', 'withdrawn': '0'},
+                    {'annotation_term_ilx': 'ilx_0000001', 'value': 'gone', 'withdrawn': '1'},
+                    {'annotation_term_ilx': 'ilx_0000009', 'value': 'other', 'withdrawn': '0'},],
+                'relationships': [
+                    {'term1_ilx': ilx_id, 'relationship_term_ilx': 'ilx_0000002',
+                     'term2_ilx': 'ilx_0000003', 'withdrawn': '0'},
+                    {'term1_ilx': 'ilx_0000004', 'relationship_term_ilx': 'ilx_0000002',
+                     'term2_ilx': ilx_id, 'withdrawn': '0'},],}
+
+    def _record(name):
+        def write(self, s, p, o):
+            with self.lock:
+                self.writes.append((name, s, p, o))
+        return write
+
+    add_annotation = _record('add_annotation')
+    add_relationship = _record('add_relationship')
+    withdraw_annotation = _record('withdraw_annotation')
+    withdraw_relationship = _record('withdraw_relationship')
+
+
+class TestSyncPredicates(unittest.TestCase):
+    def setUp(self):
+        self.remote = InterLexRemote(apiEndpoint=None)
+        self.remote.ilx_cli = FakeSyncCli()
+        base = 'http://uri.interlex.org/base/'
+        self.desired = {
+            'ilx_0101431': {base + 'ilx_0000001': ['keep', 'new'],
+                            base + 'ilx_0000002': base + 'ilx_0000005'},
+            'ilx_0101432': {base + 'ilx_0000001': 'keep'},}
+
+    def test_diff(self):
+        added, withdrawn = self.remote.sync_predicates(self.desired, dry_run=True)
+        assert sorted(added) == [('ilx_0101431', 'ilx_0000001', 'new'),
+                                 ('ilx_0101431', 'ilx_0000002', 'ilx_0000005'),]
+        # ilx_0000009 is not being synced and the incoming relationship is not ours
+        assert sorted(withdrawn) == [('ilx_0101431', 'ilx_0000001', 'drop'),
+                                     ('ilx_0101431', 'ilx_0000002', 'ilx_0000003'),
+                                     ('ilx_0101432', 'ilx_0000001', 'drop'),]
+        assert sorted(self.remote.ilx_cli.gets) == ['ilx_0101431', 'ilx_0101432']
+        assert not self.remote.ilx_cli.writes
+
+    def test_clear_predicate(self):
+        base = 'http://uri.interlex.org/base/'
+        added, withdrawn = self.remote.sync_predicates(
+            {'ilx_0101431': {base + 'ilx_0000001': []}}, dry_run=True)
+        assert not added
+        assert sorted(withdrawn) == [('ilx_0101431', 'ilx_0000001', 'drop'),
+                                     ('ilx_0101431', 'ilx_0000001', 'keep'),]
+
+    def test_write_rate(self):
+        start = time.time()
+        added, withdrawn = self.remote.sync_predicates(self.desired, rate=50)
+        writes = self.remote.ilx_cli.writes
+        assert len(writes) == len(added) + len(withdrawn) == 5
+        assert time.time() - start >= 4 / 50
+        assert ('withdraw_relationship', 'ilx_0101431', 'ilx_0000002', 'ilx_0000003') in writes
+
+    def test_triples(self):
+        base = 'http://uri.interlex.org/base/'
+        self.remote.add_triple(base + 'ilx_0101431', base + 'ilx_0000002', base + 'tmp_0000005')
+        self.remote.delete_triple(base + 'ilx_0101431', base + 'ilx_0000001', 'drop')
+        assert self.remote.ilx_cli.writes == [
+            ('add_relationship', 'ilx_0101431', 'ilx_0000002', 'tmp_0000005'),
+            ('withdraw_annotation', 'ilx_0101431', 'ilx_0000001', 'drop'),]
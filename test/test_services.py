@@ -1,11 +1,17 @@
 import os
+import time
+import asyncio
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 import pytest
 import rdflib
 import ontquery as oq
+from ontquery.utils import QueryPlan, time_left
 from .common import test_graph, skipif_no_net, log
 from .test_interlex_client import skipif_no_api_key
+from .servers import FakeSciGraph, FakeInterLex
 
 # FIXME TODO per service ... + mismatch warning
 oq.OntCuries({'rdf': str(rdflib.RDF),
@@ -220,3 +226,1040 @@ class TestGitHub(ServiceBase, unittest.TestCase):
     def test_ontid(self):
         t = self.OntTerm(OntId('BIRNLEX:796'))
         assert t.label, repr(t)
+
+
+class CountingRdflib(oq.plugin.get('rdflib')):
+    """ rdflibLocal that records how many times it was queried """
+
+    def __init__(self, *args, **kwargs):
+        self.calls = 0
+        super().__init__(*args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        self.calls += 1
+        yield from super().query(*args, **kwargs)
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        class OntTermChild(OntTerm): pass
+        self.remote = CountingRdflib(test_graph)
+        OntTerm.query_init(self.remote, negative_cache_ttl=300)
+        self.OntTerm = OntTerm
+        self.OntTermChild = OntTermChild
+
+    def test_miss_is_cached(self):
+        t1 = self.OntTerm('TEMP:curie/does/not/exist')
+        calls = self.remote.calls
+        t2 = self.OntTermChild('TEMP:curie/does/not/exist')
+        assert not t1.validated and not t2.validated
+        assert self.remote.calls == calls, 'shared negative cache was not used'
+        assert len(self.OntTerm.query.negative_cache) == 1
+
+    def test_hits_not_cached(self):
+        self.OntTerm('UBERON:0000955')
+        assert not self.OntTerm.query.negative_cache.items()
+
+    def test_purge(self):
+        self.OntTerm('TEMP:curie/does/not/exist')
+        self.OntTerm('TEMP:also/does/not/exist')
+        nc = self.OntTerm.query.negative_cache
+        assert nc.purge(iri=OntId('TEMP:also/does/not/exist').iri) == 1
+        assert len(nc) == 1
+        calls = self.remote.calls
+        self.OntTerm('TEMP:also/does/not/exist')
+        assert self.remote.calls > calls
+        assert nc.purge() == 2
+
+    def test_off_by_default(self):
+        graph = rdflib.Graph()
+        class OntTerm(oq.OntTerm): pass
+        OntTerm.query_init(oq.plugin.get('rdflib')(graph))
+        iri = OntId('UBERON:0000955').iri
+        assert not list(OntTerm.query(iri=iri))
+        graph.add((rdflib.URIRef(iri), rdflib.RDF.type, rdflib.OWL.Class))
+        graph.add((rdflib.URIRef(iri), rdflib.RDFS.label, rdflib.Literal('brain')))
+        result, = OntTerm.query(iri=iri, raw=True)
+        assert result.label == 'brain'
+
+    def test_ttl(self):
+        self.OntTerm.query.negative_cache.ttl = 0
+        self.OntTerm('TEMP:curie/does/not/exist')
+        calls = self.remote.calls
+        self.OntTerm('TEMP:curie/does/not/exist')
+        assert self.remote.calls > calls
+
+
+class SlowCountingRdflib(CountingRdflib):
+    delay = 0.2
+
+    def query(self, *args, **kwargs):
+        time.sleep(self.delay)
+        yield from super().query(*args, **kwargs)
+
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.remote = SlowCountingRdflib(test_graph)
+        OntTerm.query_init(self.remote)
+        self.OntTerm = OntTerm
+
+    def _fan_out(self, n=8, **kwargs):
+        barrier = threading.Barrier(n)
+        def work():
+            barrier.wait()
+            return list(self.OntTerm.query(raw=True, **kwargs))
+
+        with ThreadPoolExecutor(max_workers=n) as ex:
+            return [f.result() for f in [ex.submit(work) for _ in range(n)]]
+
+    def test_identical_queries_share_call(self):
+        self.OntTerm.query.setup()
+        outs = self._fan_out(iri=OntId('UBERON:0000955').iri)
+        assert self.remote.calls == 1, self.remote.calls
+        first, = outs[0]
+        assert all(len(o) == 1 and o[0] is first for o in outs)
+
+    def test_different_queries_do_not_share(self):
+        self.OntTerm.query.setup()
+        self._fan_out(n=2, iri=OntId('UBERON:0000955').iri)
+        self._fan_out(n=2, iri=OntId('BIRNLEX:796').iri)
+        assert self.remote.calls == 2, self.remote.calls
+
+    def test_leader_stops_early(self):
+        self.OntTerm.query.setup()
+        iri = OntId('UBERON:0000955').iri
+        gen = self.OntTerm.query(iri=iri, raw=True)
+        follower = []
+        thread = threading.Thread(target=lambda: follower.extend(
+            self.OntTerm.query(iri=iri, raw=True)))
+        first = next(gen)
+        thread.start()
+        flight, = self.OntTerm.query._in_flight.values()
+        while not flight.followers:
+            time.sleep(0.01)
+
+        gen.close()
+        thread.join(timeout=5)
+        assert follower and follower[0] is first
+
+
+class TestAsyncOntQuery(unittest.TestCase):
+    def setUp(self):
+        self.remote = SlowCountingRdflib(test_graph)
+        self.query = oq.AsyncOntQuery(self.remote, instrumented=oq.OntTerm)
+
+    def test_query(self):
+        async def main():
+            return [r async for r in self.query(curie='UBERON:0000955', raw=True)]
+
+        result, = asyncio.run(main())
+        assert result.label == 'brain'
+
+    def test_concurrent_identical_queries_share_call(self):
+        async def one():
+            return [r async for r in self.query(iri=OntId('UBERON:0000955').iri, raw=True)]
+
+        async def main():
+            return await asyncio.gather(*[one() for _ in range(8)])
+
+        outs = asyncio.run(main())
+        assert self.remote.calls == 1, self.remote.calls
+        first, = outs[0]
+        assert all(o[0] is first for o in outs)
+
+    def test_timed_and_untimed_do_not_share(self):
+        iri = OntId('UBERON:0000955').iri
+        async def one(**kwargs):
+            return [r async for r in self.query(iri=iri, raw=True, **kwargs)]
+
+        async def main():
+            return await asyncio.gather(one(timeout=0.05), one())
+
+        timed, untimed = asyncio.run(main())
+        assert not timed
+        result, = untimed
+        assert result.label == 'brain'
+
+
+class PlanRecordingRdflib(oq.plugin.get('rdflib')):
+    """ rdflibLocal that records the QueryPlans it receives """
+
+    def __init__(self, *args, **kwargs):
+        self.plans = []
+        super().__init__(*args, **kwargs)
+
+    def query(self, *args, _plan=None, **kwargs):
+        self.plans.append(_plan)
+        yield from super().query(*args, _plan=_plan, **kwargs)
+
+
+class TestQueryPlan(unittest.TestCase):
+    def test_forms(self):
+        plan = QueryPlan({'curie': 'UBERON:0000955',
+                          'predicates': ('rdfs:subClassOf', 'subClassOf'),
+                          'prefix': 'UBERON'}, OntId)
+        assert plan.iri == 'http://purl.obolibrary.org/obo/UBERON_0000955'
+        assert plan.curie == 'UBERON:0000955'
+        assert plan.uriref == rdflib.URIRef(plan.iri)
+        assert plan.predicate_urirefs == (rdflib.RDFS.subClassOf, 'subClassOf')
+        assert plan.prefixes == {'UBERON'}
+        assert plan['curie'] == 'UBERON:0000955'
+
+    def test_bad_identifier(self):
+        plan = QueryPlan({'curie': 'lol not a curie'}, OntId)
+        assert plan.identifier is None and plan.iri is None
+
+    def test_services_share_plan(self):
+        class OntTerm(oq.OntTerm): pass
+        r1 = PlanRecordingRdflib(rdflib.Graph())
+        r2 = PlanRecordingRdflib(test_graph)
+        OntTerm.query_init(r1, r2)
+        t = OntTerm('UBERON:0000955')
+        assert t.label == 'brain'
+        (p1,), (p2,) = r1.plans, r2.plans
+        assert p1 is p2
+        assert p1.iri == t.iri
+
+
+class UberonOnlyRdflib(CountingRdflib):
+    served_prefixes = frozenset(('UBERON',))
+    served_namespaces = 'http://purl.obolibrary.org/obo/UBERON_',
+
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.remote = CountingRdflib(test_graph)
+        self.uberon = UberonOnlyRdflib(test_graph)
+        OntTerm.query_init(self.uberon, self.remote)
+        self.OntTerm = OntTerm
+
+    def test_skip_namespace(self):
+        t = self.OntTerm('BIRNLEX:796')
+        assert self.uberon.calls == 0
+        assert self.remote.calls == 1
+        t = self.OntTerm('UBERON:0000955')
+        assert self.uberon.calls == 1
+
+    def test_skip_keyword(self):
+        assert not list(self.OntTerm.query(search='brain'))
+        assert self.remote.calls == 0 and self.uberon.calls == 0
+
+    def test_skip_prefix(self):
+        list(self.OntTerm.query(label='brain', prefix='BIRNLEX'))
+        assert self.uberon.calls == 0
+
+    def test_unknown_prefix(self):
+        class OntTerm(oq.OntTerm): pass
+        OntTerm.query_init(self.uberon)
+        try:
+            next(OntTerm.query(label='brain', prefix='notaprefix'))
+            raise AssertionError('should have failed')
+        except ValueError:
+            pass
+
+
+class SlowRdflib(CountingRdflib):
+    def query(self, *args, **kwargs):
+        time.sleep(0.05)
+        yield from super().query(*args, **kwargs)
+
+
+class TestAdaptive(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.slow = SlowRdflib(test_graph)
+        self.empty = SlowRdflib(rdflib.Graph())
+        self.fast = CountingRdflib(test_graph)
+        OntTerm.query_init(self.empty, self.slow, self.fast)
+        self.OntTerm = OntTerm
+        self.query = OntTerm.query
+        self.query.adaptive = True
+        self.query.negative_cache.ttl = 0
+
+    def _run(self, n=4):
+        for _ in range(n):
+            list(self.query(iri=OntId('UBERON:0000955').iri, raw=True))
+
+    def test_reorder(self):
+        self._run()
+        stats = self.query.stats.as_dict()
+        key = 'UBERON', 'iri'
+        assert stats[self.empty][key]['hits'] == 0
+        assert stats[self.fast][key]['hit_rate'] == 1
+        self.fast.calls = self.slow.calls = self.empty.calls = 0
+        self._run()
+        assert self.fast.calls == 4
+        assert self.slow.calls == 0 and self.empty.calls == 0
+
+    def test_recovers(self):
+        self._run()
+        self.query.stats.stale = 0.2
+        self.empty.graph = test_graph  # the empty service now has the answers
+        self._run()
+        assert self.empty.calls == 1  # only the first query, sorted last after that
+        time.sleep(0.25)
+        self.fast.calls = self.slow.calls = self.empty.calls = 0
+        self._run(1)
+        assert self.empty.calls == 1, 'stale stats were not retried'
+        stats = self.query.stats.as_dict()[self.empty]['UBERON', 'iri']
+        assert stats['calls'] == 1 and stats['hit_rate'] == 1
+
+    def test_priority(self):
+        self.slow.priority = 1
+        self._run()
+        assert self.slow.calls == 4
+        assert self.fast.calls == 0
+
+    def test_dedupe(self):
+        self.query.ladd(self.fast)
+        self.query.radd(self.empty, self.fast)
+        assert self.query.services == (self.fast, self.empty, self.slow)
+
+
+class DownRdflib(CountingRdflib):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.down = True
+
+    def query(self, *args, **kwargs):
+        if self.down:
+            self.calls += 1
+            raise ConnectionError('service is down')
+
+        yield from super().query(*args, **kwargs)
+
+
+class TestBreaker(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.down = DownRdflib(test_graph)
+        self.up = CountingRdflib(test_graph)
+        OntTerm.query_init(self.down, self.up, breaker_threshold=2, breaker_cooldown=0.2,
+                           negative_cache_ttl=300)
+        self.OntTerm = OntTerm
+        self.query = OntTerm.query
+        self.query.coalesce = False
+
+    def test_open_and_probe(self):
+        breaker = self.query.breaker
+        for curie in ('UBERON:0000955', 'BIRNLEX:796'):
+            assert self.OntTerm(curie).label
+
+        assert self.down.calls == 2
+        assert breaker.state(self.down) == breaker.open
+        assert breaker.as_dict()[self.down]['failures'] == 2
+        assert self.OntTerm('UBERON:0000955').label
+        assert self.down.calls == 2  # skipped
+
+        time.sleep(0.25)
+        assert breaker.state(self.down) == breaker.half_open
+        self.down.down = False
+        assert self.OntTerm('UBERON:0000955').label
+        assert breaker.state(self.down) == breaker.closed
+        assert not breaker.as_dict()
+
+    def test_failure_not_negative_cached(self):
+        self.query._services = self.down,
+        assert list(self.query(iri=OntId('UBERON:0000955').iri)) == []
+        assert not len(self.query.negative_cache)
+
+    def test_disabled_raises(self):
+        class OntTerm(oq.OntTerm): pass
+        OntTerm.query_init(self.down, self.up)
+        with self.assertRaises(ConnectionError):
+            OntTerm('UBERON:0000955')
+
+
+class StallingRdflib(CountingRdflib):
+    """ the first query stalls, like a request stuck on a bad connection,
+        and gives up at the deadline like requests through deadline_session """
+    hedgeable = True
+    stall = 0.5
+    cut_short = False
+
+    def query(self, *args, **kwargs):
+        with self.lock:
+            first = not self.stalled
+            self.stalled = True
+
+        if first:
+            left = time_left()
+            if left is not None and left < self.stall:
+                time.sleep(left)
+                self.cut_short = True
+                raise TimeoutError('stalled past the deadline')
+
+            time.sleep(self.stall)
+
+        yield from super().query(*args, **kwargs)
+
+
+class TestDeadline(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.slow = StallingRdflib(test_graph)
+        self.slow.lock, self.slow.stalled = threading.Lock(), False
+        self.fast = CountingRdflib(test_graph)
+        OntTerm.query_init(self.slow, self.fast, negative_cache_ttl=300)
+        self.OntTerm = OntTerm
+        self.query = OntTerm.query
+
+    def test_timeout_skips_remaining(self):
+        self.slow.graph = rdflib.Graph()  # stalls and then has nothing
+        start = time.monotonic()
+        assert list(self.query(iri=OntId('UBERON:0000955').iri, timeout=0.1)) == []
+        assert time.monotonic() - start < 0.3
+        assert self.slow.cut_short, 'the stalled request ran past the deadline'
+        assert self.fast.calls == 0
+        assert not len(self.query.negative_cache)
+
+    def test_session_timeout(self):
+        from ontquery.utils import deadline, deadline_session
+        class Response(dict):
+            status_code = 200
+
+        class Session:
+            def send(self, request, **kwargs):
+                return Response(kwargs)
+
+        session = deadline_session(Session())
+        assert session.send(None) == {}
+        with deadline(time.monotonic() + 5):
+            assert 0 < session.send(None)['timeout'] <= 5
+            assert session.send(None, timeout=(1, None))['timeout'][0] == 1
+
+    def test_hedge(self):
+        self.query.hedge = 0.9
+        for _ in range(self.query.stats.min_samples):
+            self.query.stats.record(self.slow, None, True, 0.01)
+
+        start = time.monotonic()
+        assert self.OntTerm('UBERON:0000955').label == 'brain'
+        assert time.monotonic() - start < 0.4
+        assert self.fast.calls == 0  # the duplicate request answered
+
+    def test_cli_from_query(self):
+        self.query._configure(hedge=0.9, timeout=5)
+        cli = oq.OntQueryCli(query=self.query)
+        assert cli._config == self.query._config
+        assert cli._stats is self.query._stats
+        result, = cli(iri=OntId('UBERON:0000955').iri, raw=True)
+        assert result.label == 'brain'
+
+
+class TestMap(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        OntTerm.query_init(oq.plugin.get('rdflib')(test_graph))
+        self.query = OntTerm.query
+        self.queries = ['UBERON:0000955', OntId('BIRNLEX:796'), 'UBERON:9999999',
+                        {'label': 'brain'}] * 3
+
+    def test_map(self):
+        expect = self.query.map(self.queries, processes=0)
+        out = self.query.map(self.queries, processes=2, chunksize=2)
+        assert out == expect
+        assert [len(r) for r in out[:4]] == [1, 1, 0, 1]
+
+    def test_wire(self):
+        result, = self.query.map(['UBERON:0000955'], processes=1, raw=True)[0]
+        assert result.label == 'brain' and result._graph is None
+        assert result.source is self.query.services[0]
+        assert result.predicates['rdfs:subClassOf'] == (OntId('UBERON:0000062'),)
+        direct, = self.query(curie='UBERON:0000955', raw=True)
+        assert result.type == direct.type and type(result.type) is type(direct.type)
+        assert [type(t) for t in result.types] == [type(t) for t in direct.types]
+
+        # scigraph types are OntIds
+        wire = direct.__class__(None, iri=direct.iri, type=OntId('owl:Class'),
+                                types=(OntId('owl:Class'),)).to_wire()
+        back = direct.__class__.from_wire(wire, OntId)
+        assert type(back.type) is OntId and back.types == (OntId('owl:Class'),)
+
+    def test_executor_in_worker(self):
+        self.query.add(oq.plugin.get('rdflib')(test_graph))
+        self.query.setup()
+        queries = [dict(curie=curie, include_all_services=True)
+                   for curie in ('UBERON:0000955', 'BIRNLEX:796')]
+        expect = self.query.map(queries, processes=0)  # the executor now has threads
+        assert self.query._executor is not None
+        out = []
+        thread = threading.Thread(target=lambda: out.extend(
+            self.query.map(queries, processes=2, chunksize=1)), daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+        assert not thread.is_alive(), 'worker hung on an executor inherited from the parent'
+        assert out == expect and all(out)
+
+
+class PickleTerm(oq.OntTerm):
+    pass
+
+
+class TestPickle(unittest.TestCase):
+    def setUp(self):
+        self.remote = CountingRdflib(test_graph)
+        PickleTerm.query_init(self.remote)
+
+    def test_term(self):
+        import pickle
+        t = PickleTerm('UBERON:0000955')
+        calls = self.remote.calls
+        t2 = pickle.loads(pickle.dumps(t))
+        assert self.remote.calls == calls
+        assert t2 == t and type(t2) is PickleTerm
+        assert t2.label == 'brain' and t2.validated and t2.curie == 'UBERON:0000955'
+        assert t2._query_result.label == 'brain'
+        assert t2._query_result._graph is None and t2.source is None
+        assert repr(t2) == repr(t)
+
+    def test_provenance(self):
+        import pickle
+        t = PickleTerm('UBERON:0000955')
+        oq.utils.QueryResult.pickle_provenance = True
+        try:
+            t2 = pickle.loads(pickle.dumps(t))
+        finally:
+            oq.utils.QueryResult.pickle_provenance = False
+
+        assert len(t2._query_result._graph) == len(t._query_result._graph)
+
+    def test_id(self):
+        import pickle
+        i = OntId('UBERON:0000955')
+        i2 = pickle.loads(pickle.dumps(i))
+        assert type(i2) is OntId and i2.curie == i.curie
+
+
+class SetupCountingRdflib(CountingRdflib):
+    setups = 0
+
+    def setup(self, **kwargs):
+        time.sleep(0.05)  # widen the window for a second setup
+        self.setups += 1
+        return super().setup(**kwargs)
+
+
+class TestThreadSafety(unittest.TestCase):
+    curies = 'UBERON:0000955', 'BIRNLEX:796', 'UBERON:0000062', 'UBERON:9999999'
+
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.remote = SetupCountingRdflib(test_graph)
+        OntTerm.query_init(self.remote)
+        self.OntTerm = OntTerm
+
+    def test_stress(self):
+        n = 16
+        barrier = threading.Barrier(n)
+
+        def work(i):
+            barrier.wait()
+            out = []
+            for j in range(40):
+                t = self.OntTerm(self.curies[(i + j) % len(self.curies)])
+                if (i + j) % 2:
+                    t.set_next_repr('curie')
+
+                out.append((t.curie, bool((i + j) % 2), repr(t)))
+
+            return out
+
+        with ThreadPoolExecutor(n) as pool:
+            results = [r for rs in pool.map(work, range(n)) for r in rs]
+
+        assert self.remote.setups == 1
+        expect = {}
+        for curie in self.curies:
+            t = self.OntTerm(curie)
+            expect[curie, False] = repr(t)
+            t.set_next_repr('curie')
+            expect[curie, True] = repr(t)
+
+        bad = [r for r in results if expect[r[:2]] != r[2]]
+        assert not bad, bad[:5]
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        g = rdflib.Graph()
+        brain = rdflib.URIRef(OntId('UBERON:0000955').iri)
+        g.add((brain, rdflib.RDF.type, rdflib.OWL.Class))
+        g.add((brain, rdflib.RDFS.label, rdflib.Literal('not the brain')))
+        g.add((brain, rdflib.URIRef(OntId('NIFRID:synonym').iri), rdflib.Literal('encephalon')))
+        g.add((brain, rdflib.URIRef(OntId('hasPart:').iri), rdflib.URIRef(OntId('UBERON:0000956').iri)))
+        self.other = SlowCountingRdflib(g)
+        self.remote = SlowCountingRdflib(test_graph)
+        OntTerm.query_init(self.remote, self.other)
+        self.OntTerm = OntTerm
+
+    def test_merge(self):
+        start = time.monotonic()
+        result, = self.OntTerm.query(iri=OntId('UBERON:0000955').iri,
+                                     include_all_services=True, raw=True)
+        assert time.monotonic() - start < 2 * SlowCountingRdflib.delay, 'not concurrent'
+        assert self.remote.calls == 1 and self.other.calls == 1
+        assert result.label == 'brain'
+        assert result.source is self.remote
+        assert 'encephalon' in result.synonyms
+        assert 'hasPart:' in result.predicates
+
+    def test_priority(self):
+        self.other.priority = 1
+        result, = self.OntTerm.query(iri=OntId('UBERON:0000955').iri,
+                                     include_all_services=True, raw=True)
+        assert result.label == 'not the brain'
+
+
+class SearchRdflib(CountingRdflib):
+    """ rdflibLocal with a substring search on labels """
+    query_keywords = None
+
+    def query(self, *args, search=None, _plan=None, **kwargs):
+        if search is None:
+            yield from super().query(*args, _plan=_plan, **kwargs)
+            return
+
+        for s, o in sorted(self.graph.subject_objects(rdflib.RDFS.label)):
+            if search in o:
+                yield from super().query(iri=s)
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.remote = SearchRdflib(test_graph)
+        self.other = SearchRdflib(test_graph)
+        OntTerm.query_init(self.remote, self.other)
+        self.OntTerm = OntTerm
+
+    def test_dedupe(self):
+        results = list(self.OntTerm.query.stream(search='rain', raw=True))
+        assert len(results) == 2, results
+        assert self.other.calls, 'both services should be asked'
+
+    def test_stop_early(self):
+        stream = self.OntTerm.query.stream(search='rain', buffer=1)
+        first = next(stream)
+        stream.close()
+        assert first.label == 'brain'
+        for thread in threading.enumerate():
+            if thread.name.endswith('.stream'):
+                thread.join(timeout=5)
+                assert not thread.is_alive()
+
+    def test_search_iter(self):
+        terms = list(self.OntTerm.search_iter('rain'))
+        assert sorted(t.curie for t in terms) == ['BIRNLEX:796', 'UBERON:0000955']
+        assert self.OntTerm.search('rain') == sorted(terms, key=lambda t: t.label)
+
+    def test_search_no_extra_lookups(self):
+        terms = self.OntTerm.search('rain', filters=('Br',))
+        assert [t.curie for t in terms] == ['BIRNLEX:796']
+        # only the iri queries that SearchRdflib makes for the two hits
+        assert self.remote.calls == 2 and self.other.calls == 2
+
+
+class TestNeighborsMany(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.remote = CountingRdflib(test_graph)
+        OntTerm.query_init(self.remote)
+        self.OntTerm = OntTerm
+
+    def test_neighbors_many(self):
+        out = self.OntTerm.neighbors_many(
+            ['UBERON:0000955', 'UBERON:0000062', 'UBERON:0000955'],
+            'rdfs:subClassOf', asTerm=True)
+        assert list(out) == ['UBERON:0000955', 'UBERON:0000062']
+        parent, = out['UBERON:0000955']['rdfs:subClassOf']
+        assert isinstance(parent, self.OntTerm) and parent.curie == 'UBERON:0000062'
+        # two subjects and three distinct neighbors, rdflib also returns rdf:type owl:Class
+        assert self.remote.calls == 5, self.remote.calls
+
+    def test_every_form_is_a_key(self):
+        iri = OntId('UBERON:0000955').iri
+        out = self.OntTerm.neighbors_many(['UBERON:0000955', iri], 'rdfs:subClassOf')
+        assert out['UBERON:0000955'] is out[iri]
+        assert self.remote.calls == 1, self.remote.calls
+
+    def test_matches_call(self):
+        t = self.OntTerm('UBERON:0000955')
+        expect = t('rdfs:subClassOf', depth=2)
+        out = self.OntTerm.neighbors_many([t], 'rdfs:subClassOf', depth=2)
+        assert out[t]['rdfs:subClassOf'] == expect
+
+
+class TestDeferred(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.remote = CountingRdflib(test_graph)
+        OntTerm.query_init(self.remote)
+        self.OntTerm = OntTerm
+
+    def test_type_from_resolution(self):
+        t = self.OntTerm('UBERON:0000955')
+        calls = self.remote.calls
+        del t._type, t._types
+        assert str(t.type) == OntId('owl:Class').iri and t.types == tuple()
+        assert self.remote.calls == calls
+
+    def test_unresolved_does_not_requery(self):
+        t = self.OntTerm('UBERON:9999999')
+        calls = self.remote.calls
+        assert t.type is None and t.types == tuple()
+        assert self.remote.calls == calls
+
+
+class TestPreferred(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        g = rdflib.Graph()
+        replacedBy = rdflib.URIRef(OntId('replacedBy:').iri)
+        ids = [rdflib.URIRef(OntId(f'TEMP:replaced-{i}').iri) for i in range(4)]
+        for i, s in enumerate(ids):
+            g.add((s, rdflib.RDF.type, rdflib.OWL.Class))
+            g.add((s, rdflib.RDFS.label, rdflib.Literal(f'replaced {i}')))
+            if i < 3:
+                g.add((s, rdflib.OWL.deprecated, rdflib.Literal(True)))
+                g.add((s, replacedBy, ids[i + 1]))
+
+        cyc = [rdflib.URIRef(OntId(f'TEMP:cyc-{i}').iri) for i in range(2)]
+        for i, s in enumerate(cyc):
+            g.add((s, rdflib.RDF.type, rdflib.OWL.Class))
+            g.add((s, rdflib.OWL.deprecated, rdflib.Literal(True)))
+            g.add((s, replacedBy, cyc[i - 1]))
+
+        self.remote = CountingRdflib(g)
+        OntTerm.query_init(self.remote)
+        self.OntTerm = OntTerm
+
+    def test_chain(self):
+        t = self.OntTerm('TEMP:replaced-0')
+        assert t.asPreferred().curie == 'TEMP:replaced-3'
+        calls = self.remote.calls
+        assert self.OntTerm('TEMP:replaced-1').asPreferred().curie == 'TEMP:replaced-3'
+        assert self.remote.calls == calls + 2  # only constructing the two terms
+
+    def test_provenance(self):
+        t0, t1 = self.OntTerm('TEMP:replaced-0'), self.OntTerm('TEMP:replaced-1')
+        p0, p1 = t0.asPreferred(), t1.asPreferred()
+        assert p0 == p1 and p0 is not p1
+        assert p0._original_term is t0 and p1._original_term is t1
+        assert self.OntTerm('TEMP:replaced-3').asPreferred().curie == 'TEMP:replaced-3'
+
+    def test_cache_bounds(self):
+        self.OntTerm.preferred_cache_size = 2
+        self.OntTerm('TEMP:replaced-0').asPreferred()
+        assert len(self.OntTerm._preferred_cache) == 2  # replaced-2 and -3 were kept
+        self.OntTerm.preferred_cache_ttl = 0
+        calls = self.remote.calls
+        self.OntTerm('TEMP:replaced-2').asPreferred()
+        assert self.remote.calls > calls + 2, 'expired entry was used'
+
+    def test_cycle(self):
+        assert self.OntTerm('TEMP:cyc-0').asPreferred().curie == 'TEMP:cyc-1'
+
+    def test_many(self):
+        out = self.OntTerm.asPreferred_many(['TEMP:replaced-0', 'TEMP:replaced-3', 'TEMP:replaced-0'])
+        assert [t.curie for t in out] == ['TEMP:replaced-3'] * 3
+
+    def test_nested_fan_out(self):
+        # fill every worker with a task that fans out again
+        n = self.OntTerm.query._max_workers
+        barrier = threading.Barrier(n)
+        def work(i):
+            barrier.wait(timeout=10)
+            return self.OntTerm.asPreferred_many([f'TEMP:replaced-{i % 3}', 'TEMP:replaced-3'])
+
+        executor = self.OntTerm.query._get_executor()
+        futures = [executor.submit(work, i) for i in range(n)]
+        for future in futures:
+            assert [t.curie for t in future.result(timeout=20)] == ['TEMP:replaced-3'] * 2
+
+
+class FakeSciGraphGraph:
+    """ just enough of scigraph Graph.getNeighbors to run offline """
+
+    def __init__(self, edges):
+        self.edges = edges  # (sub, pred, obj)
+        self.calls = []
+
+    def getNeighbors(self, id, relationshipType=None, depth=1, direction='OUTGOING', entail=True):
+        self.calls.append((id.curie, relationshipType))
+        todo, edges = [id.curie], []
+        for _ in range(depth):
+            next = []
+            for s, p, o in self.edges:
+                if s in todo and p == relationshipType:
+                    edges.append({'sub': s, 'pred': p, 'obj': o, 'meta': {}})
+                    next.append(o)
+
+            todo = next
+
+        return {'nodes': [], 'edges': edges} if edges else None
+
+
+class TestSciGraphSupers(unittest.TestCase):
+    def setUp(self):
+        self.sgg = FakeSciGraphGraph([
+            ('UBERON:1', 'subClassOf', 'UBERON:2'),
+            ('UBERON:2', 'subClassOf', 'UBERON:3'),
+            ('UBERON:4', 'subClassOf', 'UBERON:3'),
+            ('UBERON:1', 'partOf', 'UBERON:4'),
+            ('UBERON:2', 'partOf', 'UBERON:5'),
+            ('UBERON:3', 'partOf', 'UBERON:6'),
+            ('UBERON:4', 'partOf', 'UBERON:7'),
+        ])
+        self.remote = oq.plugin.get('SciGraph')()
+        self.remote.sgg = self.sgg
+        self.remote._remote_curies = oq.OntCuries
+
+    def test_include_supers(self):
+        out = list(self.remote._graphQuery(OntId('UBERON:1'), 'partOf', include_supers=True))
+        assert sorted(o.curie for p, o in out) == [f'UBERON:{i}' for i in (4, 5, 6, 7)]
+        closure = [c for c, p in self.sgg.calls if p == 'subClassOf']
+        # UBERON:4 and UBERON:7 are outside the closure of UBERON:1 so they need their own
+        assert closure == ['UBERON:1', 'UBERON:4', 'UBERON:7'], closure
+        partof = [c for c, p in self.sgg.calls if p == 'partOf']
+        # UBERON:3 is shared by UBERON:1 and UBERON:4 but only fetched once
+        assert sorted(partof) == sorted(set(partof)), partof
+
+    def test_decode_edges(self):
+        edges = [{'sub': f'UBERON:{i}', 'pred': 'BFO:0000050', 'obj': 'UBERON:9', 'meta': {}}
+                 for i in range(3)]
+        out = self.remote._decodeEdges(edges)
+        assert {p for p, o in out} == {'partOf:'}
+        first = out[0][1]
+        assert first.curie == 'UBERON:9' and all(o is first for p, o in out)
+
+
+class TestLocalSciGraph(ServiceBase, unittest.TestCase):
+    """ the real SciGraph client against a local stand-in, runs offline """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeSciGraph(test_graph, dict(oq.OntCuries._dict)).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        # a fresh client each time, the scigraph client caches responses
+        self.remote = oq.plugin.get('SciGraph')(apiEndpoint=self.server.url)
+        super().setUp()
+
+    def tearDown(self):
+        self.server.reset()
+        self.server.latency = 0
+
+    def test_depth(self):
+        t = self.OntTerm('UBERON:0000955')
+        assert t.label == 'brain'
+        sco = t('rdfs:subClassOf', depth=3)
+        assert sorted(o.curie for o in sco) == ['UBERON:0000062', 'UBERON:0000467',
+                                                'UBERON:0010000'], sco
+
+    def test_search(self):
+        assert [t.curie for t in self.OntTerm.query(term='biocpu')] == ['BIRNLEX:796']
+        assert {t.curie for t in self.OntTerm.query(search='rai')} == {'UBERON:0000955',
+                                                                       'BIRNLEX:796'}
+
+    def test_injected_error(self):
+        self.server.fail(route='find_by_id')
+        assert not list(self.OntTerm.query(curie='BIRNLEX:796'))
+        assert self.server.hits['find_by_id'] == 1
+        assert list(self.OntTerm.query(curie='UBERON:0000955'))
+
+    def test_recovers(self):
+        self.OntTerm.query.negative_cache.ttl = 300
+        self.server.fail(route='find_by_id')
+        assert not list(self.OntTerm.query(curie='BIRNLEX:796'))
+        assert not len(self.OntTerm.query.negative_cache), 'outage was negative cached'
+        assert [r.label for r in self.OntTerm.query(curie='BIRNLEX:796', raw=True)] == ['Brain']
+        assert self.server.hits['find_by_id'] == 2  # the failure did not stick in the client cache
+
+    def test_curies_added_after_setup(self):
+        self.OntTerm.query.setup()
+        assert 'NEWPREFIX' not in self.remote.served_prefixes
+        self.remote.curies({'NEWPREFIX': 'http://example.org/new/'})
+        assert 'NEWPREFIX' in self.remote.served_prefixes
+        assert self.remote.serves(QueryPlan({'search': 'brain', 'prefix': 'NEWPREFIX'}, OntId))
+
+    def test_recovers_async(self):
+        query = oq.AsyncOntQuery(self.remote, instrumented=self.OntTerm,
+                                 negative_cache_ttl=300)
+        async def main():
+            async with query:
+                return [r async for r in query(curie='BIRNLEX:796', raw=True)]
+
+        self.server.fail(route='find_by_id')
+        assert asyncio.run(main()) == []
+        assert not len(query.negative_cache)
+        assert [r.label for r in asyncio.run(main())] == ['Brain']
+        assert not self.remote._asessions, 'session was not closed'
+
+    def test_bad_key_async(self):
+        query = oq.AsyncOntQuery(self.remote, instrumented=self.OntTerm)
+        async def main():
+            async with query:
+                return [r async for r in query(curie='BIRNLEX:796', raw=True)]
+
+        self.server.fail(status=401, route='find_by_id')
+        with self.assertRaises(ConnectionError):
+            asyncio.run(main())
+
+    def test_latency(self):
+        self.OntTerm.query.setup()
+        self.server.latency = .5
+        start = time.monotonic()
+        assert not list(self.OntTerm.query(curie='UBERON:0000955', timeout=.1))
+        assert time.monotonic() - start < .4
+
+
+class TestLocalInterLex(unittest.TestCase):
+    """ the InterLex remote against a local stand-in, both the
+        n-triples resolver and the scicrunch api, runs offline """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeInterLex(test_graph, dict(oq.OntCuries._dict)).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.server.reset()
+
+    def _term(self, **kwargs):
+        class OntTerm(oq.OntTerm): pass
+        remote = oq.plugin.get('InterLex')(apiEndpoint=None, **kwargs)
+        OntTerm.query_init(remote)
+        OntTerm.query.setup()
+        return OntTerm, remote
+
+    def test_resolver(self):
+        OntTerm, remote = self._term()
+        remote.host, remote.port = self.server.host, self.server.port
+        iri = self.server.ilx_iri(OntId('UBERON:0000955').iri)
+        t = OntTerm(iri=iri)
+        assert t.label == 'brain'
+        assert t.predicates['TEMP:preferredId'] == (OntId(iri),)
+        OntTerm(iri=iri)
+        assert self.server.hits['ilx_ntriples'] == 1  # the rest came from the graph cache
+
+    def test_api(self):
+        OntTerm, remote = self._term(api_first=True)
+        remote.ilx_cli = self.server.client()
+        t = OntTerm('BIRNLEX:796')
+        assert t.label == 'Brain' and t.definition.startswith('Gray')
+        assert [r.curie for r in OntTerm.query(label='biocpu')] == ['ILX:0000002']
+
+    def test_injected_error(self):
+        OntTerm, remote = self._term(api_first=True)
+        remote.ilx_cli = self.server.client()
+        self.server.fail(route='entity_from_curie')
+        assert not list(OntTerm.query(curie='UBERON:0000955'))
+        assert self.server.hits['entity_from_curie'] == 1
+        assert list(OntTerm.query(curie='BIRNLEX:796'))
+
+    def test_recovers(self):
+        OntTerm, remote = self._term(api_first=True)
+        remote.ilx_cli = self.server.client()
+        OntTerm.query.negative_cache.ttl = 300
+        self.server.fail(route='entity_from_curie')
+        assert not list(OntTerm.query(curie='UBERON:0000955'))
+        assert not len(OntTerm.query.negative_cache), 'outage was negative cached'
+        assert list(OntTerm.query(curie='UBERON:0000955'))
+
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        class OntTerm(oq.OntTerm): pass
+        self.down = DownRdflib(test_graph)
+        self.remote = CountingRdflib(test_graph)
+        OntTerm.query_init(self.remote, metrics=True, negative_cache_ttl=300)
+        self.OntTerm = OntTerm
+        self.query = OntTerm.query
+        self.events = []
+
+    def _record(self, target, *names):
+        for name in names or target.hook_names:
+            target.add_hook(name, lambda name=name, **kwargs: self.events.append((name, kwargs)))
+
+    def test_events(self):
+        self._record(self.query)
+        iri = OntId('UBERON:0000955').iri
+        assert len(list(self.query(iri=iri))) == 1
+        names = [name for name, kwargs in self.events]
+        assert names == ['on_query_start', 'on_service_result', 'on_query_end'], names
+        (_, result), (_, end) = self.events[1:]
+        assert result['service'] is self.remote and result['count'] == 1
+        assert end['count'] == 1 and not end['cached'] and end['latency'] >= 0
+
+        self.events.clear()
+        assert not list(self.query(curie='TEMP:curie/does/not/exist'))
+        assert not list(self.query(curie='TEMP:curie/does/not/exist'))
+        assert self.events[-1][1]['cached'] and self.events[-2][0] == 'on_query_start'
+
+    def test_service_hooks(self):
+        self._record(self.remote)
+        self.OntTerm('UBERON:0000955')
+        names = [name for name, kwargs in self.events]
+        assert names == ['on_query_start', 'on_service_result', 'on_query_end'], names
+        assert self.events[-1][1]['service'] is self.remote
+        self.remote.remove_hook('on_query_end', self.remote._hooks['on_query_end'][0])
+        assert 'on_query_end' not in self.remote._hooks
+        assert not CountingRdflib._hooks, 'hooks leaked onto the class'
+
+    def test_bad_hook(self):
+        with self.assertRaises(ValueError):
+            self.query.add_hook('on_everything', print)
+
+        self.query.add_hook('on_query_start', lambda **kwargs: 1 / 0)
+        assert self.OntTerm('UBERON:0000955').label  # logged, not raised
+
+    def test_metrics(self):
+        class OntTerm(oq.OntTerm): pass
+        OntTerm.query_init(self.down, self.remote, metrics=True, breaker_threshold=2)
+        OntTerm('UBERON:0000955')
+        list(OntTerm.query(label='brain'))
+        metrics = OntTerm.query.metrics.as_dict()
+        assert metrics['queries']['iri']['queries'] == 1
+        assert metrics['queries']['label']['results'] >= 1
+        down = metrics['services']['DownRdflib']['iri']
+        assert down['calls'] == down['errors'] == 1 and down['latency']['count'] == 1
+        up = metrics['services']['CountingRdflib']['iri']
+        assert up['results'] == 1 and not up['errors']
+        assert up['latency']['buckets'][float('inf')] == 1
+
+        text = OntTerm.query.metrics.prometheus()
+        assert 'ontquery_service_errors_total{service="DownRdflib",kind="iri"} 1' in text
+        assert 'ontquery_query_duration_seconds_bucket{kind="iri",le="+Inf"} 1' in text
+        assert '# TYPE ontquery_queries_total counter' in text
+        OntTerm.query.metrics.reset()
+        assert OntTerm.query.metrics.as_dict() == {'queries': {}, 'services': {}}
+
+    def test_disabled(self):
+        class OntTerm(oq.OntTerm): pass
+        OntTerm.query_init(self.remote)
+        assert OntTerm.query.metrics is None and not OntTerm.query._hooks
+        assert OntTerm('UBERON:0000955').label
+
+    def test_async(self):
+        query = oq.AsyncOntQuery(self.remote, instrumented=oq.OntTerm, metrics=True)
+        self._record(query)
+        async def main():
+            return [r async for r in query(curie='UBERON:0000955', raw=True)]
+
+        assert len(asyncio.run(main())) == 1
+        names = [name for name, kwargs in self.events]
+        assert names == ['on_query_start', 'on_service_result', 'on_query_end'], names
+        assert query.metrics.as_dict()['services']['CountingRdflib']['iri']['results'] == 1